@@ -11,8 +11,9 @@ void updateSerial() {
 
   if (scheduler.taskReady(STATUS_MESSAGE_TASK_ID)) {
     motor.UpdateStatus();
+    unsigned long sample_micros = micros();
 
-    uint8_t motor_status_buffer[MOTOR_STATUS_MESSAGE_LENGTH];
+    uint8_t motor_status_buffer[MOTOR_STATUS_TIMESTAMPED_MESSAGE_LENGTH];
     motor_status_buffer[0] = MOTOR_STATUS_MESSAGE_ID;
     motor_status_buffer[1] = motor.status_byte;
     motor_status_buffer[2] = motor.status_variables.job_id; 
@@ -20,20 +21,58 @@ void updateSerial() {
 
     memcpy(&motor_status_buffer[4], &motor.status_variables.pulses_remaining, sizeof(unsigned long));
 
-    serialport.sendMessage(&motor_status_buffer[0], MOTOR_STATUS_MESSAGE_LENGTH);
+    // The sample time is only appended once the host has asked for it with SET_TIMESTAMPS
+    if (timestamps_enabled) {
+      memcpy(&motor_status_buffer[8], &sample_micros, sizeof(unsigned long));
+      serialport.sendMessage(&motor_status_buffer[0], MOTOR_STATUS_TIMESTAMPED_MESSAGE_LENGTH);
+    } else {
+        serialport.sendMessage(&motor_status_buffer[0], MOTOR_STATUS_MESSAGE_LENGTH);
+      }
   }
 
   if (scheduler.taskReady(MOTOR_FEEDBACK_TASK_ID)) {
-    uint8_t motor_feedback_buffer[MOTOR_FEEDBACK_MESSAGE_LENGTH];
-    motor_feedback_buffer[0] = MOTOR_FEEDBACK_MESSAGE_ID;
+    if (feedback_batch_size > 1) {
+      addFeedbackSample();
+    } else {
+        sendFeedbackMessage();
+      }
+  }
+}
 
-    float angle_radians = motor.getEncoderAngleRadians();
+void sendFeedbackMessage() {
+  uint8_t motor_feedback_buffer[MOTOR_FEEDBACK_TIMESTAMPED_MESSAGE_LENGTH];
+  motor_feedback_buffer[0] = MOTOR_FEEDBACK_MESSAGE_ID;
 
-    memcpy(&motor_feedback_buffer[1], &motor.encoder_status.velocity_radians, sizeof(float));
-    memcpy(&motor_feedback_buffer[5], &angle_radians, sizeof(float));
-    memcpy(&motor_feedback_buffer[9], &motor.encoder_status.angle_count, sizeof(int));
-    
-    serialport.sendMessage(&motor_feedback_buffer[0], MOTOR_FEEDBACK_MESSAGE_LENGTH);
+  unsigned long sample_micros = micros();
+  float angle_radians = motor.getEncoderAngleRadians();
+
+  memcpy(&motor_feedback_buffer[1], &motor.encoder_status.velocity_radians, sizeof(float));
+  memcpy(&motor_feedback_buffer[5], &angle_radians, sizeof(float));
+  memcpy(&motor_feedback_buffer[9], &motor.encoder_status.angle_count, sizeof(int));
+
+  if (timestamps_enabled) {
+    memcpy(&motor_feedback_buffer[13], &sample_micros, sizeof(unsigned long));
+    serialport.sendMessage(&motor_feedback_buffer[0], MOTOR_FEEDBACK_TIMESTAMPED_MESSAGE_LENGTH);
+  } else {
+      serialport.sendMessage(&motor_feedback_buffer[0], MOTOR_FEEDBACK_MESSAGE_LENGTH);
+    }
+}
+
+void addFeedbackSample() {
+  // {MOTOR_FEEDBACK_BATCH_MESSAGE_ID, sample count, {micros, velocity_radians, angle_count} * sample count}
+  uint8_t* sample_ptr = &feedback_batch_buffer[2 + feedback_batch_count * MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH];
+  unsigned long sample_micros = micros();
+
+  memcpy(sample_ptr, &sample_micros, sizeof(unsigned long));
+  memcpy(sample_ptr + 4, &motor.encoder_status.velocity_radians, sizeof(float));
+  memcpy(sample_ptr + 8, &motor.encoder_status.angle_count, sizeof(int));
+  feedback_batch_count++;
+
+  if (feedback_batch_count >= feedback_batch_size) {
+    feedback_batch_buffer[0] = MOTOR_FEEDBACK_BATCH_MESSAGE_ID;
+    feedback_batch_buffer[1] = feedback_batch_count;
+    serialport.sendMessage(&feedback_batch_buffer[0], 2 + feedback_batch_count * MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH);
+    feedback_batch_count = 0;
   }
 }
 
@@ -357,6 +396,43 @@ void processCommandMessage(MotorInterface* motor_ptr, int bytes_read) {
 
       break;
 
+    case SET_TIMESTAMPS:
+      // Older firmware answers this with UNKNOWN_MOTOR_COMMAND_RESPONSE, the host then keeps to untimed frames
+      if (bytes_read == 2) {
+        timestamps_enabled = (serial_buffer[1] > 0) ? true : false;
+        response_buffer[3] = 0x00;
+        response_buffer[4] = ACK;
+      }
+
+      break;
+
+    case SET_FEEDBACK_BATCH:
+      // {batch size, sample interval us}, a batch size of 1 goes back to one MOTOR_FEEDBACK message per sample
+      // and an interval of 0 keeps the current one
+      if (bytes_read == 6) {
+        unsigned long feedback_interval = unsignedLongFromBytes(&serial_buffer[2]);
+
+        if (serial_buffer[1] < 1 || serial_buffer[1] > MOTOR_FEEDBACK_BATCH_MAX_SAMPLES) {
+          response_buffer[3] = BAD_SETTING_RESPONSE;
+
+        } else if (feedback_interval != 0 && feedback_interval < MOTOR_FEEDBACK_MINIMUM_INTERVAL_US) {
+            response_buffer[3] = BAD_SETTING_RESPONSE;
+
+          } else {
+              feedback_batch_size = serial_buffer[1];
+              feedback_batch_count = 0;
+
+              if (feedback_interval != 0) {
+                scheduler.editTime(MOTOR_FEEDBACK_TASK_ID, feedback_interval);
+              }
+
+              response_buffer[3] = 0x00;
+              response_buffer[4] = ACK;
+            }
+      }
+
+      break;
+
     case RESET_MOTOR:
 
       bool was_enabled = false;
@@ -23,6 +23,7 @@
 #define STATUS_MESSAGE_INTERVAL_US  250000
 #define MOTOR_FEEDBACK_TASK_ID  2
 #define MOTOR_FEEDBACK_INTERVAL_US  10000
+#define MOTOR_FEEDBACK_MINIMUM_INTERVAL_US  250
 
 // io_settings
 #define MOTOR_INT_PIN_A 2
@@ -55,14 +56,19 @@
 #define RESPONSE_MESSAGE_ID                 0xFC
 #define JOB_COMPLETE_MESSAGE_ID             0xFA
 #define JOB_CANCELLED_MESSAGE_ID            0xF9
+#define MOTOR_FEEDBACK_BATCH_MESSAGE_ID     0xF8
 
 // message_lengths
 #define MOTOR_STATUS_MESSAGE_LENGTH         8
-#define MOTOR_FEEDBACK_MESSAGE_LENGTH       11
+#define MOTOR_FEEDBACK_MESSAGE_LENGTH       13
 #define MOTOR_FAULT_MESSAGE_LENGTH          1
 #define RESPONSE_MESSAGE_LENGTH             5
 #define JOB_COMPLETE_MESSAGE_LENGTH         2
 #define JOB_CANCELLED_MESSAGE_LENGTH        2
+#define MOTOR_STATUS_TIMESTAMPED_MESSAGE_LENGTH     12
+#define MOTOR_FEEDBACK_TIMESTAMPED_MESSAGE_LENGTH   17
+#define MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH  12
+#define MOTOR_FEEDBACK_BATCH_MAX_SAMPLES    20
 
 // command_types
 #define SEND_JOB                            0xEF
@@ -78,6 +84,8 @@
 #define SLEEP_MOTOR                         0xE6
 #define WAKE_MOTOR                          0xE5
 #define RESET_MOTOR                         0xE4
+#define SET_TIMESTAMPS                      0xE2
+#define SET_FEEDBACK_BATCH                  0xE1
 
 // response_types
 #define BAD_JOB_COMMAND_RESPONSE            0xDF
@@ -96,6 +104,7 @@
 #define MOTOR_ALREADY_AWAKE_RESPONSE        0xD2
 #define SLEEP_WITH_ACTIVE_JOB_RESPONSE      0xD1
 #define WAKE_WITH_ACTIVE_JOB_RESPONSE       0xD0
+#define BAD_SETTING_RESPONSE                0xCF
 
 // motor_settings
 #define MOTOR_ID                            0x00
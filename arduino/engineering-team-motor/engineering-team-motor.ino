@@ -8,6 +8,10 @@ ScheduleMicro scheduler(FAULT_CHECK_INTERVAL_US, STATUS_MESSAGE_INTERVAL_US, MOT
 AtSerial serialport;
 
 bool job_direction = false;
+bool timestamps_enabled = false;
+uint8_t feedback_batch_size = 1;
+uint8_t feedback_batch_count = 0;
+uint8_t feedback_batch_buffer[2 + MOTOR_FEEDBACK_BATCH_MAX_SAMPLES * MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH];
 uint8_t serial_buffer[SERIAL_BUFFER_LENGTH];
 
 void setup() {
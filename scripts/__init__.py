@@ -1,2 +1,48 @@
-from .definition_file_parser import parse_definitions_file
-from .motor import Motor
\ No newline at end of file
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Python interface to the motor controller. The modules import each other as top level modules, as when run
+    from this directory, so the directory is put on sys.path. Names are imported on first use
+"""
+
+import sys
+import importlib
+from pathlib import Path
+
+_scripts_directory = str(Path(__file__).resolve().parent)
+
+if _scripts_directory not in sys.path:
+    sys.path.append(_scripts_directory)
+
+_exports = {'parse_definitions_file': 'definition_file_parser',
+            'load_protocol': 'motor_protocol',
+            'Protocol': 'motor_protocol',
+            'ProtocolError': 'motor_protocol',
+            'Motor': 'motor',
+            'AsyncMotor': 'async_motor',
+            'MotorBus': 'motor_bus',
+            'MotorProcess': 'motor_process',
+            'MotionPlanner': 'motion_planner',
+            'MotionCoordinator': 'motion_coordinator',
+            'VirtualMotor': 'virtual_motor',
+            }
+
+__all__ = list(_exports)
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_exports[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    asyncio client for the motor controller, jobs are awaitable and resolve on the firmware's
+    RESPONSE / JOB_COMPLETE / JOB_CANCELLED messages
+"""
+
+import asyncio
+import math
+import random
+from typing import Union
+from pathlib import Path
+
+from motor import Motor
+from serial_transport import open_transport
+from messages import JobCompleteMessage
+from command_tracker import MotorCommandError, JobCancelledError
+
+
+class AsyncMotor(Motor):
+    def __init__(self, definitions_filepath: Union[Path, None] = None, serial_port: Union[str, None] = None, **kwargs):
+        """
+        Description:
+            Runs the Motor protocol handling on an asyncio event loop instead of the read and processing threads.
+            The serial port is read from a selector callback (loop.add_reader) so no thread ever polls.
+            Commands go through command_tracker and command_scheduler as they do on Motor, the scheduler is drained
+            by a loop callback as soon as a command is queued and the tracker deadlines are checked from a task,
+            so the send_* methods return the same futures and resends and timeouts work.
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            serial_port (str): Default serial port path as string
+        """
+        super().__init__(definitions_filepath=definitions_filepath, serial_port=serial_port, **kwargs)
+
+        self.dispatch_inline = True
+        self.loop = None
+        self.reader_fd = None
+        self.write_scheduled = False
+        self.deadline_task = None
+
+        # Futures waiting on job messages, command responses are matched by command_tracker
+        self.job_futures = {}
+        self.feedback_queues = set()
+
+        self.register_handler(self.job_complete_message_id, self.resolve_job_complete)
+        self.register_handler(self.job_cancelled_message_id, self.resolve_job_cancelled)
+        self.register_handler(self.motor_feedback_message_id, self.publish_feedback)
+
+        if self.motor_feedback_batch_message_id is not None:
+            self.register_handler(self.motor_feedback_batch_message_id, self.publish_feedback)
+
+    async def connect(self):
+        """
+        Description:
+            Opens the serial port in non-blocking mode and starts reading it from the running event loop.
+        """
+        self.loop = asyncio.get_running_loop()
+
+        while not self.connected:
+            try:
+                self.ser = open_transport(self.transport, self.serial_port_name, self.baud_rate, timeout=0)
+                self.connected = self.ser.isOpen()
+
+            # pyserial's SerialException is an OSError too
+            except OSError:
+                await asyncio.sleep(1)
+
+        self.running = True
+
+        # Kept, the transport forgets its fd once closed e.g. after an unplug
+        self.reader_fd = self.ser.fileno()
+        self.loop.add_reader(self.reader_fd, self.read_serial_messages)
+        self.command_notifier = self.schedule_write
+        self.deadline_task = self.loop.create_task(self.check_deadlines_loop())
+
+        # Commands sent before connecting are waiting in the scheduler
+        self.schedule_write()
+
+        if self.device_timestamps:
+            await self.enable_timestamps()
+
+    async def close(self):
+        self.running = False
+        self.command_notifier = None
+
+        if self.deadline_task is not None:
+            self.deadline_task.cancel()
+            self.deadline_task = None
+
+        if self.reader_fd is not None:
+            self.loop.remove_reader(self.reader_fd)
+            self.reader_fd = None
+
+        if self.connected:
+            self.ser.close()
+            self.connected = False
+
+        # Ends every feedback() iterator waiting for a message
+        for feedback_queue in self.feedback_queues:
+            if feedback_queue.full():
+                feedback_queue.get_nowait()
+
+            feedback_queue.put_nowait(None)
+
+        self.command_scheduler.clear()
+        self.command_tracker.cancel_all()
+        self.stop_recording()
+
+        for future in list(self.job_futures.values()):
+            if not future.done():
+                future.cancel()
+
+    async def stop(self):
+        print("\nShutting down motor...")
+
+        # A disable drops whatever is still queued before it, so it waits for the cancel and sleep to be answered
+        await asyncio.wait([asyncio.wrap_future(self.send_cancel_job()), asyncio.wrap_future(self.send_sleep_motor())], timeout=0.5)
+        self.send_disable_motor()
+        await asyncio.sleep(0.1)
+        await self.close()
+        print("Complete")
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def schedule_write(self, motor=None):
+        """
+        Description:
+            command_notifier, drains command_scheduler from the event loop once for any number of queued commands.
+        """
+        if self.write_scheduled or self.loop is None:
+            return
+
+        self.write_scheduled = True
+        self.loop.call_soon_threadsafe(self.write_queued_commands)
+
+    def write_queued_commands(self):
+        self.write_scheduled = False
+
+        if self.connected:
+            self.write_serial_messages()
+
+    async def check_deadlines_loop(self):
+        """
+        Description:
+            Resends or times out unanswered commands, polling only while a response is outstanding.
+        """
+        while self.running:
+            self.check_command_deadlines()
+            await asyncio.sleep(0.001 if self.command_tracker.pending_count else self.idle_wait_timeout)
+
+    def resolve_job_complete(self, job_complete_message):
+        future = self.job_futures.get(job_complete_message.job_id)
+
+        # A goto that finishes off target is followed by an adjustment job with the same id
+        if future is not None and self.at_commanded_position:
+            del self.job_futures[job_complete_message.job_id]
+
+            if not future.done():
+                future.set_result(job_complete_message)
+
+    def finish_job(self):
+        job_id = self.current_job_id
+        super().finish_job()
+
+        # In settle mode a goto can finish from the feedback stream, with no JOB_COMPLETE to resolve on
+        future = self.job_futures.pop(job_id, None)
+
+        if future is not None and not future.done():
+            future.set_result(JobCompleteMessage(job_id))
+
+    def resolve_job_cancelled(self, job_cancelled_message):
+        future = self.job_futures.pop(job_cancelled_message.job_id, None)
+
+        if future is not None and not future.done():
+            future.set_exception(JobCancelledError(f"Job {job_cancelled_message.job_id} cancelled"))
+
+    def publish_feedback(self, feedback_message):
+        for feedback_queue in self.feedback_queues:
+            if feedback_queue.full():
+                feedback_queue.get_nowait()
+
+            feedback_queue.put_nowait(feedback_message)
+
+    async def command(self, send, timeout: Union[float, None] = None):
+        """
+        Description:
+            Sends a command without payload and waits for the firmware's response, a NAK is returned rather
+            than raised. No response within the command_tracker deadline raises CommandTimeoutError.
+
+        Args:
+            send (callable): Function sending the command and returning its future e.g. send_enable_motor
+            timeout (float): Time to wait, the command_tracker deadline if None
+
+        Returns:
+            response: (ResponseMessage)
+        """
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(send()), timeout)
+
+        except MotorCommandError as error:
+            return error.response_message
+
+    async def enable_timestamps(self, enabled: bool = True, timeout: Union[float, None] = None):
+        """
+        Description:
+            Negotiates device timestamps, see Motor.enable_device_timestamps.
+
+        Returns:
+            enabled: (bool) the firmware is sending timestamps
+        """
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.enable_device_timestamps(enabled)), timeout)
+
+        except asyncio.TimeoutError:
+            self.device_timestamps_enabled = False
+            return False
+
+    async def batch_feedback(self, batch_size: int, interval_us: int = 0, timeout: Union[float, None] = None):
+        """
+        Description:
+            Sets the feedback batch size and interval, see Motor.set_feedback_batch.
+
+        Returns:
+            acknowledged: (bool) the firmware is sending feedback in batches of batch_size
+        """
+        return await asyncio.wait_for(asyncio.wrap_future(self.set_feedback_batch(batch_size, interval_us)), timeout)
+
+    async def enable(self):
+        return await self.command(self.send_enable_motor)
+
+    async def disable(self):
+        return await self.command(self.send_disable_motor)
+
+    async def wake(self):
+        return await self.command(self.send_wake_motor)
+
+    async def sleep(self):
+        return await self.command(self.send_sleep_motor)
+
+    async def pause(self):
+        return await self.command(self.send_pause_job)
+
+    async def resume(self):
+        return await self.command(self.send_resume_job)
+
+    async def cancel(self):
+        return await self.command(self.send_cancel_job)
+
+    async def run_job(self, send, job_id: int, wake: bool = True, timeout: Union[float, None] = None):
+        """
+        Description:
+            Sends a job and waits until the firmware reports it complete.
+            The wake command is pipelined in front of the job, so a sleeping motor costs no extra round trip.
+
+        Args:
+            send (callable): Function sending the job frame, e.g. a partial of send_motor_pulses
+            job_id (int): Job id used in the job frame
+            wake (bool): Send a wake command before the job
+            timeout (float): Time to wait for the job to complete, None waits forever
+
+        Returns:
+            job complete message: (JobCompleteMessage)
+        """
+        if wake:
+            self.send_wake_motor()
+
+        job_future = self.loop.create_future()
+        self.job_futures[job_id] = job_future
+        response_future = send()
+
+        if response_future == -1:
+            # Nothing to do e.g. rotor already at target
+            self.job_futures.pop(job_id, None)
+            return None
+
+        try:
+            await asyncio.wrap_future(response_future)
+
+        except Exception:
+            self.job_futures.pop(job_id, None)
+            raise
+
+        return await asyncio.wait_for(job_future, timeout)
+
+    async def run_pulses(self, pulses: int, direction: bool, job_id: Union[int, None] = None, **kwargs):
+        job_id = self.next_job_id() if job_id is None else job_id
+
+        return await self.run_job(lambda: self.send_motor_pulses(direction=direction, pulses=pulses, job_id=job_id, **kwargs),
+                                  job_id=job_id)
+
+    async def run_rotations(self,
+                            number_or_rotations: Union[float, int],
+                            rpm: Union[float, int],
+                            direction: bool,
+                            job_id: Union[int, None] = None,
+                            **kwargs):
+        job_id = self.next_job_id() if job_id is None else job_id
+
+        return await self.run_job(lambda: self.send_motor_rotations_at_set_rpm(number_or_rotations=number_or_rotations,
+                                                                               rpm=rpm,
+                                                                               direction=direction,
+                                                                               job_id=job_id,
+                                                                               **kwargs),
+                                  job_id=job_id)
+
+    async def goto(self,
+                   desired_position: float,
+                   rpm: Union[float, int],
+                   direction: bool = True,
+                   job_id: Union[int, None] = None,
+                   **kwargs):
+        job_id = self.next_job_id() if job_id is None else job_id
+
+        return await self.run_job(lambda: self.goto_rotor_position_radians(desired_position=desired_position,
+                                                                           direction=direction,
+                                                                           rpm=rpm,
+                                                                           job_id=job_id,
+                                                                           **kwargs),
+                                  job_id=job_id)
+
+    async def feedback(self, maxsize: int = 100):
+        """
+        Description:
+            Async iterator over feedback messages, the oldest messages are dropped if the consumer falls behind.
+            With feedback batching on the messages are FeedbackBatchMessages holding every sample of a frame.
+            Iteration ends when the motor is closed.
+        """
+        feedback_queue = asyncio.Queue(maxsize=maxsize)
+        self.feedback_queues.add(feedback_queue)
+
+        try:
+            while self.running:
+                feedback_message = await feedback_queue.get()
+
+                # Put by close()
+                if feedback_message is None:
+                    break
+
+                yield feedback_message
+
+        finally:
+            self.feedback_queues.discard(feedback_queue)
+
+
+async def main(header_file: Path):
+    async with AsyncMotor(definitions_filepath=header_file, serial_port='/dev/arduino_rp2040') as motor:
+        await motor.enable()
+
+        try:
+            while True:
+                await motor.run_rotations(number_or_rotations=1,
+                                          rpm=random.random() * 10,
+                                          direction=random.choice([True, False]))
+
+                await motor.goto(desired_position=random.choice([math.pi / 2, math.pi, 1.5 * math.pi]), rpm=10.0)
+                print(f"{motor.get_rotor_position()=:.3f} radians")
+
+        finally:
+            await motor.stop()
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+
+    try:
+        asyncio.run(main(project_dir / 'arduino/engineering-team-motor/definitions.h'))
+
+    except KeyboardInterrupt:
+        pass
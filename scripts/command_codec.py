@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Table driven encoder for the commands sent to the motor controller, built once from definitions.h
+"""
+
+import struct
+import operator
+from typing import Union
+
+
+class CommandCodec:
+    # Commands without a payload, sent as {STX, length, COMMAND, ETX}
+    static_command_names = ('PAUSE_JOB',
+                            'RESUME_JOB',
+                            'CANCEL_JOB',
+                            'ENABLE_MOTOR',
+                            'DISABLE_MOTOR',
+                            'SLEEP_MOTOR',
+                            'WAKE_MOTOR',
+                            'RESET_MOTOR',
+                            )
+
+    # Commands carrying one setting byte, {STX, length, COMMAND, value, ETX}
+    setting_command_names = ('SET_TIMESTAMPS',)
+
+    # Job commands, {STX, length, COMMAND, direction, microstep, job_id, fields..., ETX}
+    job_command_formats = (('SEND_JOB', '!6BIB', ('pulses',)),
+                           ('SEND_JOB_WITH_RAMPING', '!6B2IB', ('pulses', 'ramping_steps')),
+                           ('SEND_JOB_ALL_VARIABLES', '!6B3IB', ('pulses', 'pulse_interval', 'pulse_on_period')),
+                           ('SEND_JOB_ALL_VARIABLES_WITH_RAMPING', '!6B4IB', ('pulses', 'pulse_interval', 'pulse_on_period', 'ramping_steps')),
+                           ('SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE', '!6B4I2B', ('pulses', 'pulse_interval', 'pulse_on_period', 'ramping_steps', 'ramp_scaler')),
+                           )
+    job_field_order = ('pulses', 'pulse_interval', 'pulse_on_period', 'ramping_steps', 'ramp_scaler')
+
+    def __init__(self, definitions: dict):
+        """
+        Description:
+            Compiles one struct.Struct per command type, the frame length byte comes from the struct size so
+            it can not drift from the format. Commands without a payload are pre-encoded as immutable bytes.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+        """
+        self.STX = definitions['serial_settings']['STX']
+        self.ETX = definitions['serial_settings']['ETX']
+        self.command_dict = definitions['command_types']
+        self.minimum_pulse_interval_us = definitions['motor_settings']['MINIMUM_PULSE_INTERVAL']
+        self.microsteps = (1, 2, 4, 8, 16, 32)
+
+        self.static_frame_struct = struct.Struct('!4B')
+        self.static_frames = {}
+
+        for command_name in self.static_command_names:
+            if command_name in self.command_dict:
+                self.static_frames[command_name] = self.static_frame_struct.pack(self.STX,
+                                                                                 self.static_frame_struct.size,
+                                                                                 self.command_dict[command_name],
+                                                                                 self.ETX)
+
+        self.setting_frame_struct = struct.Struct('!5B')
+
+        # {STX, length, SET_FEEDBACK_BATCH, batch size, sample interval us, ETX}
+        self.feedback_batch_frame_struct = struct.Struct('!4BIB')
+
+        # Keyed by command byte, the field getters pick values out of
+        # (pulses, pulse_interval, pulse_on_period, ramping_steps, ramp_scaler)
+        self.job_structs = {}
+        self.job_headers = {}
+        self.job_fields = {}
+        self.job_buffers = {}
+        self.footer = (self.ETX,)
+
+        for command_name, job_format, job_fields in self.job_command_formats:
+            if command_name in self.command_dict:
+                command = self.command_dict[command_name]
+                self.job_structs[command] = struct.Struct(job_format)
+                self.job_headers[command] = (self.STX, self.job_structs[command].size, command)
+                self.job_fields[command] = self.field_getter(job_fields)
+                self.job_buffers[command] = bytearray(self.job_structs[command].size)
+
+        self.has_ramp_rate = 'SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE' in self.command_dict
+
+    def field_getter(self, job_fields: tuple):
+        indices = [self.job_field_order.index(field) for field in job_fields]
+
+        if len(indices) == 1:
+            index = indices[0]
+            return lambda job_variables: (job_variables[index],)
+
+        return operator.itemgetter(*indices)
+
+    def get_static_frame(self, command_name: str):
+        """
+        Description:
+            Returns the pre-encoded frame for a command without payload e.g. 'PAUSE_JOB'
+        """
+        return self.static_frames[command_name]
+
+    def has_command(self, command_name: str):
+        return command_name in self.command_dict
+
+    def encode_setting(self, command_name: str, value: int):
+        """
+        Description:
+            Encodes a command carrying one setting byte e.g. ('SET_TIMESTAMPS', 1).
+        """
+        return self.setting_frame_struct.pack(self.STX, self.setting_frame_struct.size, self.command_dict[command_name], value & 0xFF, self.ETX)
+
+    def encode_feedback_batch(self, batch_size: int, interval_us: int = 0):
+        """
+        Description:
+            Encodes SET_FEEDBACK_BATCH, an interval of 0 leaves the firmware's feedback interval unchanged.
+        """
+        return self.feedback_batch_frame_struct.pack(self.STX,
+                                                     self.feedback_batch_frame_struct.size,
+                                                     self.command_dict['SET_FEEDBACK_BATCH'],
+                                                     batch_size,
+                                                     interval_us,
+                                                     self.ETX)
+
+    def select_job_command(self,
+                           pulse_on_period: Union[int, None] = None,
+                           use_ramping: bool = False,
+                           ramp_scaler: Union[int, None] = None,
+                           ):
+        """
+        Description:
+            Picks the smallest job command able to carry the requested variables.
+
+        Returns:
+            command: (int) command byte
+        """
+        if pulse_on_period is None:
+            if not use_ramping:
+                return self.command_dict['SEND_JOB']
+            else:
+                return self.command_dict['SEND_JOB_WITH_RAMPING']
+        else:
+            if not use_ramping:
+                return self.command_dict['SEND_JOB_ALL_VARIABLES']
+            elif ramp_scaler is None or not self.has_ramp_rate:
+                return self.command_dict['SEND_JOB_ALL_VARIABLES_WITH_RAMPING']
+            else:
+                return self.command_dict['SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE']
+
+    def job_values(self,
+                   command: int,
+                   direction: bool,
+                   microstep: int,
+                   job_id: int,
+                   pulses: int,
+                   pulse_interval: int,
+                   pulse_on_period: Union[int, None],
+                   ramping_steps: int,
+                   ramp_scaler: Union[int, None],
+                   ):
+        """
+        Description:
+            Sanitises the job variables and orders them for the command's struct.
+
+        Returns:
+            values: (tuple) every value packed into the frame
+        """
+        return (self.job_headers[command]
+                + (1 if direction else 0, microstep if microstep in self.microsteps else 1, job_id)
+                + self.job_fields[command]((pulses,
+                                            pulse_interval if pulse_interval > self.minimum_pulse_interval_us else self.minimum_pulse_interval_us,
+                                            pulse_on_period,
+                                            ramping_steps,
+                                            ramp_scaler))
+                + self.footer)
+
+    def encode_job(self,
+                   command: int,
+                   direction: bool,
+                   microstep: int = 1,
+                   job_id: int = 0,
+                   pulses: int = 0,
+                   pulse_interval: int = 1000,
+                   pulse_on_period: Union[int, None] = None,
+                   ramping_steps: int = 0,
+                   ramp_scaler: Union[int, None] = None,
+                   ):
+        """
+        Description:
+            Encodes a job frame as immutable bytes, suitable for handing to a send queue.
+
+        Returns:
+            frame: (bytes)
+        """
+        return self.job_structs[command].pack(*self.job_values(command, direction, microstep, job_id, pulses,
+                                                               pulse_interval, pulse_on_period, ramping_steps, ramp_scaler))
+
+    def pack_job_into(self,
+                      buffer: Union[bytearray, memoryview, None],
+                      offset: int,
+                      command: int,
+                      direction: bool,
+                      microstep: int = 1,
+                      job_id: int = 0,
+                      pulses: int = 0,
+                      pulse_interval: int = 1000,
+                      pulse_on_period: Union[int, None] = None,
+                      ramping_steps: int = 0,
+                      ramp_scaler: Union[int, None] = None,
+                      ):
+        """
+        Description:
+            Packs a job frame into a caller owned buffer without allocating a new bytes object.
+            If buffer is None the codec's reusable buffer for this command is used and returned.
+
+        Returns:
+            buffer: (bytearray) buffer the frame was written to
+            frame length: (int) number of bytes written
+        """
+        job_struct = self.job_structs[command]
+
+        if buffer is None:
+            buffer = self.job_buffers[command]
+            offset = 0
+
+        job_struct.pack_into(buffer, offset, *self.job_values(command, direction, microstep, job_id, pulses,
+                                                              pulse_interval, pulse_on_period, ramping_steps, ramp_scaler))
+
+        return buffer, job_struct.size
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Queue for encoded command frames waiting to be written to the motor controller, frames keep their send
+    order, stops drop what is queued before them and repeated commands are merged
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Union
+
+SAFETY_STOP = 0
+CANCEL = 1
+CONTROL = 2
+JOB = 3
+
+QUEUED = 'queued'
+COALESCED = 'coalesced'
+REJECTED = 'rejected'
+
+
+class CommandQueueFullError(Exception):
+    def __init__(self, command: int, priority: int):
+        super().__init__(f"Command 0x{command:02X} rejected, priority {priority} queue is full")
+        self.command = command
+        self.priority = priority
+
+    def __reduce__(self):
+        return self.__class__, (self.command, self.priority)
+
+
+class CommandPreemptedError(Exception):
+    def __init__(self, command: int, preempted_by: int):
+        super().__init__(f"Command 0x{command:02X} dropped before sending by command 0x{preempted_by:02X}")
+        self.command = command
+        self.preempted_by = preempted_by
+
+    def __reduce__(self):
+        return self.__class__, (self.command, self.preempted_by)
+
+
+class CommandScheduler:
+    def __init__(self, definitions: dict, capacities: tuple = (64, 64, 32, 20)):
+        """
+        Description:
+            One FIFO of frames waiting to be written, drain() hands them to the writer in the order they were
+            submitted so a sequence such as enable, wake, disable or job, pause reaches the firmware as sent.
+            Each frame is counted against its priority class: safety stop (DISABLE_MOTOR, RESET_MOTOR) >
+            cancel / pause > control > jobs, a full class rejects the frame and never blocks the others.
+            A safety stop drops every frame queued before it and CANCEL_JOB drops the job frames queued before it,
+            they would only run once the motor was stopped. A command without payload that is identical to the
+            last frame waiting is merged with it and shares its future.
+            submit() never blocks.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            capacities (tuple): Frames of each class that can wait, safety stop first
+        """
+        command_types = definitions['command_types']
+        class_names = ((SAFETY_STOP, ('DISABLE_MOTOR', 'RESET_MOTOR')),
+                       (CANCEL, ('CANCEL_JOB', 'PAUSE_JOB')),
+                       )
+
+        self.priorities = {}
+
+        for name, command in command_types.items():
+            self.priorities[command] = JOB if name.startswith('SEND_JOB') else CONTROL
+
+        for priority, names in class_names:
+            for name in names:
+                if name in command_types:
+                    self.priorities[command_types[name]] = priority
+
+        self.safety_stop_commands = {command for command, priority in self.priorities.items() if priority == SAFETY_STOP}
+        self.job_command_types = {command for command, priority in self.priorities.items() if priority == JOB}
+        self.cancel_commands = {command_types[name] for name in ('CANCEL_JOB',) if name in command_types}
+
+        self.capacities = capacities
+        self.queue = deque()
+        self.class_counts = [0] * len(capacities)
+        self.pending_count = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+        # Statistics
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.preempted = 0
+        self.high_water = 0
+
+        # Time from submit to drain is recorded here when set, see MotorMetrics
+        self.dwell_histogram = None
+
+    def __len__(self):
+        return self.pending_count
+
+    def submit(self, frame: bytes, future: Future, priority: Union[int, None] = None):
+        """
+        Description:
+            Queues an encoded frame, safe to call from any thread.
+
+        Args:
+            frame (bytes): Encoded command frame
+            future (Future): Future completed by the command's response
+            priority (int): Class the frame is counted against, from the command byte if None
+
+        Returns:
+            status: (str) QUEUED, COALESCED or REJECTED
+            future: (Future) future to wait on, the already queued one when coalesced. A rejected frame's future
+                    holds CommandQueueFullError
+        """
+        command = frame[2]
+        priority = self.priorities.get(command, CONTROL) if priority is None else priority
+        preempted = []
+
+        with self.lock:
+            self.submitted += 1
+
+            if command not in self.job_command_types and self.queue and self.queue[-1][0] == frame:
+                self.coalesced += 1
+                return COALESCED, self.queue[-1][1]
+
+            if self.class_counts[priority] >= self.capacities[priority]:
+                self.rejected += 1
+                rejected = True
+
+            else:
+                rejected = False
+
+                if command in self.safety_stop_commands:
+                    preempted = list(self.queue)
+                    self.queue.clear()
+
+                elif command in self.cancel_commands:
+                    preempted = [entry for entry in self.queue if entry[3] == JOB]
+
+                    if preempted:
+                        self.queue = deque(entry for entry in self.queue if entry[3] != JOB)
+
+                for entry in preempted:
+                    self.class_counts[entry[3]] -= 1
+
+                self.pending_count -= len(preempted)
+                self.preempted += len(preempted)
+
+                self.queue.append((frame, future, time.perf_counter_ns(), priority))
+                self.class_counts[priority] += 1
+                self.pending_count += 1
+
+                if self.pending_count > self.high_water:
+                    self.high_water = self.pending_count
+
+                self.ready.set()
+
+        for preempted_frame, preempted_future, _, _ in preempted:
+            if not preempted_future.done():
+                preempted_future.set_exception(CommandPreemptedError(preempted_frame[2], command))
+
+        if rejected:
+            if not future.done():
+                future.set_exception(CommandQueueFullError(command, priority))
+
+            return REJECTED, future
+
+        return QUEUED, future
+
+    def drain(self):
+        """
+        Description:
+            Takes every waiting frame.
+
+        Returns:
+            frames: (list) encoded frames in the order they were submitted
+        """
+        if self.pending_count == 0:
+            return []
+
+        with self.lock:
+            entries = list(self.queue)
+            self.queue.clear()
+            self.class_counts = [0] * len(self.capacities)
+            self.pending_count = 0
+            self.ready.clear()
+
+        dwell_histogram = self.dwell_histogram
+
+        if dwell_histogram is not None:
+            now = time.perf_counter_ns()
+
+            for _, _, submitted, _ in entries:
+                dwell_histogram.record(now - submitted)
+
+        return [entry[0] for entry in entries]
+
+    def wait(self, timeout: float):
+        """
+        Description:
+            Blocks until a frame is submitted or the timeout passes.
+        """
+        return self.ready.wait(timeout)
+
+    def clear(self):
+        with self.lock:
+            for _, future, _, _ in self.queue:
+                future.cancel()
+
+            self.queue.clear()
+            self.class_counts = [0] * len(self.capacities)
+            self.pending_count = 0
+            self.ready.clear()
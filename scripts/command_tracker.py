@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Table of commands waiting on a RESPONSE message, each command gets a concurrent.futures.Future
+    that resolves on the matching response, fails on a NAK or times out after its retries are used up
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Union
+
+
+class MotorCommandError(Exception):
+    def __init__(self, response_message, response_name: str):
+        super().__init__(f"Command 0x{response_message.command:02X} rejected: {response_name}")
+        self.response_message = response_message
+        self.response_name = response_name
+
+    def __reduce__(self):
+        return self.__class__, (self.response_message, self.response_name)
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class CommandTimeoutError(TimeoutError):
+    def __init__(self, command: int, job_id: Union[int, None], attempts: int):
+        super().__init__(f"No response to command 0x{command:02X} after {attempts} attempt(s)")
+        self.command = command
+        self.job_id = job_id
+        self.attempts = attempts
+
+    def __reduce__(self):
+        return self.__class__, (self.command, self.job_id, self.attempts)
+
+
+class PendingCommand:
+    __slots__ = ('command', 'job_id', 'frame', 'future', 'timeout', 'deadline', 'retries', 'attempts', 'tracked_ns')
+
+    def __init__(self, command: int, job_id: Union[int, None], frame: bytes, timeout: float, retries: int):
+        self.command = command
+        self.job_id = job_id
+        self.frame = frame
+        self.future = Future()
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.retries = retries
+        self.attempts = 1
+        self.tracked_ns = time.perf_counter_ns()
+
+
+class CommandTracker:
+    def __init__(self, definitions: dict, timeout: float = 1.0, retries: int = 0):
+        """
+        Description:
+            Pending commands are keyed by (command byte, job id). The firmware only echoes a meaningful job id
+            for job commands, every other command is keyed with job id None and matched oldest first.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            timeout (float): Default time to wait for a response, in seconds
+            retries (int): Default number of times a command is resent before its future times out
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.response_names = {value: key for key, value in definitions['response_types'].items()}
+        self.job_command_types = {value for key, value in definitions['command_types'].items() if key.startswith('SEND_JOB')}
+
+        self.pending = {}
+        self.pending_count = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.acknowledged = 0
+        self.rejected = 0
+        self.unmatched = 0
+        self.resent = 0
+        self.timed_out = 0
+
+        # Time from track to response is recorded here when set, see MotorMetrics
+        self.ack_histogram = None
+
+    def key(self, command: int, job_id: Union[int, None]):
+        return command, job_id if command in self.job_command_types else None
+
+    def track(self, frame: bytes, timeout: Union[float, None] = None, retries: Union[int, None] = None):
+        """
+        Description:
+            Adds a pending entry for an encoded command frame {STX, length, COMMAND, [direction, microstep, job_id, ...], ETX}.
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to the ResponseMessage
+        """
+        command = frame[2]
+        job_id = frame[5] if command in self.job_command_types else None
+
+        pending_command = PendingCommand(command=command,
+                                         job_id=job_id,
+                                         frame=frame,
+                                         timeout=self.timeout if timeout is None else timeout,
+                                         retries=self.retries if retries is None else retries)
+
+        with self.lock:
+            self.pending.setdefault(self.key(command, job_id), deque()).append(pending_command)
+            self.pending_count += 1
+
+        return pending_command.future
+
+    def resolve(self, response_message):
+        """
+        Description:
+            Completes the oldest pending command matching a response. ACK sets the ResponseMessage as the result,
+            NAK sets a MotorCommandError carrying the response_types name e.g. MOTOR_BUSY_RESPONSE.
+
+        Returns:
+            matched: (bool) a pending command was found
+        """
+        key = self.key(response_message.command, response_message.job_id)
+
+        with self.lock:
+            pending_commands = self.pending.get(key)
+            pending_command = None
+
+            # Futures already done were cancelled, coalesced or dropped before they were sent
+            while pending_commands and pending_command is None:
+                pending_command = pending_commands.popleft()
+                self.pending_count -= 1
+
+                if pending_command.future.done():
+                    pending_command = None
+
+            if pending_commands is not None and not pending_commands:
+                del self.pending[key]
+
+            if pending_command is None:
+                self.unmatched += 1
+                return False
+
+            if response_message.acknowledged:
+                self.acknowledged += 1
+            else:
+                self.rejected += 1
+
+        ack_histogram = self.ack_histogram
+
+        if ack_histogram is not None:
+            ack_histogram.record(time.perf_counter_ns() - pending_command.tracked_ns)
+
+        if pending_command.future.set_running_or_notify_cancel():
+            if response_message.acknowledged:
+                pending_command.future.set_result(response_message)
+            else:
+                pending_command.future.set_exception(MotorCommandError(response_message, self.response_name(response_message.response)))
+
+        return True
+
+    def response_name(self, response: int):
+        return self.response_names.get(response, f"0x{response:02X}")
+
+    def check_deadlines(self, resend, now: Union[float, None] = None):
+        """
+        Description:
+            Resends commands past their deadline while they have retries left, times out the rest.
+            Called from whichever loop owns the serial port, it returns straight away when nothing is pending.
+
+        Args:
+            resend (callable): Function writing a frame without tracking it again
+            now (float): time.monotonic() value, read here if not given
+        """
+        if self.pending_count == 0:
+            return
+
+        now = time.monotonic() if now is None else now
+        expired = []
+        resent = []
+
+        with self.lock:
+            for key in list(self.pending):
+                pending_commands = self.pending[key]
+
+                for pending_command in list(pending_commands):
+                    if pending_command.future.done():
+                        pending_commands.remove(pending_command)
+                        self.pending_count -= 1
+
+                    elif pending_command.deadline <= now:
+                        if pending_command.retries > 0:
+                            pending_command.retries -= 1
+                            pending_command.attempts += 1
+                            pending_command.deadline = now + pending_command.timeout
+                            resent.append(pending_command.frame)
+
+                        else:
+                            pending_commands.remove(pending_command)
+                            self.pending_count -= 1
+                            expired.append(pending_command)
+
+                if not pending_commands:
+                    del self.pending[key]
+
+            self.resent += len(resent)
+            self.timed_out += len(expired)
+
+        # Timed out first, so a resend that raises can't leave their futures unresolved
+        for pending_command in expired:
+            if pending_command.future.set_running_or_notify_cancel():
+                pending_command.future.set_exception(CommandTimeoutError(pending_command.command,
+                                                                         pending_command.job_id,
+                                                                         pending_command.attempts))
+
+        for frame in resent:
+            resend(frame)
+
+    def get_statistics(self):
+        return {"responses_acknowledged": self.acknowledged,
+                "responses_rejected": self.rejected,
+                "responses_unmatched": self.unmatched,
+                "commands_resent": self.resent,
+                "commands_timed_out": self.timed_out,
+                }
+
+    def cancel_all(self):
+        """
+        Description:
+            Cancels every pending future, used when the port is closed.
+        """
+        with self.lock:
+            pending_commands = [pending_command for pending in self.pending.values() for pending_command in pending]
+            self.pending = {}
+            self.pending_count = 0
+
+        for pending_command in pending_commands:
+            pending_command.future.cancel()
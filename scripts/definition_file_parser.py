@@ -46,6 +46,35 @@ def parse_definitions_file(definitions_filepath: Path):
     return def_dict
 
 
+def parse_header_defines(header_filepath: Path):
+    """
+    Description:
+        Reads every "#define NAME value" line with an integer value from a C header, e.g. a firmware library header.
+        Lines with other values (pin names, expressions) are skipped.
+
+    Args:
+        header_filepath (Path): Path to the header file
+
+    Returns:
+        defines: (dict) define name -> int value
+    """
+    defines = {}
+
+    if not header_filepath.is_file():
+        raise Exception("Filepath is not a file")
+
+    with open(header_filepath, "r") as header_file:
+        for line in [lines.split() for lines in header_file.read().splitlines() if len(lines.split()) > 0]:
+            if line[0] == '#define' and len(line) == 3:
+                try:
+                    defines[line[1]] = int(line[2], 0)
+
+                except ValueError:
+                    pass
+
+    return defines
+
+
 if __name__ == "__main__":
     project_dir = Path(__file__).resolve().parents[1]
     header_file = project_dir / 'arduino/engineering-team-motor/definitions.h'
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Maps the firmware micros() carried by timestamped feedback onto the host time.monotonic() clock, estimating
+    the offset and drift between the two and the jitter of the arrival times
+"""
+
+import numpy as np
+
+MICROS_MASK = 0xFFFFFFFF
+MICROS_HALF_RANGE = 1 << 31
+
+
+class DeviceClock:
+    def __init__(self,
+                 nominal_interval_us: int = 10000,
+                 window_length: int = 2048,
+                 segments: int = 16,
+                 refit_interval: int = 64,
+                 resync_threshold: float = 0.5,
+                 ):
+        """
+        Description:
+            A frame can only arrive after it was sampled, so arrival - device time is the clock offset plus a
+            transport delay that is never negative. The offset is taken from the lower envelope of that difference:
+            every refit_interval samples a line is fitted through the smallest difference in each of segments
+            slices of the window, its slope is the drift and it is lowered until no sample lies under it.
+            Between refits a sample arriving under the line moves it down straight away.
+            The smallest transport delay can't be told apart from the offset with one way timestamps, mapped times
+            are late by that constant (the USB latency floor, about 100 - 200 us) but carry none of the jitter.
+            micros() wraps every 71.6 minutes, it is unwrapped against the previous sample. Device time going
+            backwards, or a sample arriving more than resync_threshold before the model says it was taken,
+            means the controller restarted and the estimate starts again.
+
+        Args:
+            nominal_interval_us (int): MOTOR_FEEDBACK_INTERVAL_US, interval jitter is measured against it
+            window_length (int): Samples the fit and the statistics are taken over
+            segments (int): Slices of the window contributing one envelope point each
+            refit_interval (int): Samples between fits
+            resync_threshold (float): Seconds a sample may arrive early before the estimate is restarted
+        """
+        self.nominal_interval_us = nominal_interval_us
+        self.window_length = window_length
+        self.segments = segments
+        self.refit_interval = refit_interval
+        self.resync_threshold = resync_threshold
+
+        self.device_seconds = np.zeros(window_length, dtype=np.float64)
+        self.offsets = np.zeros(window_length, dtype=np.float64)
+        self.arrival_times = np.zeros(window_length, dtype=np.float64)
+
+        self.wraps = 0
+        self.resets = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Description:
+            Forgets every sample, the next one starts a new estimate.
+        """
+        self.origin_micros = None
+        self.last_raw_micros = 0
+        self.unwrapped_micros = 0
+        self.sample_count = 0
+        self.window_count = 0
+        self.intercept = 0.0
+        self.drift = 0.0
+
+    def unwrap(self, raw_micros: int):
+        """
+        Description:
+            Unwrapped micros for a raw 32 bit value close to the last sample, either side of it.
+        """
+        delta = ((raw_micros - self.last_raw_micros + MICROS_HALF_RANGE) & MICROS_MASK) - MICROS_HALF_RANGE
+        return self.unwrapped_micros + delta
+
+    def update(self, raw_micros: int, arrival_time: float):
+        """
+        Description:
+            Adds a sample, called with every timestamped feedback message in arrival order.
+
+        Args:
+            raw_micros (int): Firmware micros() of the sample
+            arrival_time (float): time.monotonic() when the frame was read
+
+        Returns:
+            sample time: (float) when the sample was taken, on the time.monotonic() clock
+        """
+        if self.origin_micros is not None:
+            unwrapped_micros = self.unwrap(raw_micros)
+
+            if unwrapped_micros < self.unwrapped_micros:
+                self.resets += 1
+                self.reset()
+
+            else:
+                if raw_micros < self.last_raw_micros:
+                    self.wraps += 1
+
+                device_seconds = (unwrapped_micros - self.origin_micros) * 1e-6
+
+                if arrival_time - device_seconds - (self.intercept + device_seconds * self.drift) < -self.resync_threshold:
+                    self.resets += 1
+                    self.reset()
+
+        if self.origin_micros is None:
+            self.origin_micros = raw_micros
+            unwrapped_micros = raw_micros
+            device_seconds = 0.0
+            self.intercept = arrival_time
+
+        offset = arrival_time - device_seconds
+        residual = offset - (self.intercept + device_seconds * self.drift)
+
+        # A frame can't arrive before it was sent, the envelope comes down to it
+        if residual < 0.0:
+            self.intercept += residual
+
+        index = self.window_count % self.window_length
+        self.device_seconds[index] = device_seconds
+        self.offsets[index] = offset
+        self.arrival_times[index] = arrival_time
+        self.window_count += 1
+
+        self.last_raw_micros = raw_micros
+        self.unwrapped_micros = unwrapped_micros
+        self.sample_count += 1
+
+        if self.window_count % self.refit_interval == 0 and self.window_count >= 2 * self.segments:
+            self.refit()
+
+        return device_seconds + self.intercept + device_seconds * self.drift
+
+    def update_batch(self, raw_micros: np.ndarray, arrival_time: float):
+        """
+        Description:
+            Adds the samples of one batched feedback frame, all read at arrival_time, in one vectorised step.
+            Equivalent to update for each sample except that the envelope is lowered and refitted once per batch.
+            A batch going backwards or arriving early enough to resync goes through update one sample at a time.
+
+        Args:
+            raw_micros (np.ndarray): Firmware micros() of the samples, oldest first
+            arrival_time (float): time.monotonic() when the frame was read
+
+        Returns:
+            sample times: (np.ndarray) when each sample was taken, on the time.monotonic() clock
+        """
+        batch_length = len(raw_micros)
+
+        if batch_length == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        if self.origin_micros is None or batch_length > self.window_length:
+            return np.array([self.update(int(raw), arrival_time) for raw in raw_micros.tolist()])
+
+        # Micros since the last sample, a batch spans far less than half the 32 bit range
+        steps = (raw_micros.astype(np.int64) - self.last_raw_micros) & MICROS_MASK
+        last_step = int(steps[-1])
+
+        if last_step >= MICROS_HALF_RANGE or (batch_length > 1 and (steps[1:] < steps[:-1]).any()):
+            return np.array([self.update(int(raw), arrival_time) for raw in raw_micros.tolist()])
+
+        device_seconds = (steps + (self.unwrapped_micros - self.origin_micros)) * 1e-6
+        offsets = arrival_time - device_seconds
+
+        # Every sample arrived together, the newest one waited least and is lowest against the envelope
+        lowest_residual = arrival_time - self.intercept - float(device_seconds[-1]) * (1.0 + self.drift)
+
+        if lowest_residual < -self.resync_threshold:
+            return np.array([self.update(int(raw), arrival_time) for raw in raw_micros.tolist()])
+
+        # A frame can't arrive before it was sent, the envelope comes down to it
+        if lowest_residual < 0.0:
+            self.intercept += lowest_residual
+
+        self.wraps += (self.last_raw_micros + last_step) >> 32
+        self.store_window(device_seconds, offsets, arrival_time)
+
+        self.last_raw_micros = (self.last_raw_micros + last_step) & MICROS_MASK
+        self.unwrapped_micros += last_step
+        self.sample_count += batch_length
+
+        if self.window_count % self.refit_interval < batch_length and self.window_count >= 2 * self.segments:
+            self.refit()
+
+        return device_seconds * (1.0 + self.drift) + self.intercept
+
+    def store_window(self, device_seconds: np.ndarray, offsets: np.ndarray, arrival_time: float):
+        batch_length = len(device_seconds)
+        start = self.window_count % self.window_length
+
+        if start + batch_length <= self.window_length:
+            indices = slice(start, start + batch_length)
+        else:
+            indices = (start + np.arange(batch_length)) % self.window_length
+
+        self.device_seconds[indices] = device_seconds
+        self.offsets[indices] = offsets
+        self.arrival_times[indices] = arrival_time
+        self.window_count += batch_length
+
+    def window(self):
+        """
+        Returns:
+            device seconds, offsets, arrival times: (np.ndarray) the samples in the window, oldest first
+        """
+        count = min(self.window_count, self.window_length)
+        order = (self.window_count - count + np.arange(count)) % self.window_length
+        return self.device_seconds[order], self.offsets[order], self.arrival_times[order]
+
+    def refit(self):
+        device_seconds, offsets, _ = self.window()
+
+        if len(device_seconds) < 2 * self.segments or device_seconds[-1] - device_seconds[0] <= 0.0:
+            return
+
+        envelope_device = []
+        envelope_offsets = []
+
+        for indices in np.array_split(np.arange(len(device_seconds)), self.segments):
+            minimum_index = indices[np.argmin(offsets[indices])]
+            envelope_device.append(device_seconds[minimum_index])
+            envelope_offsets.append(offsets[minimum_index])
+
+        drift, intercept = np.polyfit(envelope_device, envelope_offsets, 1)
+        intercept += np.min(offsets - (intercept + device_seconds * drift))
+
+        self.drift = float(drift)
+        self.intercept = float(intercept)
+
+    def to_host_time(self, raw_micros: int):
+        """
+        Description:
+            Host time.monotonic() of any firmware micros() near the latest sample, e.g. a status message's.
+
+        Returns:
+            host time: (float) None before the first sample
+        """
+        if self.origin_micros is None:
+            return None
+
+        device_seconds = (self.unwrap(raw_micros) - self.origin_micros) * 1e-6
+        return device_seconds + self.intercept + device_seconds * self.drift
+
+    def get_statistics(self):
+        """
+        Description:
+            Offset and drift of the device clock and the jitter of the samples in the window. latency_us is how
+            far each arrival was behind the fastest one, device_interval_us the spacing of the firmware's samples
+            and arrival_interval_us the spacing the host saw, both against nominal_interval_us.
+
+        Returns:
+            statistics: (dict)
+        """
+        device_seconds, offsets, arrival_times = self.window()
+        last_device_seconds = float(device_seconds[-1]) if len(device_seconds) else 0.0
+
+        statistics = {'samples': self.sample_count,
+                      'wraps': self.wraps,
+                      'resets': self.resets,
+                      'offset': self.intercept + last_device_seconds * self.drift,
+                      'drift_ppm': self.drift * 1e6,
+                      }
+
+        if len(device_seconds) < 2:
+            return statistics
+
+        latencies = (offsets - (self.intercept + device_seconds * self.drift)) * 1e6
+        statistics['latency_us'] = {'mean': float(latencies.mean()),
+                                    'std': float(latencies.std()),
+                                    'p99': float(np.percentile(latencies, 99)),
+                                    'max': float(latencies.max()),
+                                    }
+
+        for name, intervals in (('device_interval_us', np.diff(device_seconds) * 1e6),
+                                ('arrival_interval_us', np.diff(arrival_times) * 1e6)):
+            errors = intervals - self.nominal_interval_us
+            statistics[name] = {'mean': float(intervals.mean()),
+                                'jitter': float(intervals.std()),
+                                'max_error': float(np.abs(errors).max()),
+                                }
+
+        statistics['missed_intervals'] = int(np.count_nonzero(np.diff(device_seconds) * 1e6 > 1.5 * self.nominal_interval_us))
+        return statistics
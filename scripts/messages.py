@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Decoded message types received from the motor controller and a dispatch table keyed by message id
+"""
+
+import struct
+import numpy as np
+from typing import Union
+
+# One sample of a MOTOR_FEEDBACK_BATCH message, {micros, velocity_radians, angle_count}
+feedback_batch_dtype = np.dtype([('device_micros', '<u4'),
+                                 ('velocity', '<f4'),
+                                 ('encoder_count', '<i4'),
+                                 ])
+
+
+class StatusBits:
+    __slots__ = ('direction', 'fault', 'paused', 'using_ramping', 'enabled', 'running', 'sleeping')
+
+    def __init__(self, definitions: dict):
+        """
+        Description:
+            Bit masks for the status byte, taken from definitions.h status_message_bits
+        """
+        status_bits = definitions['status_message_bits']
+        self.direction = 1 << status_bits['STATUS_DIRECTION_BIT']
+        self.fault = 1 << status_bits['STATUS_FAULT_BIT']
+        self.paused = 1 << status_bits['STATUS_PAUSED_BIT']
+        self.using_ramping = 1 << status_bits['STATUS_RAMPING_BIT']
+        self.enabled = 1 << status_bits['STATUS_ENABLED_BIT']
+        self.running = 1 << status_bits['STATUS_RUNNING_BIT']
+        self.sleeping = 1 << status_bits['STATUS_SLEEP_BIT']
+
+
+class StatusMessage:
+    __slots__ = ('status_byte', 'job_id', 'microstep', 'pulses_remaining', 'status_bits', 'device_micros')
+
+    def __init__(self, status_byte: int, job_id: int, microstep: int, pulses_remaining: int, status_bits: StatusBits, device_micros: Union[int, None] = None):
+        """
+        Description:
+            Status is kept as the raw status byte, flags are only decoded when they are read.
+            device_micros is the firmware micros() of the status, None unless timestamps were enabled.
+        """
+        self.status_byte = status_byte
+        self.job_id = job_id
+        self.microstep = microstep
+        self.pulses_remaining = pulses_remaining
+        self.status_bits = status_bits
+        self.device_micros = device_micros
+
+    @property
+    def direction(self):
+        return (self.status_byte & self.status_bits.direction) > 0
+
+    @property
+    def fault(self):
+        return (self.status_byte & self.status_bits.fault) > 0
+
+    @property
+    def paused(self):
+        return (self.status_byte & self.status_bits.paused) > 0
+
+    @property
+    def using_ramping(self):
+        return (self.status_byte & self.status_bits.using_ramping) > 0
+
+    @property
+    def enabled(self):
+        return (self.status_byte & self.status_bits.enabled) > 0
+
+    @property
+    def running(self):
+        return (self.status_byte & self.status_bits.running) > 0
+
+    @property
+    def sleeping(self):
+        return (self.status_byte & self.status_bits.sleeping) > 0
+
+    def as_dict(self):
+        return {"job_id": self.job_id,
+                "status": {
+                    "direction": self.direction,
+                    "fault": self.fault,
+                    "paused": self.paused,
+                    "using_ramping": self.using_ramping,
+                    "enabled": self.enabled,
+                    "running": self.running,
+                    "sleeping": self.sleeping,
+                },
+                "microstep": self.microstep,
+                "pulses_remaining": self.pulses_remaining
+                }
+
+    def __repr__(self):
+        return f"StatusMessage(status_byte=0x{self.status_byte:02X}, job_id={self.job_id}, microstep={self.microstep}, pulses_remaining={self.pulses_remaining})"
+
+
+class FeedbackMessage:
+    __slots__ = ('velocity', 'position', 'encoder_count', 'device_micros')
+
+    def __init__(self, velocity: float, position: float, encoder_count: int, device_micros: Union[int, None] = None):
+        self.velocity = velocity
+        self.position = position
+        self.encoder_count = encoder_count
+        self.device_micros = device_micros
+
+    def __repr__(self):
+        return f"FeedbackMessage(velocity={self.velocity:.3f}, position={self.position:.3f}, encoder_count={self.encoder_count})"
+
+
+class FeedbackBatchMessage:
+    __slots__ = ('samples',)
+
+    def __init__(self, samples: np.ndarray):
+        """
+        Description:
+            Consecutive feedback samples sent in one frame after SET_FEEDBACK_BATCH, oldest first.
+            samples is a feedback_batch_dtype array owning its memory, the frame buffer is reused.
+        """
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return f"FeedbackBatchMessage(samples={len(self.samples)})"
+
+
+class FaultMessage:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "FaultMessage()"
+
+
+class ResponseMessage:
+    __slots__ = ('command', 'job_id', 'response', 'acknowledged')
+
+    def __init__(self, command: int, job_id: int, response: int, acknowledged: bool):
+        self.command = command
+        self.job_id = job_id
+        self.response = response
+        self.acknowledged = acknowledged
+
+    def __repr__(self):
+        return f"ResponseMessage(command=0x{self.command:02X}, job_id={self.job_id}, response=0x{self.response:02X}, acknowledged={self.acknowledged})"
+
+
+class JobCompleteMessage:
+    __slots__ = ('job_id',)
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def __repr__(self):
+        return f"JobCompleteMessage(job_id={self.job_id})"
+
+
+class JobCancelledMessage:
+    __slots__ = ('job_id',)
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def __repr__(self):
+        return f"JobCancelledMessage(job_id={self.job_id})"
+
+
+class MessageDispatcher:
+    def __init__(self, definitions: dict):
+        """
+        Description:
+            Dispatch table keyed by the message ids in definitions.h message_types.
+            Each entry holds a decoder working on the message buffer (message contents followed by ETX)
+            and the list of handlers called with every decoded message.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+        """
+        message_types = definitions['message_types']
+        self.ACK = definitions['serial_settings']['ACK']
+        self.status_bits = StatusBits(definitions)
+
+        # Incoming messages don't include header or footer bytes
+        self.motor_status_message_struct = struct.Struct('<4BLB')  # {MOTOR_STATUS_MESSAGE_ID, motor.status_byte, motor.status_variables.job_id, motor.status_variables.microstep, motor.status_variables.pulses_remaining, ETX}
+        self.motor_feedback_message_struct = struct.Struct('<B2fiB')  # {MOTOR_FEEDBACK_MESSAGE_ID, motor.encoder_status.velocity_radians, motor.encoder.angle_radians, motor.encoder_status.angle_count, ETX}
+        self.short_motor_feedback_message_struct = struct.Struct('<B2fhB')  # Firmware with MOTOR_FEEDBACK_MESSAGE_LENGTH 11 only sends the low 2 bytes of angle_count
+        self.timestamped_motor_status_message_struct = struct.Struct('<4BLLB')  # Status followed by the firmware micros() after SET_TIMESTAMPS
+        self.timestamped_motor_feedback_message_struct = struct.Struct('<B2fiLB')  # Feedback followed by the firmware micros() after SET_TIMESTAMPS
+        self.response_message_struct = struct.Struct('<6B')  # {RESPONSE_MESSAGE_ID, COMMAND, JOB_ID, RESPONSE, [ACK or NAK], ETX};
+        self.job_message_struct = struct.Struct('<3B')  # {JOB_COMPLETE_MESSAGE_ID or JOB_CANCELLED_MESSAGE_ID, motor.status_variables.job_id, ETX}
+
+        self.decoders = {}
+        self.handlers = {}
+
+        decoders = {'MOTOR_STATUS_MESSAGE_ID': self.decode_status_message,
+                    'MOTOR_FEEDBACK_MESSAGE_ID': self.decode_feedback_message,
+                    'MOTOR_FEEDBACK_BATCH_MESSAGE_ID': self.decode_feedback_batch_message,
+                    'MOTOR_FAULT_MESSAGE_ID': self.decode_fault_message,
+                    'RESPONSE_MESSAGE_ID': self.decode_response_message,
+                    'JOB_COMPLETE_MESSAGE_ID': self.decode_job_complete_message,
+                    'JOB_CANCELLED_MESSAGE_ID': self.decode_job_cancelled_message,
+                    }
+
+        for message_name, decoder in decoders.items():
+            if message_name in message_types:
+                self.register_decoder(message_types[message_name], decoder)
+
+    def register_decoder(self, message_id: int, decoder):
+        """
+        Description:
+            Adds or replaces the decoder for a message id, decoder(buffer) returns the decoded message
+        """
+        self.decoders[message_id] = decoder
+        self.handlers.setdefault(message_id, ())
+
+    def register_handler(self, message_id: int, handler):
+        """
+        Description:
+            Adds a handler called as handler(message) for every decoded message with this id.
+            Handler tuples are replaced rather than modified so dispatch never sees a list change under it.
+        """
+        if message_id not in self.decoders:
+            raise KeyError(f"No decoder for message id 0x{message_id:02X}")
+
+        self.handlers[message_id] = self.handlers[message_id] + (handler,)
+
+    def remove_handler(self, message_id: int, handler):
+        handlers = list(self.handlers.get(message_id, ()))
+
+        if handler in handlers:
+            handlers.remove(handler)
+            self.handlers[message_id] = tuple(handlers)
+
+    def decode(self, message_id: int, buffer):
+        """
+        Description:
+            Decodes a message buffer, unknown message ids and buffers too short for their message return None
+        """
+        decoder = self.decoders.get(message_id)
+
+        if decoder is None:
+            return None
+
+        return decoder(buffer)
+
+    def dispatch(self, message_id: int, message):
+        for handler in self.handlers[message_id]:
+            handler(message)
+
+    def decode_status_message(self, buffer):
+        if len(buffer) >= self.timestamped_motor_status_message_struct.size:
+            _, status_byte, job_id, microstep, pulses_remaining, device_micros, _ = self.timestamped_motor_status_message_struct.unpack_from(buffer)
+            return StatusMessage(status_byte, job_id, microstep, pulses_remaining, self.status_bits, device_micros)
+
+        if len(buffer) < self.motor_status_message_struct.size:
+            return None
+
+        _, status_byte, job_id, microstep, pulses_remaining, _ = self.motor_status_message_struct.unpack_from(buffer)
+        return StatusMessage(status_byte, job_id, microstep, pulses_remaining, self.status_bits)
+
+    def decode_feedback_message(self, buffer):
+        buffer_length = len(buffer)
+
+        if buffer_length < self.short_motor_feedback_message_struct.size:
+            return None
+
+        if buffer_length < self.motor_feedback_message_struct.size:
+            _, velocity, position, encoder_count, _ = self.short_motor_feedback_message_struct.unpack_from(buffer)
+            return FeedbackMessage(velocity, position, encoder_count)
+
+        if buffer_length >= self.timestamped_motor_feedback_message_struct.size:
+            _, velocity, position, encoder_count, device_micros, _ = self.timestamped_motor_feedback_message_struct.unpack_from(buffer)
+            return FeedbackMessage(velocity, position, encoder_count, device_micros)
+
+        _, velocity, position, encoder_count, _ = self.motor_feedback_message_struct.unpack_from(buffer)
+        return FeedbackMessage(velocity, position, encoder_count)
+
+    def decode_feedback_batch_message(self, buffer):
+        # {MOTOR_FEEDBACK_BATCH_MESSAGE_ID, sample count, samples..., ETX}, a short frame keeps the whole samples it holds
+        if len(buffer) < 3:
+            return None
+
+        sample_count = min(buffer[1], (len(buffer) - 3) // feedback_batch_dtype.itemsize)
+        return FeedbackBatchMessage(np.frombuffer(buffer, dtype=feedback_batch_dtype, count=sample_count, offset=2).copy())
+
+    def decode_fault_message(self, buffer):
+        return FaultMessage()
+
+    def decode_response_message(self, buffer):
+        if len(buffer) < self.response_message_struct.size:
+            return None
+
+        _, command, job_id, response, ack, _ = self.response_message_struct.unpack_from(buffer)
+        return ResponseMessage(command, job_id, response, ack == self.ACK)
+
+    def decode_job_complete_message(self, buffer):
+        if len(buffer) < self.job_message_struct.size:
+            return None
+
+        return JobCompleteMessage(self.job_message_struct.unpack_from(buffer)[1])
+
+    def decode_job_cancelled_message(self, buffer):
+        if len(buffer) < self.job_message_struct.size:
+            return None
+
+        return JobCancelledMessage(self.job_message_struct.unpack_from(buffer)[1])
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Coordinated moves over several motors. Jobs are sized with the firmware timing model so every axis finishes
+    together, encoded ahead of time and released in one burst or at a deadline, and the achieved start skew is
+    measured from the feedback
+"""
+
+import math
+import time
+import numpy as np
+from typing import Union
+from pathlib import Path
+
+from motor import Motor
+from motion_planner import MotionPlanner
+from command_tracker import MotorCommandError
+
+
+class MotionCoordinator:
+    def __init__(self,
+                 motors: list,
+                 definitions_filepath: Path,
+                 tolerance: float = 0.001,
+                 spin_time: float = 0.002,
+                 library_header_filepath: Union[Path, None] = None,
+                 ):
+        """
+        Description:
+            The axis with the longest move runs at the requested speed, every other axis gets the microstep and
+            pulse interval whose MotionPlanner duration is closest to it. The finest microstep within tolerance of
+            the lead duration is used, otherwise the closest. Ramped moves keep the lead's ramp as the same
+            fraction of every axis's move, so the axes also accelerate together.
+
+        Args:
+            motors (list): Motor per axis, run with start_threads() or from a MotorBus
+            definitions_filepath (Path): Path to the firmware definitions.h
+            tolerance (float): Accepted relative error between an axis's duration and the lead's
+            spin_time (float): Time before a deadline spent busy waiting rather than sleeping, in seconds
+            library_header_filepath (Path): MotorInterface.h, defaults to the copy next to definitions.h
+        """
+        self.motors = motors
+        self.planner = MotionPlanner(definitions_filepath, library_header_filepath)
+        self.tolerance = tolerance
+        self.spin_time = spin_time
+
+        self.microsteps = np.array(self.planner.microsteps, dtype=np.int64)
+        self.motor_pulses_per_revolution = self.planner.motor_pulses_per_revolution
+        self.minimum_pulse_interval = self.planner.host_minimum_pulse_interval
+        self.maximum_pulse_interval = self.planner.maximum_pulse_interval
+        self.default_pulse_on_period = self.planner.host_default_pulse_on_period
+
+    def plan_rotations(self,
+                       rotations: list,
+                       rpm: float,
+                       use_ramping: bool = False,
+                       ramping_steps: int = 0,
+                       ramp_scaler: Union[int, None] = None,
+                       duration: Union[float, None] = None,
+                       ):
+        """
+        Description:
+            Plans a relative move, rotations are signed and one per motor, 0 leaves a motor still.
+
+        Args:
+            rotations (list): Rotations per axis, negative turns backwards
+            rpm (float): Speed of the axis with the longest move
+            use_ramping (bool): Ramp every axis
+            ramping_steps (int): Ramping pulses of the lead axis, the others are scaled to match
+            ramp_scaler (int): Sent to every axis, firmware default if None
+            duration (float): Time every axis should take in seconds, instead of the lead running at rpm
+
+        Returns:
+            move: (dict | None) jobs, frames and predicted durations per axis, see execute(). None if no axis moves
+                  or the axes can't be matched
+        """
+        full_steps = np.asarray(rotations, dtype=np.float64) * self.motor_pulses_per_revolution
+        return self.plan_steps(full_steps, rpm, use_ramping, ramping_steps, ramp_scaler, duration)
+
+    def plan_positions(self,
+                       positions: list,
+                       rpm: float,
+                       use_ramping: bool = False,
+                       ramping_steps: int = 0,
+                       ramp_scaler: Union[int, None] = None,
+                       duration: Union[float, None] = None,
+                       ):
+        """
+        Description:
+            Plans a multi-turn move to absolute positions in radians from each motor's position_tracker origin,
+            as goto_absolute_position_radians. None leaves a motor where it is. Axes that end off target are
+            corrected as a goto would be.
+        """
+        full_steps = np.zeros(len(self.motors))
+        target_counts = []
+
+        for index, (motor, position) in enumerate(zip(self.motors, positions)):
+            if position is None:
+                target_counts.append(None)
+                continue
+
+            target_count = motor.position_tracker.counts_from_radians(position)
+            delta_count = target_count - motor.position_tracker.absolute_count
+            target_counts.append(target_count)
+
+            if abs(delta_count) >= motor.encoder_setpoint_tolerance:
+                full_steps[index] = delta_count * self.motor_pulses_per_revolution / motor.encoder_pulses_per_revolution
+
+        move = self.plan_steps(full_steps, rpm, use_ramping, ramping_steps, ramp_scaler, duration)
+
+        if move is not None:
+            move["target_counts"] = target_counts
+
+        return move
+
+    def plan_steps(self,
+                   full_steps: np.ndarray,
+                   rpm: float,
+                   use_ramping: bool = False,
+                   ramping_steps: int = 0,
+                   ramp_scaler: Union[int, None] = None,
+                   duration: Union[float, None] = None,
+                   ):
+        """
+        Description:
+            Plans a move given in signed full steps per axis, see plan_rotations.
+        """
+        full_steps = np.asarray(full_steps, dtype=np.float64)
+        distances = np.abs(full_steps)
+        moving = np.round(distances * self.microsteps.max()) > 0
+
+        if not moving.any() or rpm <= 0:
+            print(f"Coordinated move with no motion requested")
+            return None
+
+        # The lead is sent exactly as send_motor_rotations_at_set_rpm would send it
+        lead = int(np.argmax(distances))
+        lead_microstep, lead_interval, _, _ = self.motors[lead].rpm_solver.solve(rpm)
+        lead_pulses = int(round(distances[lead] * lead_microstep))
+        ramp_fraction = min(ramping_steps / lead_pulses, 0.5) if use_ramping else 0.0
+        effective_ramp_scaler = self.planner.job_variables(pulse_on_period=self.default_pulse_on_period,
+                                                           use_ramping=use_ramping,
+                                                           ramp_scaler=ramp_scaler)["ramp_scaler"]
+
+        if duration is None:
+            duration = float(self.durations(np.array(lead_pulses),
+                                             np.array(lead_interval),
+                                             ramp_fraction,
+                                             use_ramping,
+                                             effective_ramp_scaler))
+
+        microsteps, pulses, intervals, durations = self.match_duration(distances, duration, ramp_fraction, use_ramping, effective_ramp_scaler)
+        errors = np.abs(durations - duration) / duration
+
+        if np.any(moving & (errors > 10 * self.tolerance)):
+            print(f"Coordinated move can't be matched, relative duration errors {np.round(errors, 4)}")
+            return None
+
+        jobs = []
+        frames = []
+        job_ids = []
+
+        for index, motor in enumerate(self.motors):
+            if not moving[index]:
+                jobs.append(None)
+                frames.append(None)
+                job_ids.append(None)
+                continue
+
+            interval = int(intervals[index])
+            job = {"direction": bool(full_steps[index] > 0),
+                   "microstep": int(microsteps[index]),
+                   "pulses": int(pulses[index]),
+                   "pulse_interval": interval,
+                   "pulse_on_period": min(self.default_pulse_on_period, interval // 2),
+                   "use_ramping": use_ramping,
+                   "ramping_steps": max(1, int(round(ramp_fraction * pulses[index]))) if use_ramping else 0,
+                   "ramp_scaler": ramp_scaler,
+                   }
+
+            job_id = motor.next_job_id()
+            command = motor.codec.select_job_command(pulse_on_period=job["pulse_on_period"],
+                                                     use_ramping=use_ramping,
+                                                     ramp_scaler=ramp_scaler)
+
+            jobs.append(job)
+            job_ids.append(job_id)
+            frames.append(motor.codec.encode_job(command=command,
+                                                 direction=job["direction"],
+                                                 microstep=job["microstep"],
+                                                 job_id=job_id,
+                                                 pulses=job["pulses"],
+                                                 pulse_interval=job["pulse_interval"],
+                                                 pulse_on_period=job["pulse_on_period"],
+                                                 ramping_steps=job["ramping_steps"],
+                                                 ramp_scaler=ramp_scaler))
+
+        return {"jobs": jobs,
+                "frames": frames,
+                "job_ids": job_ids,
+                "durations": np.where(moving, durations, 0.0),
+                "duration": duration,
+                "lead": lead,
+                "rpm": rpm,
+                "target_counts": None,
+                "release_time": None,
+                "start_counts": None,
+                }
+
+    def durations(self, pulses: np.ndarray, intervals: np.ndarray, ramp_fraction: float, use_ramping: bool, ramp_scaler: int):
+        ramping_steps = np.maximum(1, np.round(ramp_fraction * pulses)).astype(np.int64) if use_ramping else np.zeros_like(pulses)
+
+        return self.planner.durations(pulses=pulses,
+                                      pulse_interval=intervals,
+                                      pulse_on_period=np.minimum(self.default_pulse_on_period, intervals // 2),
+                                      use_ramping=np.full(np.shape(pulses), use_ramping),
+                                      ramping_steps=ramping_steps,
+                                      ramp_scaler=np.full(np.shape(pulses), ramp_scaler))
+
+    def match_duration(self, distances: np.ndarray, duration: float, ramp_fraction: float, use_ramping: bool, ramp_scaler: int):
+        """
+        Description:
+            Bisects the pulse interval of every (axis, microstep) pair at once for the duration closest to the
+            target, durations grow with the interval.
+
+        Returns:
+            microsteps, pulses, pulse intervals, durations: (np.ndarray) one per axis
+        """
+        pulses = np.round(distances[:, None] * self.microsteps[None, :]).astype(np.int64)
+        low = np.full(pulses.shape, self.minimum_pulse_interval, dtype=np.int64)
+        high = np.full(pulses.shape, self.maximum_pulse_interval, dtype=np.int64)
+
+        while np.any(low < high):
+            middle = (low + high) // 2
+            short = self.durations(pulses, middle, ramp_fraction, use_ramping, ramp_scaler) < duration
+            low = np.where(short, middle + 1, low)
+            high = np.where(short, high, middle)
+
+        # The closest duration is at the first interval reaching the target or the one before it
+        below = np.maximum(low - 1, self.minimum_pulse_interval)
+        low_durations = self.durations(pulses, low, ramp_fraction, use_ramping, ramp_scaler)
+        below_durations = self.durations(pulses, below, ramp_fraction, use_ramping, ramp_scaler)
+        use_below = np.abs(below_durations - duration) < np.abs(low_durations - duration)
+        intervals = np.where(use_below, below, low)
+        durations = np.where(use_below, below_durations, low_durations)
+
+        # Finest microstep within tolerance, else the smallest error
+        errors = np.where(pulses > 0, np.abs(durations - duration) / duration, np.inf)
+        within = errors <= self.tolerance
+        finest = len(self.microsteps) - 1 - np.argmax(within[:, ::-1], axis=1)
+        choice = np.where(within.any(axis=1), finest, np.argmin(errors, axis=1))
+        rows = np.arange(len(distances))
+
+        return self.microsteps[choice], pulses[rows, choice], intervals[rows, choice], durations[rows, choice]
+
+    def execute(self, move: dict, deadline: Union[float, None] = None, wake: bool = True):
+        """
+        Description:
+            Sends a planned move. Wake commands go first and are waited for when there is a deadline, then every
+            motor's job bookkeeping is done so the release itself only hands the pre-encoded frames to each
+            motor's queue, back to back.
+
+        Args:
+            move (dict): Output of plan_rotations / plan_positions, each plan can be executed once
+            deadline (float): time.monotonic() time to release the frames at, straight away if None
+            wake (bool): Wake the moving motors first, finish_job leaves them asleep
+
+        Returns:
+            futures: (list) job command response per axis, None for axes that don't move
+        """
+        axes = [index for index, job in enumerate(move["jobs"]) if job is not None]
+
+        if wake:
+            wake_futures = [self.motors[index].send_wake_motor() for index in axes]
+
+            if deadline is not None:
+                for future in wake_futures:
+                    try:
+                        future.result(timeout=max(deadline - time.monotonic(), 0.0))
+
+                    # An already awake motor NAKs the wake
+                    except MotorCommandError:
+                        pass
+
+                    except Exception as e:
+                        print(f'Wake before coordinated move failed: {e}')
+
+        for index in axes:
+            motor = self.motors[index]
+            job = move["jobs"][index]
+            motor.begin_job(command=move["frames"][index][2],
+                            direction=job["direction"],
+                            microstep=job["microstep"],
+                            pulse_interval=job["pulse_interval"],
+                            pulse_on_period=job["pulse_on_period"],
+                            use_ramping=job["use_ramping"],
+                            job_id=move["job_ids"][index])
+
+            if move["target_counts"] is not None:
+                motor.commanded_count = move["target_counts"][index]
+                motor.commanded_speed = move["rpm"]
+                motor.at_commanded_position = False
+
+        move["start_counts"] = [motor.position_tracker.unwrapped_count for motor in self.motors]
+
+        if deadline is not None:
+            self.wait_until(deadline)
+
+        futures = [None] * len(self.motors)
+        release_time = time.monotonic()
+
+        for index in axes:
+            futures[index] = self.motors[index].send_job_frame(move["frames"][index], move["job_ids"][index])
+
+        move["release_time"] = release_time
+        move["release_spread"] = time.monotonic() - release_time
+
+        return futures
+
+    def wait_until(self, deadline: float):
+        remaining = deadline - time.monotonic() - self.spin_time
+
+        if remaining > 0:
+            time.sleep(remaining)
+
+        while time.monotonic() < deadline:
+            pass
+
+    def measure(self, move: dict, min_counts: int = 3):
+        """
+        Description:
+            Works out when each axis actually started from its feedback. Every sample taken while the axis moves is
+            matched against the planned pulse times to give one estimate of the start, the median over the first
+            half of the move is the start and over the second half, plus the planned duration, the finish.
+            Host arrival latency is common to every axis so cancels in the skews. Call once the move has finished.
+
+        Args:
+            move (dict): An executed move
+            min_counts (int): Encoder counts an axis must have moved before its samples are used
+
+        Returns:
+            measurement: (dict) starts and finishes per axis relative to the release (NaN for still axes and axes
+                         without enough feedback), start_skew and finish_skew in seconds
+        """
+        starts = np.full(len(self.motors), np.nan)
+        finishes = np.full(len(self.motors), np.nan)
+        release_time = move["release_time"]
+
+        for index, (motor, job) in enumerate(zip(self.motors, move["jobs"])):
+            if job is None:
+                continue
+
+            samples = motor.feedback_history.window(time.monotonic() - release_time)
+            samples = samples[samples['timestamp'] >= release_time]
+
+            profile = self.planner.profile(**job)
+            pulses_per_count = self.motor_pulses_per_revolution * job["microstep"] / motor.encoder_pulses_per_revolution
+            moved = np.abs(samples['unwrapped_count'] - move["start_counts"][index])
+
+            # A sample lands anywhere while the rotor is on a count, on average half way through it
+            pulses_done = (moved + 0.5) * pulses_per_count
+            usable = (moved >= min_counts) & (pulses_done < job["pulses"] - pulses_per_count)
+            start_estimates = samples['timestamp'] - np.interp(pulses_done, np.arange(1, job["pulses"] + 1), profile["times"])
+
+            first_half = usable & (pulses_done <= job["pulses"] / 2)
+            second_half = usable & (pulses_done > job["pulses"] / 2)
+
+            if first_half.any():
+                starts[index] = np.median(start_estimates[first_half]) - release_time
+
+            if second_half.any():
+                finishes[index] = np.median(start_estimates[second_half]) - release_time + profile["duration"]
+
+        return {"starts": starts,
+                "finishes": finishes,
+                "start_skew": float(np.nanmax(starts) - np.nanmin(starts)) if np.isfinite(starts).any() else math.nan,
+                "finish_skew": float(np.nanmax(finishes) - np.nanmin(finishes)) if np.isfinite(finishes).any() else math.nan,
+                }
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+    header_file = project_dir / 'arduino/engineering-team-motor/definitions.h'
+
+    motors = [Motor(definitions_filepath=header_file, serial_port=serial_port)
+              for serial_port in ['/dev/arduino_rp2040_0', '/dev/arduino_rp2040_1']]
+
+    for motor in motors:
+        motor.start_threads()
+        motor.send_enable_motor()
+
+    coordinator = MotionCoordinator(motors, header_file)
+    move = coordinator.plan_rotations([2.0, -0.75], rpm=30, use_ramping=True, ramping_steps=200)
+    print(f"{move['jobs']=}\n{move['durations']=}")
+
+    futures = coordinator.execute(move, deadline=time.monotonic() + 0.1)
+    time.sleep(move["duration"] + 0.5)
+    print(coordinator.measure(move))
+
+    for motor in motors:
+        motor.stop()
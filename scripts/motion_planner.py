@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Reproduces the pulse timing of MotorInterface::StartJob / Update so move durations and velocity profiles
+    are known before a job is sent, and searches ramp settings for the fastest move under an acceleration limit
+"""
+
+import math
+import numpy as np
+from typing import Union
+from pathlib import Path
+
+from definition_file_parser import parse_header_defines
+from motor_protocol import load_protocol
+from command_codec import CommandCodec
+
+MASK = 0xFFFFFFFF  # StartJob / Update work in unsigned long
+
+
+def descending_clipped_sum(a0: np.ndarray, step: np.ndarray, n: np.ndarray, floor: np.ndarray):
+    """
+    Description:
+        sum(max(a0 - j * step, floor) for j in range(n)), step >= 0
+
+    Returns:
+        total: (np.ndarray) sum of the clipped terms
+        above: (np.ndarray) number of terms >= floor, these come first
+    """
+    safe_step = np.maximum(step, 1)
+    above = np.where(a0 < floor, 0, np.where(step == 0, n, np.minimum(n, (a0 - floor) // safe_step + 1)))
+    total = above * a0 - step * above * (above - 1) // 2 + (n - above) * floor
+    return total, above
+
+
+def ascending_clipped_sum(a0: np.ndarray, step: np.ndarray, n: np.ndarray, floor: np.ndarray):
+    """
+    Description:
+        sum(max(a0 + j * step, floor) for j in range(n)), step >= 0
+
+    Returns:
+        total: (np.ndarray) sum of the clipped terms
+        below: (np.ndarray) number of terms < floor, these come first
+    """
+    safe_step = np.maximum(step, 1)
+    below = np.where(a0 >= floor, 0, np.where(step == 0, n, np.minimum(n, -((a0 - floor) // safe_step))))
+    total = below * floor + (n - below) * a0 + step * (n * (n - 1) - below * (below - 1)) // 2
+    return total, below
+
+
+class MotionPlanner:
+    def __init__(self, definitions_filepath: Path, library_header_filepath: Union[Path, None] = None):
+        """
+        Description:
+            Every method works on NumPy arrays of job variables, so thousands of candidate moves are planned in one call.
+            Job variables are the values the firmware receives, fields a job command doesn't carry take the
+            MotorInterface::ClearCommandVariables defaults, see job_variables().
+            Timings are ideal, the firmware's loop period adds a few microseconds per pulse edge.
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            library_header_filepath (Path): MotorInterface.h, defaults to the copy next to definitions.h
+        """
+        definitions = load_protocol(definitions_filepath)
+
+        if library_header_filepath is None:
+            library_header_filepath = definitions.header_path.parent / 'libraries/MotorInterface/MotorInterface.h'
+
+        library_defines = parse_header_defines(library_header_filepath)
+
+        self.codec = CommandCodec(definitions)
+        self.command_dict = definitions['command_types']
+        self.microsteps = (1, 2, 4, 8, 16, 32)
+        self.motor_pulses_per_revolution = definitions['motor_settings']['MOTOR_STEPS_PER_REV']
+        self.host_minimum_pulse_interval = definitions['motor_settings']['MINIMUM_PULSE_INTERVAL']
+        self.host_default_pulse_on_period = definitions['motor_settings']['DEFAULT_PULSE_ON_PERIOD']
+
+        # MotorInterface.h values, these are what StartJob actually uses
+        self.minimum_pulse_interval = library_defines['MINIMUM_PULSE_INTERVAL']
+        self.maximum_pulse_interval = library_defines['MAXIMUM_PULSE_INTERVAL']
+        self.default_pulse_interval = library_defines['DEFAULT_PULSE_INTERVAL']
+        self.default_pulse_on_period = library_defines['DEFAULT_PULSE_ON_PERIOD']
+        self.default_ramp_steps = library_defines['DEFAULT_RAMP_STEPS']
+        self.default_ramp_scaler = library_defines['DEFAULT_RAMP_SCALER']
+
+    def job_variables(self,
+                      microstep: int = 1,
+                      pulses: int = 0,
+                      pulse_interval: int = 1000,
+                      pulse_on_period: Union[int, None] = None,
+                      use_ramping: bool = False,
+                      ramping_steps: int = 0,
+                      ramp_scaler: Union[int, None] = None,
+                      **kwargs):
+        """
+        Description:
+            Maps send_motor_pulses arguments to the variables the firmware ends up with. The job command is chosen
+            as CommandCodec does, e.g. SEND_JOB_WITH_RAMPING carries no pulse interval so the firmware uses its default.
+
+        Returns:
+            job variables: (dict) microstep, pulses, pulse_interval, pulse_on_period, use_ramping, ramping_steps, ramp_scaler
+        """
+        command = self.codec.select_job_command(pulse_on_period=pulse_on_period, use_ramping=use_ramping, ramp_scaler=ramp_scaler)
+        carries_interval = command not in (self.command_dict['SEND_JOB'], self.command_dict['SEND_JOB_WITH_RAMPING'])
+        carries_ramping = command not in (self.command_dict['SEND_JOB'], self.command_dict['SEND_JOB_ALL_VARIABLES'])
+
+        return {"microstep": microstep if microstep in self.microsteps else 1,
+                "pulses": pulses & MASK,
+                "pulse_interval": max(pulse_interval, self.host_minimum_pulse_interval) if carries_interval else self.default_pulse_interval,
+                "pulse_on_period": pulse_on_period if carries_interval else self.default_pulse_on_period,
+                "use_ramping": carries_ramping,
+                "ramping_steps": ramping_steps if carries_ramping else 0,
+                "ramp_scaler": ramp_scaler if command == self.command_dict.get('SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE') else self.default_ramp_scaler,
+                }
+
+    def firmware_state(self,
+                       pulses: np.ndarray,
+                       pulse_interval: np.ndarray,
+                       pulse_on_period: np.ndarray,
+                       use_ramping: np.ndarray,
+                       ramping_steps: np.ndarray,
+                       ramp_scaler: np.ndarray,
+                       **kwargs):
+        """
+        Description:
+            The status variables StartJob derives from the job variables. Without ramping the ramp boundaries are set
+            so no pulse falls in a ramp, which makes one set of formulas cover both cases.
+
+        Returns:
+            state: (dict) of int64 arrays
+        """
+        pulses, pulse_interval, pulse_on_period, ramping_steps, ramp_scaler = np.broadcast_arrays(
+            *[np.asarray(value, dtype=np.int64) for value in (pulses, pulse_interval, pulse_on_period, ramping_steps, ramp_scaler)])
+        use_ramping = np.broadcast_to(np.asarray(use_ramping, dtype=bool), pulses.shape)
+
+        interval = np.where((pulse_interval > self.minimum_pulse_interval) & (pulse_interval < self.maximum_pulse_interval),
+                            pulse_interval, self.default_pulse_interval)
+        on_period = np.where((pulse_on_period < pulse_interval) & (pulse_on_period != 0), pulse_on_period, interval // 2)
+
+        ramping_steps = np.where(ramping_steps == 0, self.default_ramp_steps, ramping_steps)
+        long_move = 2 * ramping_steps < pulses
+        ramp_up_stop = np.where(long_move, pulses - ramping_steps, pulses // 2)
+        ramp_down_start = np.where(long_move, ramping_steps, (pulses // 2 - 1) & MASK)
+        ramp_up_interval = (interval * ramp_scaler) & MASK
+        ramp_interval_step = ((ramp_up_interval - interval) & MASK) // ramping_steps
+
+        return {"pulses": pulses,
+                "pulse_interval": interval,
+                "pulse_on_period": on_period,
+                "ramp_up_stop": np.where(use_ramping, ramp_up_stop, pulses),
+                "ramp_down_start": np.where(use_ramping, ramp_down_start, 0),
+                "ramp_up_interval": np.where(use_ramping, ramp_up_interval, interval),
+                "ramp_interval_step": np.where(use_ramping, ramp_interval_step, 0),
+                }
+
+    def pulse_gaps(self, state: dict, k: np.ndarray):
+        """
+        Description:
+            Time from rising edge k to rising edge k + 1 in microseconds. Update sets the next interval on each rising
+            edge, and the next rising edge can't come before the falling edge pulse_on_period later.
+
+        Args:
+            state (dict): Output of firmware_state, arrays broadcast against k
+            k (np.ndarray): Pulse indices, 0 <= k < pulses - 1
+        """
+        pulses_remaining = state["pulses"] - k
+        step = state["ramp_interval_step"]
+
+        interval = np.where(pulses_remaining > state["ramp_up_stop"],
+                            (state["ramp_up_interval"] - (k + 1) * step) & MASK,
+                            np.where(pulses_remaining < state["ramp_down_start"],
+                                     (state["pulse_interval"] + (state["ramp_down_start"] - pulses_remaining) * step) & MASK,
+                                     state["pulse_interval"]))
+
+        return np.maximum(interval, state["pulse_on_period"])
+
+    def phase_lengths(self, state: dict):
+        """
+        Description:
+            Number of pulse gaps in the ramp up, full speed and ramp down phases.
+        """
+        gaps = np.maximum(state["pulses"] - 1, 0)
+        up_gaps = np.clip(state["pulses"] - state["ramp_up_stop"], 0, gaps)
+        first_down_gap = np.maximum(state["pulses"] - state["ramp_down_start"] + 1, up_gaps)
+        down_gaps = np.clip(gaps - first_down_gap, 0, gaps - up_gaps)
+        return gaps, up_gaps, gaps - up_gaps - down_gaps, down_gaps
+
+    def wraps(self, state: dict):
+        """
+        Description:
+            Moves whose ramp intervals overflow the firmware's unsigned long, e.g. ramp_scaler 0. These are evaluated
+            pulse by pulse instead of in closed form.
+        """
+        gaps, up_gaps, _, down_gaps = self.phase_lengths(state)
+        up_unwrapped = state["ramp_up_interval"] - up_gaps * state["ramp_interval_step"] >= 0
+        down_unwrapped = state["pulse_interval"] + down_gaps * state["ramp_interval_step"] <= MASK
+        step_unwrapped = state["ramp_up_interval"] >= state["pulse_interval"]
+        return ~(up_unwrapped & down_unwrapped & step_unwrapped)
+
+    def durations(self, **job_variables):
+        """
+        Description:
+            Time from the first rising edge until the job completes, for arrays of job variables.
+
+        Returns:
+            durations: (np.ndarray) seconds
+        """
+        state = self.firmware_state(**job_variables)
+        gaps, up_gaps, full_speed_gaps, down_gaps = self.phase_lengths(state)
+        step = state["ramp_interval_step"]
+        on_period = state["pulse_on_period"]
+
+        up_total, _ = descending_clipped_sum(state["ramp_up_interval"] - step, step, up_gaps, on_period)
+        down_total, _ = ascending_clipped_sum(state["pulse_interval"] + step, step, down_gaps, on_period)
+        total = np.array(up_total + full_speed_gaps * np.maximum(state["pulse_interval"], on_period) + down_total)
+
+        for index in map(tuple, np.argwhere(self.wraps(state))):
+            row_state = {key: value[index] for key, value in state.items()}
+            total[index] = self.pulse_gaps(row_state, np.arange(gaps[index])).sum()
+
+        return np.where(state["pulses"] > 0, total + on_period, 0) / 1e6
+
+    def peak_accelerations(self, microstep: np.ndarray, **job_variables):
+        """
+        Description:
+            Largest rotor acceleration in rad/s^2, including the step from rest to the first pulse rate and
+            back to rest after the last. Velocity changes are monotonic within each ramp, so only the gaps at
+            phase boundaries need evaluating.
+
+        Returns:
+            peak accelerations: (np.ndarray) rad/s^2
+        """
+        state = self.firmware_state(**job_variables)
+        gaps, up_gaps, full_speed_gaps, down_gaps = self.phase_lengths(state)
+        step = state["ramp_interval_step"]
+        on_period = state["pulse_on_period"]
+        radians_per_pulse = 2 * math.pi / (self.motor_pulses_per_revolution * np.asarray(microstep, dtype=np.float64))
+        radians_per_pulse = np.broadcast_to(radians_per_pulse, state["pulses"].shape)
+
+        _, up_above = descending_clipped_sum(state["ramp_up_interval"] - step, step, up_gaps, on_period)
+        _, down_below = ascending_clipped_sum(state["pulse_interval"] + step, step, down_gaps, on_period)
+        down_start = up_gaps + full_speed_gaps
+
+        pair_indices = np.stack([np.zeros_like(gaps),
+                                 up_above - 1,
+                                 up_gaps - 2,
+                                 up_gaps - 1,
+                                 down_start - 1,
+                                 down_start,
+                                 down_start + down_below - 1,
+                                 down_start + down_below,
+                                 gaps - 2], axis=-1)
+
+        last_pair = np.maximum(gaps - 2, 0)[..., None]
+        pair_indices = np.clip(pair_indices, 0, last_pair)
+        expanded_state = {key: value[..., None] for key, value in state.items()}
+        first = self.pulse_gaps(expanded_state, pair_indices).astype(np.float64)
+        second = self.pulse_gaps(expanded_state, np.minimum(pair_indices + 1, np.maximum(gaps - 1, 0)[..., None])).astype(np.float64)
+
+        # velocity = radians_per_pulse / gap, acceleration between gap midpoints
+        pair_accelerations = np.abs(1 / second - 1 / first) / (0.5 * (first + second))
+        pair_accelerations = np.where(gaps[..., None] >= 2, pair_accelerations, 0).max(axis=-1)
+
+        first_gap = self.pulse_gaps(state, np.zeros_like(gaps)).astype(np.float64)
+        last_gap = self.pulse_gaps(state, np.maximum(gaps - 1, 0)).astype(np.float64)
+        first_gap = np.where(gaps > 0, first_gap, on_period)
+        last_gap = np.where(gaps > 0, last_gap, on_period)
+        start_stop_accelerations = np.maximum(1 / first_gap ** 2, 1 / last_gap ** 2)
+
+        peak = np.array(np.maximum(pair_accelerations, start_stop_accelerations) * radians_per_pulse * 1e12)
+
+        for index in map(tuple, np.argwhere(self.wraps(state) & (gaps >= 2))):
+            row_state = {key: value[index] for key, value in state.items()}
+            row_gaps = self.pulse_gaps(row_state, np.arange(gaps[index])).astype(np.float64)
+            row_pairs = np.abs(np.diff(1 / row_gaps)) / (0.5 * (row_gaps[1:] + row_gaps[:-1]))
+            peak[index] = max(row_pairs.max(), start_stop_accelerations[index]) * radians_per_pulse[index] * 1e12
+
+        return np.where(state["pulses"] > 0, peak, 0)
+
+    def profile(self, **kwargs):
+        """
+        Description:
+            Pulse by pulse profile of one job, takes send_motor_pulses arguments.
+
+        Returns:
+            profile: (dict) times (s) of each rising edge, gaps (us) between them, velocity (rad/s) over each gap,
+                     duration (s) until the firmware reports the job complete
+        """
+        job_variables = self.job_variables(**kwargs)
+        state = self.firmware_state(**job_variables)
+        pulses = int(state["pulses"])
+        gaps = self.pulse_gaps(state, np.arange(max(pulses - 1, 0), dtype=np.int64))
+        radians_per_pulse = 2 * math.pi / (self.motor_pulses_per_revolution * job_variables["microstep"])
+
+        return {"times": np.concatenate(([0], np.cumsum(gaps)))[:pulses] / 1e6,
+                "gaps": gaps,
+                "velocity": radians_per_pulse * 1e6 / gaps,
+                "duration": (gaps.sum() + int(state["pulse_on_period"])) / 1e6 if pulses > 0 else 0.0,
+                }
+
+    def estimate_duration(self, **kwargs):
+        """
+        Description:
+            Duration of one job in seconds, takes send_motor_pulses arguments.
+        """
+        return float(self.durations(**self.job_variables(**kwargs)))
+
+    def optimise_move(self,
+                      number_or_rotations: Union[float, int],
+                      max_acceleration: float,
+                      max_rpm: Union[float, None] = None,
+                      microsteps: Union[tuple, None] = None,
+                      speeds: int = 32,
+                      ):
+        """
+        Description:
+            Searches microstep, pulse interval, ramping_steps and ramp_scaler for the shortest job moving
+            number_or_rotations, with every acceleration (including starting and stopping) under max_acceleration.
+            Pulse counts follow send_motor_rotations, so every microstep moves the same distance.
+
+        Args:
+            number_or_rotations (float): Distance to move
+            max_acceleration (float): Acceleration limit in rad/s^2
+            max_rpm (float): Speed limit, the host MINIMUM_PULSE_INTERVAL is always respected
+            microsteps (tuple): Microsteps to consider, all by default
+            speeds (int): Number of full speed pulse intervals tried per microstep
+
+        Returns:
+            job: (dict | None) send_motor_pulses arguments (without direction and job_id), None if nothing is feasible
+            duration: (float) seconds
+            peak acceleration: (float) rad/s^2
+        """
+        microsteps = self.microsteps if microsteps is None else microsteps
+        steps = int(abs(number_or_rotations) * self.motor_pulses_per_revolution)
+
+        candidates = []
+
+        for microstep in microsteps:
+            pulses = steps * microstep
+
+            if pulses == 0:
+                continue
+
+            fastest_interval = self.host_minimum_pulse_interval + 1
+
+            if max_rpm is not None:
+                fastest_interval = max(fastest_interval, math.ceil(60e6 / (max_rpm * self.motor_pulses_per_revolution * microstep)))
+
+            slowest_interval = max(fastest_interval, self.maximum_pulse_interval // 100)
+            intervals = np.unique(np.geomspace(fastest_interval, slowest_interval, speeds).astype(np.int64))
+            ramp_steps = np.unique(np.geomspace(1, max(pulses // 2, 1), 24).astype(np.int64))
+            ramp_scalers = np.arange(1, 33, dtype=np.int64)
+
+            interval, ramping_steps, ramp_scaler = np.meshgrid(intervals, ramp_steps, ramp_scalers, indexing='ij')
+            on_period = np.minimum(self.host_default_pulse_on_period, interval // 2)
+
+            candidates.append((microstep, pulses, interval.ravel(), on_period.ravel(), ramping_steps.ravel(), ramp_scaler.ravel()))
+
+        best = (None, math.inf, math.inf)
+
+        for microstep, pulses, interval, on_period, ramping_steps, ramp_scaler in candidates:
+            job_variables = {"pulses": pulses,
+                             "pulse_interval": interval,
+                             "pulse_on_period": on_period,
+                             "use_ramping": True,
+                             "ramping_steps": ramping_steps,
+                             "ramp_scaler": ramp_scaler}
+
+            durations = self.durations(**job_variables)
+            accelerations = self.peak_accelerations(microstep, **job_variables)
+            durations = np.where(accelerations <= max_acceleration, durations, np.inf)
+            index = int(np.argmin(durations))
+
+            if durations[index] < best[1]:
+                best = ({"microstep": microstep,
+                         "pulses": pulses,
+                         "pulse_interval": int(interval[index]),
+                         "pulse_on_period": int(on_period[index]),
+                         "use_ramping": True,
+                         "ramping_steps": int(ramping_steps[index]),
+                         "ramp_scaler": int(ramp_scaler[index])},
+                        float(durations[index]),
+                        float(accelerations[index]))
+
+        return best
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+    planner = MotionPlanner(project_dir / 'arduino/engineering-team-motor/definitions.h')
+
+    print(f"{planner.estimate_duration(microstep=32, pulses=400, pulse_interval=20000, pulse_on_period=500, use_ramping=True, ramping_steps=250, ramp_scaler=3)=:.3f} s")
+
+    job, duration, peak_acceleration = planner.optimise_move(number_or_rotations=2, max_acceleration=200.0)
+    print(f"{job=}\n{duration=:.3f} s, {peak_acceleration=:.1f} rad/s^2")
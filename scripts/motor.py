@@ -11,38 +11,76 @@ Description:
     ??
 """
 
+import os
 import warnings
-import struct
 import math
 import time
 import threading
-import serial
+import select
 import queue
 import random
-from typing import Union
+import itertools
+import numpy as np
+from concurrent import futures
+from concurrent.futures import Future
+from typing import Union, Iterable
 from pathlib import Path
-from copy import deepcopy
 
 warnings.filterwarnings("ignore")
 
-from definition_file_parser import parse_definitions_file
+from motor_protocol import load_protocol, Protocol
+from serial_framer import SerialFramer
+from command_codec import CommandCodec
+from messages import MessageDispatcher, StatusMessage
+from telemetry import FeedbackHistory, feedback_dtype
+from serial_transport import open_transport
+from position_tracker import PositionTracker
+from rpm_solver import RpmSolver
+from command_tracker import CommandTracker, CommandTimeoutError, JobCancelledError
+from command_scheduler import CommandScheduler, CommandQueueFullError, CommandPreemptedError, COALESCED, QUEUED
+from settle_controller import SettleController
+from motor_metrics import MotorMetrics, MetricsServer
+from device_clock import DeviceClock
 
 
 class Motor:
-    def __init__(self, definitions_filepath: Path, serial_port: Union[str, None] = None):
+    def __init__(self,
+                 definitions_filepath: Union[Path, Protocol, None] = None,
+                 serial_port: Union[str, None] = None,
+                 feedback_history_length: int = 65536,
+                 command_timeout: float = 1.0,
+                 command_retries: int = 0,
+                 settle_mode: bool = False,
+                 estimate_state: bool = False,
+                 transport: Union[str, type] = 'auto',
+                 metrics: bool = True,
+                 device_timestamps: bool = False,
+                 ):
         """
         Description:
 
         Args:
+            definitions_filepath (Path): Path to the firmware definitions.h, a firmware directory or a compiled Protocol,
+                                         the firmware speaking the serial protocol is picked if None
             serial_port (str): Default serial port path as string
+            feedback_history_length (int): Number of feedback samples kept in feedback_history
+            command_timeout (float): Time to wait for the response to a command, in seconds
+            command_retries (int): Number of times a command is resent when its response doesn't arrive
+            settle_mode (bool): Measure a goto's residual on the stopped rotor and correct it slowly, see settle_controller
+            estimate_state (bool): Run every feedback sample through a StateEstimator into estimate_history
+            transport (str): 'posix' (termios, os.readv), 'pyserial', 'auto' for posix where available, or a transport class
+            metrics (bool): Count messages, commands and bytes and time decode, queueing and responses, see get_metrics
+            device_timestamps (bool): Ask the firmware for sample times once connected, see enable_device_timestamps
         """
         # Serial settings
         self.serial_port_name = serial_port
+        self.transport = transport
 
-        definitions = parse_definitions_file(definitions_filepath)
+        # Compiled once per header contents and cached on disk, see motor_protocol
+        definitions = load_protocol(definitions_filepath).require_serial()
+        self.definitions = definitions
 
         self.baud_rate = definitions['serial_settings']['BAUD_RATE']
-        self.byte_STX = struct.pack('!B', definitions['serial_settings']['STX'])
 
         self.STX = definitions['serial_settings']['STX']
         self.ETX = definitions['serial_settings']['ETX']
@@ -74,6 +112,7 @@ class Motor:
         # message_types
         self.motor_status_message_id = definitions['message_types']['MOTOR_STATUS_MESSAGE_ID']
         self.motor_feedback_message_id = definitions['message_types']['MOTOR_FEEDBACK_MESSAGE_ID']
+        self.motor_feedback_batch_message_id = definitions['message_types'].get('MOTOR_FEEDBACK_BATCH_MESSAGE_ID')
         self.motor_in_fault_message_id = definitions['message_types']['MOTOR_FAULT_MESSAGE_ID']
         self.response_message_id = definitions['message_types']['RESPONSE_MESSAGE_ID']
         self.job_complete_message_id = definitions['message_types']['JOB_COMPLETE_MESSAGE_ID']
@@ -81,6 +120,10 @@ class Motor:
 
         self.command_dict = definitions['command_types']
         self.response_dict = definitions['response_types']
+        self.codec = CommandCodec(definitions)
+
+        # Every command sent gets a future resolved by its RESPONSE message
+        self.command_tracker = CommandTracker(definitions, timeout=command_timeout, retries=command_retries)
 
         self.microsteps = [1, 2, 4, 8, 16, 32]
         self.minimum_pulse_interval_us = definitions['motor_settings']['MINIMUM_PULSE_INTERVAL']
@@ -90,45 +133,111 @@ class Motor:
         max_motor_rpm = (self.max_pulses_per_second / self.motor_pulses_per_revolution) * 60
         self.max_motor_rpm_list = [max_motor_rpm / j for j in self.microsteps]
 
+        # Speed to (microstep, pulse interval) conversions are table driven and cached
+        self.rpm_solver = RpmSolver(definitions)
+
         self.job_active = False
         self.job_pending = False
         self.job_response_code = -1
-        self.status_job_id = 0
         self.commanded_job_type = 0
         self.requested_job = 0
         self.current_job_id = 0
-        self.status_message_dict = {"job_id": 0,
-                                    "status": {
-                                        "direction" : True,
-                                        "fault": False,
-                                        "paused": False,
-                                        "using_ramping": False,
-                                        "enabled": False,
-                                        "running": False,
-                                        "sleeping": False
-                                    },
-                                    "microstep": 1,
-                                    "pulses_remaining": 0}
         self.at_commanded_position = True
         self.commanded_position = 0.0
+        self.commanded_count = 0
         self.commanded_speed = 10.0
-        self.current_motor_velocity = 0.0
-        self.current_motor_position = 0.0
-        self.current_motor_encoder_count = 0
-
-        # Incoming messages don't include header or footer bytes
-        self.motor_status_message_struct = struct.Struct('<4BLB')  # {MOTOR_STATUS_MESSAGE_ID, motor.status_byte, motor.status_variables.job_id, motor.status_variables.microstep, motor.status_variables.pulses_remaining, ETX}
-        self.motor_feedback_message_struct = struct.Struct('<B2fhB')  # {MOTOR_FEEDBACK_MESSAGE_ID, motor.encoder_status.velocity_radians, motor.encoder.angle_radians, motor.encoder_status.angle_count, ETX}
-        self.motor_in_fault_message_struct = struct.Struct('<2B')  # {MOTOR_FAULT_MESSAGE_ID, ETX};
-        self.response_message_struct = struct.Struct('<6B')  # {RESPONSE_MESSAGE_ID, COMMAND, JOB_ID, RESPONSE, [ACK or NAK], ETX};
-        self.job_complete_message_struct = struct.Struct('<3B')  # {JOB_COMPLETE_MESSAGE_ID, motor.status_variables.job_id, ETX}
-        self.job_cancelled_message_struct = struct.Struct('<3B')  # {JOB_CANCELLED_MESSAGE_ID, motor_ptr.status_variables.job_id, ETX};
-
-        self.send_queue = queue.Queue(maxsize=20)
+        self.last_job_id = 0
+
+        # Velocity the running job steps at in rad/s, None while ramping or paused
+        self.requested_velocity = None
+        self.commanded_velocity = 0.0
+
+        # Jobs queued with run_job_sequence, the next one is sent from the JOB_COMPLETE handler
+        self.job_sequence = None
+        self.job_sequence_future = None
+        self.job_sequence_count = 0
+        self.job_sequence_lock = threading.RLock()
+
+        # Every feedback message is stored with its host time.monotonic() arrival time
+        self.feedback_history = FeedbackHistory(capacity=feedback_history_length)
+        self.position_tracker = PositionTracker(self.encoder_pulses_per_revolution)
+
+        # Firmware micros() of timestamped feedback mapped onto time.monotonic(), see enable_device_timestamps
+        feedback_interval_us = definitions.get('schedule_settings', {}).get('MOTOR_FEEDBACK_INTERVAL_US', 10000)
+        self.device_clock = DeviceClock(nominal_interval_us=feedback_interval_us)
+        self.device_timestamps = device_timestamps
+        self.device_timestamps_enabled = False
+
+        # Feedback samples the firmware packs into each frame and their interval, see set_feedback_batch
+        self.feedback_batch_size = 1
+        self.feedback_interval_us = feedback_interval_us
+
+        # Off target gotos are corrected from the live feedback once the rotor has stopped
+        self.settle_mode = settle_mode
+        self.settle_controller = SettleController(definitions)
+
+        # Optional filtered position, velocity and acceleration, in radians of the unwrapped count
+        self.state_estimator = None
+        self.estimate_history = None
+
+        if estimate_state:
+            # Only imported when used, keeps start up short for processes that don't
+            from state_estimator import StateEstimator, estimate_dtype
+
+            self.state_estimator = StateEstimator(self.encoder_pulses_per_revolution)
+            self.estimate_history = FeedbackHistory(capacity=feedback_history_length, dtype=estimate_dtype)
+
+        # Decoded messages are dispatched through a table keyed by message id
+        self.dispatcher = MessageDispatcher(definitions)
+        self.status_message = StatusMessage(0, 0, 1, 0, self.dispatcher.status_bits)
+        self.dispatcher.register_handler(self.motor_status_message_id, self.process_status_message)
+        self.dispatcher.register_handler(self.motor_feedback_message_id, self.process_feedback_message)
+
+        if self.motor_feedback_batch_message_id is not None:
+            self.dispatcher.register_handler(self.motor_feedback_batch_message_id, self.process_feedback_batch_message)
+
+        self.dispatcher.register_handler(self.motor_in_fault_message_id, self.process_fault_message)
+        self.dispatcher.register_handler(self.response_message_id, self.process_response_message)
+        self.dispatcher.register_handler(self.job_complete_message_id, self.process_job_complete_message)
+        self.dispatcher.register_handler(self.job_cancelled_message_id, self.process_job_cancelled_message)
+
+        # Feedback is handled straight away in the read thread, everything else goes through receive_queue
+        self.inline_message_ids = {self.motor_feedback_message_id}
+
+        if self.motor_feedback_batch_message_id is not None:
+            self.inline_message_ids.add(self.motor_feedback_batch_message_id)
+
+        self.job_sequence_message_ids = {self.response_message_id, self.job_complete_message_id, self.job_cancelled_message_id}
+        self.dispatch_inline = False
+
+        self.framer = SerialFramer(stx=self.STX, etx=self.ETX)
+
+        # Every frame sent and received is written here when recording, see start_recording
+        self.recorder = None
+
+        # Called with every received message buffer before it is decoded, e.g. MotorDaemon forwarding raw frames
+        self.frame_taps = ()
+
+        # Frames waiting to be written, stops first, see CommandScheduler
+        self.command_scheduler = CommandScheduler(definitions)
+        self.command_notifier = None
+
+        # With a selectable transport the read thread sleeps in select() on the port and this pipe, see wait_for_io
+        self.wake_read_fd = None
+        self.wake_write_fd = None
+        self.wake_pending = False
+
+        # Longest select() while no command waits on a response, arriving bytes and queued commands end it early
+        self.idle_wait_timeout = 0.1
+
         self.receive_queue = queue.Queue(maxsize=20)
+
+        # Counters and latency histograms, None turns the instrumentation off, see motor_metrics
+        self.metrics = MotorMetrics(definitions, self.framer, self.command_scheduler, self.command_tracker) if metrics else None
+        self.metrics_server = None
+
         self.read_thread = None
         self.updating_thread = None
-        self.read_lock = threading.Lock()
         self.running = False
         self.ser = None
         self.connected = False
@@ -144,6 +253,12 @@ class Motor:
         self.connect_serial_port()
 
         if self.ser is not None:
+            if getattr(self.ser, 'selectable', False) and self.command_notifier is None:
+                self.wake_read_fd, self.wake_write_fd = os.pipe()
+                os.set_blocking(self.wake_read_fd, False)
+                os.set_blocking(self.wake_write_fd, False)
+                self.command_notifier = self.wake_read_loop
+
             self.running = True
             self.read_thread = threading.Thread(target=self.serial_read_loop, daemon=True)
             self.read_thread.start()
@@ -151,21 +266,103 @@ class Motor:
             self.updating_thread = threading.Thread(target=self.processing_loop, daemon=True)
             self.updating_thread.start()
 
+            if self.device_timestamps:
+                self.enable_device_timestamps()
+
 
     def stop(self):
         print("\nShutting down motor...")
-        self.send_cancel_job()
-        self.send_sleep_motor()
+
+        # A disable drops whatever is still queued before it, so it waits for the cancel and sleep to be answered
+        futures.wait((self.send_cancel_job(), self.send_sleep_motor()), timeout=0.5)
         self.send_disable_motor()
         time.sleep(0.5)
 
         self.running = False
+
+        if self.wake_read_fd is not None:
+            self.wake_read_loop()
+
         self.read_thread.join()
         self.updating_thread.join()
         self.ser.close()
+        self.command_scheduler.clear()
+        self.command_tracker.cancel_all()
+        self.stop_recording()
+        self.stop_metrics_server()
+
+        if self.wake_read_fd is not None:
+            self.command_notifier = None
+            os.close(self.wake_read_fd)
+            os.close(self.wake_write_fd)
+            self.wake_read_fd = None
+            self.wake_write_fd = None
 
         print("Complete")
 
+    def start_recording(self, directory: Path, prefix: Union[str, None] = None, capacity: int = 1 << 20, max_files: Union[int, None] = None):
+        """
+        Description:
+            Records every frame sent and received from now on, see TelemetryRecorder.
+
+        Args:
+            directory (Path): Folder the recording files are written to
+            prefix (str): File name prefix, defaults to the serial port name
+            capacity (int): Records per file before moving on to the next
+            max_files (int): Oldest files are deleted beyond this number, None keeps every file
+
+        Returns:
+            recorder: (TelemetryRecorder)
+        """
+        if prefix is None:
+            prefix = Path(str(self.serial_port_name)).name
+
+        self.stop_recording()
+
+        from telemetry_recorder import TelemetryRecorder
+
+        self.recorder = TelemetryRecorder(self.definitions, directory, prefix=prefix, capacity=capacity, max_files=max_files)
+        return self.recorder
+
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+
+        if recorder is not None:
+            recorder.close()
+
+    def get_metrics(self):
+        """
+        Description:
+            Snapshot of the counters, queue high-water marks and latency percentiles, see MotorMetrics.snapshot.
+
+        Returns:
+            snapshot: (dict) None when the motor was created with metrics=False
+        """
+        return self.metrics.snapshot() if self.metrics is not None else None
+
+    def start_metrics_server(self, port: int = 0, host: str = '127.0.0.1'):
+        """
+        Description:
+            Serves the metrics as Prometheus style text on http://host:port/metrics, port 0 picks a free port.
+
+        Returns:
+            server: (MetricsServer) server.port is the bound port
+        """
+        if self.metrics is None:
+            raise RuntimeError("Motor was created with metrics=False")
+
+        self.stop_metrics_server()
+        self.metrics_server = MetricsServer({str(self.serial_port_name): self.metrics}, host=host, port=port)
+        return self.metrics_server
+
+    def stop_metrics_server(self):
+        metrics_server = self.metrics_server
+        self.metrics_server = None
+
+        if metrics_server is not None:
+            metrics_server.close()
+
     def connect_serial_port(self):
         """
         Description:
@@ -175,7 +372,7 @@ class Motor:
             print(f"Trying to connect serial...")
 
             try:
-                self.ser = serial.Serial(self.serial_port_name, self.baud_rate, timeout=2, )
+                self.ser = open_transport(self.transport, self.serial_port_name, self.baud_rate, timeout=2)
                 if self.ser.isOpen():
                     self.connected = True
                     print(f"Serial connected")
@@ -202,70 +399,241 @@ class Motor:
         while self.running:
             # A check to see if serial port is open
             if self.ser.isOpen():
-                new_message_id = 1
-
-                while new_message_id != 0:
-                    new_message_id, serial_buffer = self.get_serial_message()
-
-                    if new_message_id == self.motor_feedback_message_id:
-                        feedback_message = self.motor_feedback_message_struct.unpack(serial_buffer)
-
-                        with self.read_lock:
-                            self.current_motor_velocity = feedback_message[1]
-                            self.current_motor_position = feedback_message[2]
-                            self.current_motor_encoder_count = feedback_message[3]
-
-                    else:
-                        try:
-                            self.receive_queue.put({"id": new_message_id,
-                                                    "msg": serial_buffer})
-                        except queue.Full:
-                            new_message_id = 0
-                            print(f'Receive queue is full')
-
-                        except Exception as e:
-                            new_message_id = 0
-                            print(f'Exception {e}')
-
                 try:
-                    new_message = self.send_queue.get(timeout=0.001)
-                    self.ser.write(new_message)
+                    self.read_serial_messages()
+                    self.check_command_deadlines()
 
-                except queue.Empty:
-                    pass
+                    if not self.write_serial_messages():
+                        # Deadlines are only checked on wakeups, so poll while a response is outstanding
+                        if self.wake_read_fd is None or self.command_tracker.pending_count:
+                            self.wait_for_io(timeout=0.001)
+                        else:
+                            self.wait_for_io(timeout=self.idle_wait_timeout)
 
                 except Exception as e:
                     print(f'Exception {e}')
 
+                    if self.metrics is not None:
+                        self.metrics.loop_exceptions += 1
+
             else:
                 self.ser.close()
                 self.connected = False
                 self.connect_serial_port()
 
-            time.sleep(0.0001)
+            if self.wake_read_fd is None:
+                time.sleep(0.0001)
 
         self.ser.close()
 
+    def wait_for_io(self, timeout: float):
+        """
+        Description:
+            Sleeps until a byte arrives, a command is queued or the timeout passes. Selectable transports wait in
+            select() on the port and the wake pipe so arriving bytes wake the thread at once, others wait on the
+            command scheduler.
+        """
+        if self.wake_read_fd is None or not self.ser.is_open:
+            self.command_scheduler.wait(timeout=timeout)
+            return
+
+        readable, _, _ = select.select((self.ser.fileno(), self.wake_read_fd), (), (), timeout)
+
+        if self.wake_read_fd in readable:
+            try:
+                os.read(self.wake_read_fd, 4096)
+
+            except BlockingIOError:
+                pass
+
+            # Cleared before the scheduler is drained, so a command queued after this wakes the next select
+            self.wake_pending = False
+
+    def wake_read_loop(self, motor=None):
+        if self.wake_pending:
+            return
+
+        wake_write_fd = self.wake_write_fd
+
+        # Closed by stop()
+        if wake_write_fd is None:
+            return
+
+        self.wake_pending = True
+
+        try:
+            os.write(wake_write_fd, b'\x00')
+
+        except OSError:
+            pass
+
+    def read_serial_messages(self):
+        """
+        Description:
+            Reads and decodes every complete message waiting on the serial port.
+            Messages in inline_message_ids, or every message when dispatch_inline is set, are dispatched
+            straight away. The rest are put on receive_queue for processing_loop.
+        """
+        metrics = self.metrics
+        new_message_id, serial_buffer = self.get_serial_message()
+
+        while new_message_id != 0:
+            recorder = self.recorder
+
+            if recorder is not None:
+                recorder.record_received(serial_buffer)
+
+            for frame_tap in self.frame_taps:
+                frame_tap(serial_buffer)
+
+            decode_start = time.perf_counter_ns()
+            new_message = self.dispatcher.decode(new_message_id, serial_buffer)
+
+            if metrics is not None:
+                metrics.record_received(new_message_id,
+                                        new_message is not None,
+                                        time.perf_counter_ns() - decode_start,
+                                        new_message is None and new_message_id in self.dispatcher.decoders,
+                                        )
+
+            if new_message is not None:
+                if self.dispatch_inline or new_message_id in self.inline_message_ids:
+                    self.dispatcher.dispatch(new_message_id, new_message)
+
+                else:
+                    try:
+                        self.receive_queue.put((new_message_id, new_message, time.perf_counter_ns()))
+
+                        if metrics is not None:
+                            metrics.record_queued(self.receive_queue.qsize())
+
+                    except queue.Full:
+                        print(f'Receive queue is full')
+
+                        if metrics is not None:
+                            metrics.receive_queue_dropped += 1
+
+                        break
+
+                    except Exception as e:
+                        print(f'Exception {e}')
+
+                        if metrics is not None:
+                            metrics.loop_exceptions += 1
+
+                        break
+
+            new_message_id, serial_buffer = self.get_serial_message()
+
     def get_serial_message(self):
         """
         Description:
-            Checks if serial buffer contains new data, looks for standard AT protocol message.
+            Returns the next standard AT protocol message from the framer, when no complete message is buffered
+            everything waiting in the serial buffer is read in one go.
             Valid message has the following byte structure STX, length, data, ETX. data[0] is the message id
 
         Returns:
             message id: (int) message identifier
-            message buffer: (bytes) message contents
+            message buffer: (memoryview) message contents, only valid until the next read
+        """
+        message_id, serial_buffer = self.framer.next_frame()
+
+        if message_id == 0:
+            if self.ser.fill_framer(self.framer) > 0:
+                message_id, serial_buffer = self.framer.next_frame()
+
+            if message_id == 0:
+                return 0, []
+
+        return message_id, serial_buffer
+
+    def send_command(self, frame: bytes, timeout: Union[float, None] = None, retries: Union[int, None] = None):
+        """
+        Description:
+            Registers the command with command_tracker, then hands the encoded frame to the serial thread,
+            or to whatever loop set command_notifier. Commands can be pipelined, each response is matched
+            on (command, job id) rather than on the last command sent.
+
+        Args:
+            frame (bytes): Encoded command frame
+            timeout (float): Time to wait for the response, command_tracker's default if None
+            retries (int): Number of resends before the future times out, command_tracker's default if None
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to the ResponseMessage, raises MotorCommandError on NAK
+                    or CommandTimeoutError when no response arrives
+        """
+        return self.queue_command(frame, self.command_tracker.track(frame, timeout=timeout, retries=retries))
+
+    def queue_command(self, frame: bytes, future: Union[Future, None] = None):
+        """
+        Description:
+            Hands a frame to command_scheduler without blocking. A command identical to one still waiting shares
+            its future, a full queue sets CommandQueueFullError on the returned future.
+        """
+        status, queued_future = self.command_scheduler.submit(frame, Future() if future is None else future)
+
+        if status == COALESCED and future is not None:
+            future.cancel()
+
+        elif status == QUEUED and self.command_notifier is not None:
+            self.command_notifier(self)
+
+        return queued_future
+
+    def check_command_deadlines(self):
+        """
+        Description:
+            Resends or times out commands without a response, called from the loop that owns the serial port.
         """
-        if self.ser.inWaiting() != 0:
-            if self.ser.read() == self.byte_STX:
-                message_length = self.ser.read()
+        self.command_tracker.check_deadlines(self.write_frame)
 
-                serial_buffer = self.ser.read(int.from_bytes(message_length, "little") - 2)
+    def write_frame(self, frame: bytes):
+        self.ser.write(frame)
+        recorder = self.recorder
 
-                if serial_buffer[-1] == self.ETX:
-                    return serial_buffer[0], serial_buffer
+        if self.metrics is not None:
+            self.metrics.record_sent(frame)
 
-        return 0, []
+        if recorder is not None:
+            recorder.record_sent(frame)
+
+    def write_frames(self, frames: list):
+        self.ser.write(frames[0] if len(frames) == 1 else b''.join(frames))
+        recorder = self.recorder
+        metrics = self.metrics
+
+        if metrics is not None:
+            for frame in frames:
+                metrics.record_sent(frame)
+
+        if recorder is not None:
+            for frame in frames:
+                recorder.record_sent(frame)
+
+    def write_serial_messages(self):
+        """
+        Description:
+            Writes every command waiting in command_scheduler with one write, in the order they were sent.
+
+        Returns:
+            written: (bool) any frame was written
+        """
+        frames = self.command_scheduler.drain()
+
+        if not frames:
+            return False
+
+        try:
+            self.write_frames(frames)
+
+        except Exception as e:
+            print(f'Exception {e}')
+
+            if self.metrics is not None:
+                self.metrics.loop_exceptions += 1
+
+        return True
 
     def send_motor_rotations_at_set_rpm(self,
                                         number_or_rotations: Union[float, int],
@@ -277,43 +645,24 @@ class Motor:
                                         job_id: int = 0,
                                         ):
 
-            if rpm < 0:
+            if rpm <= 0:
                 return -1
 
-            elif rpm > self.max_motor_rpm_list[0]:
-                required_pulses = int(abs(number_or_rotations) * self.motor_pulses_per_revolution)
-                return self.send_motor_pulses(direction=direction,
-                                              microstep=1,
-                                              pulses=required_pulses,
-                                              pulse_interval=self.minimum_pulse_interval_us,
-                                              pulse_on_period=self.default_pulse_on_period,
-                                              use_ramping=use_ramping,
-                                              ramping_steps=ramping_steps,
-                                              ramp_scaler=ramp_scaler,
-                                              job_id=job_id,
-                                              )
+            best_step_choice, pulse_interval, _, _ = self.rpm_solver.solve(rpm)
+            required_pulses = int(abs(number_or_rotations) * self.motor_pulses_per_revolution) * best_step_choice
 
-            else:
-                best_step_choice = 1
-                for (m_step, max_rpms) in zip(self.microsteps, self.max_motor_rpm_list):
-                    if rpm < max_rpms:
-                        best_step_choice = m_step
-
-                pulse_interval = int((1 / ((rpm / 60) * self.motor_pulses_per_revolution * best_step_choice)) * 1e6)
-                required_pulses = int(abs(number_or_rotations) * self.motor_pulses_per_revolution) * best_step_choice
-
-                # print(f"{pulse_interval=} uS, {required_pulses=}, {best_step_choice=}")
-
-                return self.send_motor_pulses(direction=direction,
-                                              microstep=best_step_choice,
-                                              pulses=required_pulses,
-                                              pulse_interval=pulse_interval,
-                                              pulse_on_period=self.default_pulse_on_period,
-                                              use_ramping=use_ramping,
-                                              ramping_steps=ramping_steps,
-                                              ramp_scaler=ramp_scaler,
-                                              job_id=job_id,
-                                              )
+            # print(f"{pulse_interval=} uS, {required_pulses=}, {best_step_choice=}")
+
+            return self.send_motor_pulses(direction=direction,
+                                          microstep=best_step_choice,
+                                          pulses=required_pulses,
+                                          pulse_interval=pulse_interval,
+                                          pulse_on_period=self.default_pulse_on_period,
+                                          use_ramping=use_ramping,
+                                          ramping_steps=ramping_steps,
+                                          ramp_scaler=ramp_scaler,
+                                          job_id=job_id,
+                                          )
 
     def send_motor_pulses_at_set_rpm(self,
                                      rpm: Union[float, int],
@@ -325,38 +674,21 @@ class Motor:
                                      job_id: int = 0,
                                      ):
 
-        if rpm < 0:
+        if rpm <= 0:
             return -1
 
-        elif rpm > self.max_motor_rpm_list[0]:
-            return self.send_motor_pulses(direction=direction,
-                                          microstep=1,
-                                          pulses=pulses,
-                                          pulse_interval=self.minimum_pulse_interval_us,
-                                          use_ramping=use_ramping,
-                                          ramping_steps=ramping_steps,
-                                          ramp_scaler=ramp_scaler,
-                                          job_id=job_id,
-                                          )
+        best_step_choice, pulse_interval, _, _ = self.rpm_solver.solve(rpm)
 
-        else:
-            best_step_choice = 1
-            for (m_step, max_rpms) in zip(self.microsteps, self.max_motor_rpm_list):
-                if rpm < max_rpms:
-                    best_step_choice = m_step
-
-            pulse_interval = int((1 / ((rpm / 60) * self.motor_pulses_per_revolution * best_step_choice)) * 1e6)
-
-            return self.send_motor_pulses(direction=direction,
-                                          microstep=best_step_choice,
-                                          pulses=pulses,
-                                          pulse_interval=pulse_interval,
-                                          pulse_on_period=self.default_pulse_on_period,
-                                          use_ramping=use_ramping,
-                                          ramping_steps=ramping_steps,
-                                          ramp_scaler=ramp_scaler,
-                                          job_id=job_id,
-                                          )
+        return self.send_motor_pulses(direction=direction,
+                                      microstep=best_step_choice,
+                                      pulses=pulses,
+                                      pulse_interval=pulse_interval,
+                                      pulse_on_period=self.default_pulse_on_period,
+                                      use_ramping=use_ramping,
+                                      ramping_steps=ramping_steps,
+                                      ramp_scaler=ramp_scaler,
+                                      job_id=job_id,
+                                      )
 
     def send_motor_rotations(self,
                              number_or_rotations: Union[float, int],
@@ -373,7 +705,7 @@ class Motor:
         m_step = microstep if microstep in self.microsteps else 1
         required_pulses = int(abs(number_or_rotations) * self.motor_pulses_per_revolution) * m_step
 
-        self.send_motor_pulses(direction=direction,
+        return self.send_motor_pulses(direction=direction,
                                microstep=m_step,
                                pulses=required_pulses,
                                pulse_interval=pulse_interval,
@@ -394,73 +726,128 @@ class Motor:
                                     job_id: int = 0,
                                     is_adjustment: bool = False,
                                     ):
+        """
+        Description:
+            Moves to an angle within one revolution, turning in the given direction. Adjustments take the shortest way.
+            The move is worked out in encoder counts and sent as one job to the matching absolute count.
+        """
+        if rpm <= 0:
+            return -1
 
-        if rpm < 0:
+        if self.motor_is_at_target(desired_position):
+            print(f"Rotor already at correct position")
+            self.job_active = False
+            self.at_commanded_position = True
             return -1
 
-        elif rpm > self.max_motor_rpm_list[0]:
-            best_step_choice = self.microsteps[0]
-            pulse_interval = self.minimum_pulse_interval_us
+        current_angle_count = self.position_tracker.absolute_count % self.encoder_pulses_per_revolution
+        target_angle_count = self.position_tracker.counts_from_radians(desired_position) % self.encoder_pulses_per_revolution
 
+        if is_adjustment:
+            delta_count = self.position_tracker.wrapped_difference(current_angle_count, target_angle_count)
+        elif direction:
+            delta_count = (target_angle_count - current_angle_count) % self.encoder_pulses_per_revolution
         else:
-            best_step_choice  = 1
-            for (m_step, max_rpms) in zip(self.microsteps, self.max_motor_rpm_list):
-                if rpm < max_rpms:
-                    best_step_choice = m_step
+            delta_count = -((current_angle_count - target_angle_count) % self.encoder_pulses_per_revolution)
 
-            pulse_interval = int((1 / ((rpm / 60) * self.motor_pulses_per_revolution * best_step_choice)) * 1e6)
+        self.commanded_position = desired_position
 
-        current_motor_position = self.get_rotor_position()
-
-        if not self.motor_is_at_target(desired_position):
-            self.at_commanded_position = False
-            self.commanded_speed = rpm
-            self.commanded_position = desired_position
-
-            if not is_adjustment:
-                if direction:
-                    if desired_position >= current_motor_position:
-                        delta_position = desired_position - current_motor_position
-                    else:
-                        delta_position = self.two_pi - (current_motor_position - desired_position)
-                else:
-                    if desired_position <= current_motor_position:
-                        delta_position = current_motor_position - desired_position
-                    else:
-                        delta_position = self.two_pi - (desired_position - current_motor_position)
-
-            else:
-                delta_position = abs(desired_position - current_motor_position)
-                direction = desired_position >= current_motor_position
+        return self.goto_encoder_count(target_count=self.position_tracker.absolute_count + delta_count,
+                                       rpm=rpm,
+                                       use_ramping=use_ramping,
+                                       ramping_steps=ramping_steps,
+                                       ramp_scaler=ramp_scaler,
+                                       job_id=job_id,
+                                       )
 
-            number_or_rotations = delta_position / self.two_pi
-            required_pulses = int(number_or_rotations * self.motor_pulses_per_revolution) * best_step_choice
+    def goto_absolute_position_radians(self,
+                                       desired_position: float,
+                                       rpm: Union[float, int],
+                                       use_ramping: bool = False,
+                                       ramping_steps: int = 0,
+                                       ramp_scaler: Union[int, None] = None,
+                                       job_id: int = 0,
+                                       ):
+        """
+        Description:
+            Multi-turn move to a position measured from the position_tracker origin, e.g. 6 * pi is three turns
+            from the origin whichever way the rotor has turned since. Sent as one job.
+        """
+        if rpm <= 0:
+            return -1
 
-            # print(f"{self.get_rotor_position():.3f}, {self.commanded_position=}, {delta_position=}, {required_pulses=}, {best_step_choice=}")
+        self.commanded_position = desired_position % self.two_pi
 
-            if required_pulses > 0:
-                self.send_motor_pulses(direction=direction,
-                                       microstep=best_step_choice,
-                                       pulses=required_pulses,
-                                       pulse_interval=pulse_interval,
-                                       pulse_on_period=self.default_pulse_on_period,
+        return self.goto_encoder_count(target_count=self.position_tracker.counts_from_radians(desired_position),
+                                       rpm=rpm,
                                        use_ramping=use_ramping,
                                        ramping_steps=ramping_steps,
                                        ramp_scaler=ramp_scaler,
                                        job_id=job_id,
                                        )
-            else:
-                print(f"Job with zero pulses requested")
-                self.job_active = False
-                self.at_commanded_position = True
-                return -1
 
-        else:
+    def goto_encoder_count(self,
+                           target_count: int,
+                           rpm: Union[float, int],
+                           use_ramping: bool = False,
+                           ramping_steps: int = 0,
+                           ramp_scaler: Union[int, None] = None,
+                           job_id: int = 0,
+                           ):
+        """
+        Description:
+            Moves to an absolute (unwrapped) encoder count. The pulse count is rounded from the distance in counts at
+            the chosen microstep, so a long move isn't cut short by truncation to whole steps.
+
+        Args:
+            target_count (int): Absolute encoder count, see position_tracker.absolute_count
+            rpm (float): Motor speed
+
+        Returns:
+            future: (concurrent.futures.Future) job command response, -1 if no job was sent
+        """
+        if rpm <= 0:
+            return -1
+
+        # A new goto replaces any settle still in progress
+        if self.settle_controller.active:
+            self.settle_controller.cancel()
+
+        best_step_choice, pulse_interval, _, _ = self.rpm_solver.solve(rpm)
+        delta_count = target_count - self.position_tracker.absolute_count
+
+        self.commanded_count = target_count
+        self.commanded_speed = rpm
+
+        if abs(delta_count) < self.encoder_setpoint_tolerance:
             print(f"Rotor already at correct position")
             self.job_active = False
             self.at_commanded_position = True
             return -1
 
+        required_pulses = round(abs(delta_count) * self.motor_pulses_per_revolution * best_step_choice / self.encoder_pulses_per_revolution)
+
+        # print(f"{self.position_tracker.absolute_count=}, {target_count=}, {delta_count=}, {required_pulses=}, {best_step_choice=}")
+
+        if required_pulses > 0:
+            self.at_commanded_position = False
+
+            return self.send_motor_pulses(direction=delta_count > 0,
+                                          microstep=best_step_choice,
+                                          pulses=required_pulses,
+                                          pulse_interval=pulse_interval,
+                                          pulse_on_period=self.default_pulse_on_period,
+                                          use_ramping=use_ramping,
+                                          ramping_steps=ramping_steps,
+                                          ramp_scaler=ramp_scaler,
+                                          job_id=job_id,
+                                          )
+        else:
+            print(f"Job with zero pulses requested")
+            self.job_active = False
+            self.at_commanded_position = True
+            return -1
+
     def send_motor_pulses(self,
                           direction: bool,
                           microstep: int = 1,
@@ -473,230 +860,543 @@ class Motor:
                           job_id: int = 0,
                           **kwargs):
 
-        if pulse_on_period is None:  # Basic send job
-            if not use_ramping:
-                command = self.command_dict['SEND_JOB']
-                self.send_queue.put(struct.pack('!6BIB',
-                                                self.STX,
-                                                11,
-                                                command,
-                                                1 if direction else 0,
-                                                microstep if microstep in self.microsteps else 1,
-                                                job_id,
-                                                pulses,
-                                                self.ETX
-                                                ))
-            else:
-                command = self.command_dict['SEND_JOB_WITH_RAMPING']
-                self.send_queue.put(struct.pack('!6B2IB',
-                                                self.STX,
-                                                15,
-                                                command,
-                                                1 if direction else 0,
-                                                microstep if microstep in self.microsteps else 1,
-                                                job_id,
-                                                pulses,
-                                                ramping_steps,
-                                                self.ETX
-                                                )) 
-        else:
-            if not use_ramping:
-                command = self.command_dict['SEND_JOB_ALL_VARIABLES']
-                self.send_queue.put(struct.pack('!6B3IB',
-                                                self.STX,
-                                                19,
-                                                command,
-                                                1 if direction else 0,
-                                                microstep if microstep in self.microsteps else 1,
-                                                job_id,
-                                                pulses,
-                                                pulse_interval if pulse_interval >self.minimum_pulse_interval_us else self.minimum_pulse_interval_us,
-                                                pulse_on_period,
-                                                self.ETX
-                                                ))
-            else:
-                if ramp_scaler is None:
-                    command = self.command_dict['SEND_JOB_ALL_VARIABLES_WITH_RAMPING']
-                    self.send_queue.put(struct.pack('!6B4IB',
-                                                    self.STX,
-                                                    23,
-                                                    command,
-                                                    1 if direction else 0,
-                                                    microstep if microstep in self.microsteps else 1,
-                                                    job_id,
-                                                    pulses,
-                                                    pulse_interval if pulse_interval > self.minimum_pulse_interval_us else self.minimum_pulse_interval_us,
-                                                    pulse_on_period,
-                                                    ramping_steps,
-                                                    self.ETX
-                                                    ))
-                else:
-                    command = self.command_dict['SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE']
-                    self.send_queue.put(struct.pack('!6B4I2B',
-                                                    self.STX,
-                                                    24,
-                                                    command,
-                                                    1 if direction else 0,
-                                                    microstep if microstep in self.microsteps else 1,
-                                                    job_id,
-                                                    pulses,
-                                                    pulse_interval if pulse_interval > self.minimum_pulse_interval_us else self.minimum_pulse_interval_us,
-                                                    pulse_on_period,
-                                                    ramping_steps,
-                                                    ramp_scaler,
-                                                    self.ETX
-                                                    ))
-
+        command = self.codec.select_job_command(pulse_on_period=pulse_on_period,
+                                                use_ramping=use_ramping,
+                                                ramp_scaler=ramp_scaler)
+
+        self.begin_job(command=command,
+                       direction=direction,
+                       microstep=microstep,
+                       pulse_interval=pulse_interval,
+                       pulse_on_period=pulse_on_period,
+                       use_ramping=use_ramping,
+                       job_id=job_id)
+
+        return self.send_job_frame(self.codec.encode_job(command=command,
+                                                         direction=direction,
+                                                         microstep=microstep,
+                                                         job_id=job_id,
+                                                         pulses=pulses,
+                                                         pulse_interval=pulse_interval,
+                                                         pulse_on_period=pulse_on_period,
+                                                         ramping_steps=ramping_steps,
+                                                         ramp_scaler=ramp_scaler,
+                                                         ),
+                                   job_id)
+
+    def begin_job(self,
+                  command: int,
+                  direction: bool,
+                  microstep: int,
+                  pulse_interval: int,
+                  pulse_on_period: Union[int, None],
+                  use_ramping: bool,
+                  job_id: int,
+                  ):
+        """
+        Description:
+            Job bookkeeping done before a job frame is sent, the response can be processed before send_command
+            returns. Split from send_motor_pulses so frames encoded ahead of time can be sent with send_job_frame.
+        """
         self.job_active = False
         self.job_pending = True
         self.requested_job = job_id
         self.commanded_job_type = command
 
+        if use_ramping:
+            self.requested_velocity = None
+        else:
+            pulse_period_us = max(pulse_interval, self.default_pulse_on_period if pulse_on_period is None else pulse_on_period)
+            step_velocity = self.two_pi * 1e6 / (pulse_period_us * self.motor_pulses_per_revolution * microstep)
+            self.requested_velocity = step_velocity if direction else -step_velocity
+
+    def send_job_frame(self, frame: bytes, job_id: int):
+        """
+        Description:
+            Sends an encoded job frame after begin_job.
+
+        Returns:
+            future: (concurrent.futures.Future) job command response
+        """
+        future = self.send_command(frame)
+
+        if future is not None:
+            future.add_done_callback(lambda done_future: self.process_job_command_result(job_id, done_future))
+
+        return future
+
     def get_rotor_position(self):
-        with self.read_lock:
-            position = deepcopy(self.current_motor_position)
-        return position
+        return self.current_motor_position
+
+    def get_estimated_state(self, when: Union[float, None] = None):
+        """
+        Description:
+            Filtered multi-turn position from the position_tracker origin, velocity and acceleration at a
+            time.monotonic() time, now by default. Needs estimate_state.
+
+        Returns:
+            position, velocity, acceleration: (float) rad, rad/s, rad/s^2, None before the first sample
+        """
+        estimate = self.state_estimator.estimate_at(when)
+
+        if estimate is None:
+            return None
+
+        position, velocity, acceleration = estimate
+        return position - self.position_tracker.origin_count * self.radians_per_encoder_pulse, velocity, acceleration
+
+    def get_absolute_rotor_position(self):
+        """
+        Description:
+            Multi-turn rotor position in radians from the position_tracker origin.
+        """
+        return self.position_tracker.absolute_position
+
+    @property
+    def current_motor_velocity(self):
+        latest_sample = self.feedback_history.latest()
+        return 0.0 if latest_sample is None else latest_sample[1]
+
+    @property
+    def current_motor_position(self):
+        latest_sample = self.feedback_history.latest()
+        return 0.0 if latest_sample is None else latest_sample[2]
+
+    @property
+    def current_motor_encoder_count(self):
+        latest_sample = self.feedback_history.latest()
+        return 0 if latest_sample is None else latest_sample[3]
 
     def send_pause_job(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['PAUSE_JOB'],
-                                        self.ETX
-                                        ))
+        future = self.send_command(self.codec.get_static_frame('PAUSE_JOB'))
+
+        if future is not None:
+            future.add_done_callback(self.process_pause_result)
+
+        return future
 
     def send_resume_job(self):
-        self.send_queue.put(struct.pack('<4B',
-                            self.STX,
-                            4,
-                            self.command_dict['RESUME_JOB'],
-                            self.ETX
-                            ))
+        future = self.send_command(self.codec.get_static_frame('RESUME_JOB'))
+
+        if future is not None:
+            future.add_done_callback(self.process_resume_result)
+
+        return future
 
     def send_cancel_job(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['CANCEL_JOB'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('CANCEL_JOB'))
 
     def send_enable_motor(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['ENABLE_MOTOR'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('ENABLE_MOTOR'))
 
     def send_disable_motor(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['DISABLE_MOTOR'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('DISABLE_MOTOR'))
 
     def send_sleep_motor(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['SLEEP_MOTOR'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('SLEEP_MOTOR'))
 
     def send_wake_motor(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['WAKE_MOTOR'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('WAKE_MOTOR'))
 
     def send_reset_motor(self):
-        self.send_queue.put(struct.pack('<4B',
-                                        self.STX,
-                                        4,
-                                        self.command_dict['RESET_MOTOR'],
-                                        self.ETX
-                                        ))
+        return self.send_command(self.codec.get_static_frame('RESET_MOTOR'))
+
+    def send_set_timestamps(self, enabled: bool = True):
+        return self.send_command(self.codec.encode_setting('SET_TIMESTAMPS', 1 if enabled else 0))
+
+    def enable_device_timestamps(self, enabled: bool = True):
+        """
+        Description:
+            Asks the firmware to append its micros() to feedback and status messages. Firmware without
+            SET_TIMESTAMPS answers UNKNOWN_MOTOR_COMMAND_RESPONSE and keeps sending plain frames, feedback is then
+            stamped with its arrival time as before. Timestamped frames are recognised by length either way.
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to True when the firmware is sending timestamps
+        """
+        result = Future()
+
+        if not self.codec.has_command('SET_TIMESTAMPS'):
+            self.device_timestamps_enabled = False
+            result.set_result(False)
+            return result
+
+        def set_result(future):
+            acknowledged = not future.cancelled() and future.exception() is None
+            self.device_timestamps_enabled = enabled and acknowledged
+            result.set_result(self.device_timestamps_enabled)
+
+        self.send_set_timestamps(enabled).add_done_callback(set_result)
+        return result
+
+    def send_set_feedback_batch(self, batch_size: int, interval_us: int = 0):
+        return self.send_command(self.codec.encode_feedback_batch(batch_size, interval_us))
+
+    def set_feedback_batch(self, batch_size: int, interval_us: int = 0):
+        """
+        Description:
+            Asks the firmware to pack batch_size consecutive feedback samples into one MOTOR_FEEDBACK_BATCH frame,
+            cutting the frames and read thread wakeups per sample by that factor. Every sample carries its firmware
+            micros() so the batch is spread back out in time through device_clock. A batch size of 1 goes back
+            to one MOTOR_FEEDBACK frame per sample. interval_us changes the feedback interval as well, 0 keeps it,
+            e.g. set_feedback_batch(10, 1000) samples at 1 kHz and sends 100 frames a second.
+            Can be changed at any time, the partly filled batch is dropped.
+
+        Args:
+            batch_size (int): Samples per frame, 1 to MOTOR_FEEDBACK_BATCH_MAX_SAMPLES
+            interval_us (int): Feedback interval, not less than MOTOR_FEEDBACK_MINIMUM_INTERVAL_US, or 0
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to True once the firmware has acknowledged the setting
+        """
+        result = Future()
+
+        if not self.check_feedback_batch(batch_size, interval_us):
+            result.set_result(False)
+            return result
+
+        def set_result(future):
+            acknowledged = not future.cancelled() and future.exception() is None
+
+            if acknowledged:
+                self.apply_feedback_batch(batch_size, interval_us)
+
+            result.set_result(acknowledged)
+
+        self.send_set_feedback_batch(batch_size, interval_us).add_done_callback(set_result)
+        return result
+
+    def check_feedback_batch(self, batch_size: int, interval_us: int):
+        message_lengths = self.definitions.get('message_lengths', {})
+        maximum_batch_size = message_lengths.get('MOTOR_FEEDBACK_BATCH_MAX_SAMPLES', 1)
+        minimum_interval_us = self.definitions.get('schedule_settings', {}).get('MOTOR_FEEDBACK_MINIMUM_INTERVAL_US', 0)
+
+        if not self.codec.has_command('SET_FEEDBACK_BATCH'):
+            print("Firmware does not support SET_FEEDBACK_BATCH")
+            return False
+
+        if not 1 <= batch_size <= maximum_batch_size or (interval_us != 0 and interval_us < minimum_interval_us):
+            print(f"Feedback batch size must be 1 to {maximum_batch_size} and the interval 0 or at least {minimum_interval_us} us")
+            return False
+
+        return True
+
+    def apply_feedback_batch(self, batch_size: int, interval_us: int):
+        # Called once the firmware has acknowledged SET_FEEDBACK_BATCH
+        self.feedback_batch_size = batch_size
+
+        if interval_us != 0:
+            self.feedback_interval_us = interval_us
+            self.device_clock.nominal_interval_us = interval_us
 
     def motor_is_at_target(self, desired_position):
-        current_motor_position = self.get_rotor_position()
-
-        return abs(current_motor_position - desired_position) < self.encoder_setpoint_tolerance * self.radians_per_encoder_pulse
-
-    def process_status_message(self, status_message: Union[list, tuple]):
-        self.status_message_dict = {"job_id": status_message[2],
-                                    "status": {
-                                        "direction": (status_message[1] & self.status_direction_bit) > 0,
-                                        "fault": (status_message[1] & self.status_fault_bit) > 0,
-                                        "paused": (status_message[1] & self.status_paused_bit) > 0,
-                                        "using_ramping": (status_message[1] & self.status_ramping_bit) > 0,
-                                        "enabled": (status_message[1] & self.status_enabled_bit) > 0,
-                                        "running": (status_message[1] & self.status_running_bit) > 0,
-                                        "sleeping": (status_message[1] & self.status_sleep_bit) > 0,
-                                    },
-                                    "microstep": status_message[3],
-                                    "pulses_remaining": status_message[4]
-                                    }
+        # Compared in counts from the position_tracker origin like the goto itself, either side of zero are close
+        target_count = self.position_tracker.counts_from_radians(desired_position)
 
-    def processing_loop(self):
-        while self.running:
-            try:
-                new_message_dict = self.receive_queue.get(timeout=0.01)
+        return abs(self.position_tracker.wrapped_difference(self.position_tracker.absolute_count, target_count)) < self.encoder_setpoint_tolerance
+
+    def motor_is_at_count(self, target_count: int):
+        return abs(target_count - self.position_tracker.absolute_count) < self.encoder_setpoint_tolerance
 
-                if new_message_dict["id"] == self.motor_status_message_id:
-                    self.process_status_message(status_message=self.motor_status_message_struct.unpack(new_message_dict["msg"]))
+    def register_handler(self, message_id: int, handler):
+        """
+        Description:
+            Attach user code to a message type, handler(message) is called with the decoded message.
+            Feedback handlers run in the serial read thread, all others in the processing thread.
+            While a job sequence runs, response and job handlers run in the serial read thread too.
 
-                elif new_message_dict["id"] == self.motor_in_fault_message_id:
-                    fault_message = self.motor_in_fault_message_struct.unpack(new_message_dict["msg"])
-                    print(f"Motor Fault")
+        Args:
+            message_id (int): Message id from definitions.h message_types
+            handler (callable): Function taking the decoded message
+        """
+        self.dispatcher.register_handler(message_id, handler)
 
-                elif new_message_dict["id"] == self.response_message_id:
-                    response_message = self.response_message_struct.unpack(new_message_dict["msg"])
-                    # print(f"{response_message=}")
-                    if response_message[1] == self.commanded_job_type:
-                        self.commanded_job_type = 0
+    def remove_handler(self, message_id: int, handler):
+        self.dispatcher.remove_handler(message_id, handler)
 
-                        if response_message[2] == self.requested_job and response_message[4] == self.ACK:
-                            self.current_job_id = self.requested_job
-                            self.job_active = True
-                            self.job_pending = False
+    @property
+    def status_message_dict(self):
+        return self.status_message.as_dict()
 
-                        else:
-                            self.current_job_id = 0
-                            self.requested_job = 0
-                            self.job_active = False
-                            self.job_pending = False
-
-                elif new_message_dict["id"] == self.job_complete_message_id:
-                    job_complete_message = self.job_complete_message_struct.unpack(new_message_dict["msg"])
-
-                    if job_complete_message[1] == self.current_job_id:
-
-                        if not self.at_commanded_position:
-                            if self.motor_is_at_target(self.commanded_position):
-                                self.at_commanded_position = True
-                                self.job_active = False
-                                self.send_sleep_motor()
-
-                            else:
-                                self.goto_rotor_position_radians(desired_position=self.commanded_position,
-                                                                 direction=True,
-                                                                 rpm=self.commanded_speed,
-                                                                 job_id=self.current_job_id,
-                                                                 is_adjustment=True)
-                        else:
-                            self.at_commanded_position = True
-                            self.job_active = False
-                            self.send_sleep_motor()
+    def process_status_message(self, status_message: StatusMessage):
+        self.status_message = status_message
 
-                elif new_message_dict["id"] == self.job_cancelled_message_id:
-                    job_cancelled_message = self.job_cancelled_message_struct.unpack(new_message_dict["msg"])
+    def process_feedback_message(self, feedback_message):
+        timestamp = time.monotonic()
+        latency = None
 
-                    if job_cancelled_message[1] == self.current_job_id:
-                        self.job_active = False
+        # With device timestamps the sample time replaces the arrival time, free of USB batching jitter
+        if feedback_message.device_micros is not None:
+            timestamp = self.device_clock.update(feedback_message.device_micros, timestamp)
+            latency = 0.0
+
+        unwrapped_count = self.position_tracker.update(feedback_message.encoder_count)
+        self.feedback_history.append(timestamp,
+                                     feedback_message.velocity,
+                                     feedback_message.position,
+                                     feedback_message.encoder_count,
+                                     unwrapped_count)
+
+        if self.state_estimator is not None:
+            self.estimate_history.append(timestamp, *self.state_estimator.update(timestamp, unwrapped_count, self.commanded_velocity, latency))
+
+        if self.settle_controller.active:
+            self.process_settle_feedback(timestamp, feedback_message.velocity)
+
+    def process_feedback_batch_message(self, feedback_batch_message):
+        """
+        Description:
+            Stores every sample of a batch in one step. Sample times come from device_clock, the firmware's
+            micros() of each sample mapped onto time.monotonic().
+        """
+        samples = feedback_batch_message.samples
+
+        if len(samples) == 0:
+            return
+
+        timestamps = self.device_clock.update_batch(samples['device_micros'], time.monotonic())
+        unwrapped_counts = self.position_tracker.update_batch(samples['encoder_count'])
+
+        # The firmware's angle_radians is angle_count scaled to one revolution, it isn't sent in a batch
+        batch = np.empty(len(samples), dtype=feedback_dtype)
+        batch['timestamp'] = timestamps
+        batch['velocity'] = samples['velocity']
+        batch['position'] = samples['encoder_count'] * self.radians_per_encoder_pulse
+        batch['encoder_count'] = samples['encoder_count']
+        batch['unwrapped_count'] = unwrapped_counts
+        self.feedback_history.append_batch(batch)
+
+        # Already sample times, the estimator must not take its latency off again
+        if self.state_estimator is not None:
+            for timestamp, unwrapped_count in zip(timestamps.tolist(), unwrapped_counts.tolist()):
+                self.estimate_history.append(timestamp, *self.state_estimator.update(timestamp, unwrapped_count, self.commanded_velocity, 0.0))
+
+        if self.settle_controller.active:
+            self.process_settle_feedback(float(timestamps[-1]), float(samples['velocity'][-1]))
+
+    def process_settle_feedback(self, timestamp: float, velocity: float):
+        """
+        Description:
+            Runs in the serial read thread, either sends the correction for the measured residual or ends the job.
+        """
+        action = self.settle_controller.update(timestamp, self.position_tracker.absolute_count, velocity)
+
+        if action is None:
+            return
+
+        if "correction" in action:
+            future = self.send_motor_pulses(**self.settle_controller.correction_job(action["correction"]),
+                                            job_id=self.current_job_id)
+
+            if future is not None:
+                future.add_done_callback(self.process_settle_correction_result)
+
+        else:
+            self.finish_job()
+
+    def process_settle_correction_result(self, future):
+        # A rejected or unanswered correction leaves no JOB_COMPLETE to continue the settle
+        if future.cancelled() or future.exception() is not None:
+            if self.settle_controller.active:
+                self.settle_controller.cancel()
+                self.at_commanded_position = True
+                self.job_active = False
+
+    def process_fault_message(self, fault_message):
+        print(f"Motor Fault")
+
+    def process_response_message(self, response_message):
+        self.command_tracker.resolve(response_message)
+
+        if response_message.command == self.commanded_job_type:
+            self.commanded_job_type = 0
+
+            if response_message.job_id == self.requested_job and response_message.acknowledged:
+                self.current_job_id = self.requested_job
+                self.job_active = True
+                self.job_pending = False
+                self.commanded_velocity = self.requested_velocity
+
+            else:
+                self.current_job_id = 0
+                self.requested_job = 0
+                self.job_active = False
+                self.job_pending = False
+
+    def process_job_command_result(self, job_id: int, future):
+        """
+        Description:
+            A job command that was never answered must not leave job_pending set forever.
+        """
+        if future.cancelled() or isinstance(future.exception(), (CommandTimeoutError, CommandQueueFullError, CommandPreemptedError)):
+            if self.job_pending and self.requested_job == job_id:
+                self.requested_job = 0
+                self.commanded_job_type = 0
+                self.job_pending = False
+
+    def process_pause_result(self, future):
+        # A paused motor is known to be stopped
+        if not future.cancelled() and future.exception() is None and self.job_active:
+            self.commanded_velocity = 0.0
+
+    def process_resume_result(self, future):
+        if not future.cancelled() and future.exception() is None and self.job_active:
+            self.commanded_velocity = self.requested_velocity
+
+    def process_job_complete_message(self, job_complete_message):
+        self.commanded_velocity = 0.0
+
+        if job_complete_message.job_id == self.current_job_id:
+
+            if not self.at_commanded_position:
+                if self.settle_mode:
+                    self.settle_controller.start(self.commanded_count)
+
+                elif self.motor_is_at_count(self.commanded_count):
+                    self.finish_job()
+
+                else:
+                    self.goto_encoder_count(target_count=self.commanded_count,
+                                            rpm=self.commanded_speed,
+                                            job_id=self.current_job_id)
+            else:
+                self.finish_job()
+
+    def finish_job(self):
+        """
+        Description:
+            The motor is only put to sleep when no queued job follows, so back to back jobs need no wake.
+        """
+        with self.job_sequence_lock:
+            self.at_commanded_position = True
+            self.job_active = False
+
+            if self.job_sequence is None or not self.send_next_sequenced_job():
+                self.send_sleep_motor()
+
+    def process_job_cancelled_message(self, job_cancelled_message):
+        # The firmware doesn't always report the cancelled job's id, so any cancel ends a job sequence
+        self.end_job_sequence(exception=JobCancelledError(f"Job {job_cancelled_message.job_id} cancelled"))
+
+        self.commanded_velocity = 0.0
+
+        if self.settle_controller.active:
+            self.settle_controller.cancel()
+
+        if job_cancelled_message.job_id == self.current_job_id:
+            self.job_active = False
+
+    def next_job_id(self):
+        # Job id 0 is used by the firmware for no active job
+        self.last_job_id = self.last_job_id % 255 + 1
+        return self.last_job_id
+
+    def run_job_sequence(self, jobs: Iterable, wake: bool = True):
+        """
+        Description:
+            Queues jobs to run back to back. The next job frame is sent straight from the JOB_COMPLETE handler in
+            the serial read thread, without the sleep / wake the motor gets between separately sent jobs.
+            Generators are read lazily, one job at a time. Calling again while a sequence runs appends to it.
+
+        Args:
+            jobs (iterable): Each job is either a dict of send_motor_pulses arguments (job_id is assigned),
+                             or a callable taking a job id and sending one job e.g. a goto_rotor_position_radians partial
+            wake (bool): Send a wake command before the first job
+
+        Returns:
+            future: (concurrent.futures.Future) resolves to the number of jobs run, raises if a job is rejected,
+                    times out or is cancelled
+        """
+        with self.job_sequence_lock:
+            if self.job_sequence is not None:
+                self.job_sequence = itertools.chain(self.job_sequence, jobs)
+                return self.job_sequence_future
+
+            self.job_sequence = iter(jobs)
+            self.job_sequence_future = Future()
+            self.job_sequence_future.set_running_or_notify_cancel()
+            self.job_sequence_count = 0
+
+            # Responses and job messages are handled in the read thread so no queued hop delays the next job
+            self.inline_message_ids.update(self.job_sequence_message_ids)
+
+            if wake:
+                self.send_wake_motor()
+
+            if self.is_ready_for_job():
+                self.send_next_sequenced_job()
+
+            return self.job_sequence_future
+
+    def send_next_sequenced_job(self):
+        """
+        Description:
+            Sends the next job of the running sequence, ends the sequence when there are no jobs left.
+
+        Returns:
+            sent: (bool) a job was sent
+        """
+        with self.job_sequence_lock:
+            while self.job_sequence is not None:
+                job = next(self.job_sequence, None)
+
+                if job is None:
+                    self.end_job_sequence()
+                    return False
+
+                job_id = self.next_job_id()
+                future = job(job_id) if callable(job) else self.send_motor_pulses(job_id=job_id, **job)
+
+                # -1 is returned when there is nothing to do, e.g. the rotor is already at the target
+                if future == -1:
+                    continue
+
+                self.job_sequence_count += 1
+
+                if future is not None:
+                    future.add_done_callback(self.process_sequenced_job_result)
+
+                return True
+
+            return False
+
+    def process_sequenced_job_result(self, future):
+        if future.cancelled():
+            self.end_job_sequence(exception=JobCancelledError("Job command cancelled"))
+
+        elif future.exception() is not None:
+            self.end_job_sequence(exception=future.exception())
+
+    def end_job_sequence(self, exception: Union[Exception, None] = None):
+        with self.job_sequence_lock:
+            if self.job_sequence is None:
+                return
+
+            self.job_sequence = None
+            self.inline_message_ids.difference_update(self.job_sequence_message_ids)
+
+            if exception is None:
+                self.job_sequence_future.set_result(self.job_sequence_count)
+            else:
+                self.job_sequence_future.set_exception(exception)
+
+    def cancel_job_sequence(self):
+        """
+        Description:
+            Drops the queued jobs and cancels the running one.
+        """
+        self.end_job_sequence(exception=JobCancelledError("Job sequence cancelled"))
+        return self.send_cancel_job()
+
+    def processing_loop(self):
+        while self.running:
+            try:
+                new_message_id, new_message, queued_ns = self.receive_queue.get(timeout=0.01)
+
+                if self.metrics is not None:
+                    self.metrics.receive_queue_dwell.record(time.perf_counter_ns() - queued_ns)
+
+                self.dispatcher.dispatch(new_message_id, new_message)
 
             except queue.Empty:
                 time.sleep(0.005)
@@ -704,6 +1404,9 @@ class Motor:
             except Exception as e:
                 print(f'Exception {e}')
 
+                if self.metrics is not None:
+                    self.metrics.loop_exceptions += 1
+
     def is_ready_for_job(self):
         return not self.job_active and not self.job_pending
 
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Drives any number of motor controllers from one selector based I/O loop
+"""
+
+import os
+import time
+import random
+import selectors
+import threading
+from concurrent import futures
+from pathlib import Path
+
+from motor import Motor
+from motor_metrics import MetricsServer
+from serial_transport import open_transport
+
+
+class MotorBus:
+    def __init__(self, select_timeout: float = 0.05, reconnect_interval: float = 1.0):
+        """
+        Description:
+            Owns the serial ports of several Motor instances and multiplexes them through one selector
+            (epoll on Linux). Incoming frames are decoded and dispatched to the owning Motor straight from
+            the loop, commands are written as soon as a send_* call wakes the loop. No per motor threads
+            are started, so host CPU follows traffic rather than motor count.
+            An exception while serving one motor is counted in its metrics loop_exceptions and the loop carries
+            on with the others. A motor whose port closes is taken off the selector and its port reopened every
+            reconnect_interval, its commands stay queued until then.
+
+        Args:
+            select_timeout (float): Longest time the loop sleeps without any I/O, in seconds
+            reconnect_interval (float): Time between attempts to reopen a closed port, in seconds
+        """
+        self.select_timeout = select_timeout
+        self.reconnect_interval = reconnect_interval
+        self.selector = selectors.DefaultSelector()
+        self.motors = []
+
+        # Registered file descriptor of each connected motor, a closed transport no longer knows its own
+        self.motor_fds = {}
+        # Motor -> time.monotonic() of the next attempt to reopen its port
+        self.disconnected_motors = {}
+
+        # Self pipe used to wake the loop when a command is sent from another thread
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
+        os.set_blocking(self.wake_read_fd, False)
+        os.set_blocking(self.wake_write_fd, False)
+        self.selector.register(self.wake_read_fd, selectors.EVENT_READ, None)
+        self.wake_pending = False
+
+        self.pending_motors = set()
+        self.pending_lock = threading.Lock()
+
+        self.running = False
+        self.loop_thread = None
+        self.loop_thread_id = None
+
+        # Serial port -> MotorMetrics of every motor on the bus, served by start_metrics_server
+        self.metrics_sources = {}
+        self.metrics_server = None
+
+    def add_motor(self, motor: Motor):
+        """
+        Description:
+            Connects the motor's serial port and hands its I/O to the bus.
+
+        Args:
+            motor (Motor): Motor that has not had start_threads() called
+        """
+        motor.connect_serial_port()
+        motor.dispatch_inline = True
+        motor.command_notifier = self.notify_command
+        motor.running = True
+
+        self.register_motor(motor)
+        self.motors.append(motor)
+
+        if motor.metrics is not None:
+            self.metrics_sources[str(motor.serial_port_name)] = motor.metrics
+
+        # Anything sent before the motor joined the bus
+        if len(motor.command_scheduler) > 0:
+            self.notify_command(motor)
+
+        return motor
+
+    def remove_motor(self, motor: Motor):
+        self.unregister_motor(motor)
+        self.disconnected_motors.pop(motor, None)
+        self.motors.remove(motor)
+        self.metrics_sources.pop(str(motor.serial_port_name), None)
+        motor.command_notifier = None
+        motor.dispatch_inline = False
+        motor.running = False
+
+    def register_motor(self, motor: Motor):
+        fd = motor.ser.fileno()
+        self.selector.register(fd, selectors.EVENT_READ, motor)
+        self.motor_fds[motor] = fd
+
+    def unregister_motor(self, motor: Motor):
+        fd = self.motor_fds.pop(motor, None)
+
+        if fd is not None:
+            self.selector.unregister(fd)
+
+    def motor_exception(self, motor: Motor, exception: Exception):
+        """
+        Description:
+            Counts an exception raised while serving one motor, a motor whose port has closed is disconnected.
+        """
+        print(f'Exception {exception} on {motor.serial_port_name}')
+
+        if motor.metrics is not None:
+            motor.metrics.loop_exceptions += 1
+
+        if not motor.ser.is_open:
+            self.disconnect_motor(motor)
+
+    def disconnect_motor(self, motor: Motor):
+        self.unregister_motor(motor)
+        motor.ser.close()
+        motor.connected = False
+        self.disconnected_motors[motor] = time.monotonic() + self.reconnect_interval
+        print(f"{motor.serial_port_name} disconnected")
+
+    def reconnect_motors(self):
+        """
+        Description:
+            One attempt to reopen each disconnected port that is due, without blocking the other motors.
+        """
+        now = time.monotonic()
+
+        for motor, next_attempt in list(self.disconnected_motors.items()):
+            if now < next_attempt:
+                continue
+
+            try:
+                motor.ser = open_transport(motor.transport, motor.serial_port_name, motor.baud_rate, timeout=2)
+
+            except Exception:
+                self.disconnected_motors[motor] = now + self.reconnect_interval
+                continue
+
+            del self.disconnected_motors[motor]
+            motor.connected = True
+            self.register_motor(motor)
+            print(f"{motor.serial_port_name} reconnected")
+
+            if len(motor.command_scheduler) > 0:
+                self.notify_command(motor)
+
+    def notify_command(self, motor: Motor):
+        with self.pending_lock:
+            self.pending_motors.add(motor)
+
+            # Commands sent from the loop itself are flushed at the end of the current pass
+            if threading.get_ident() == self.loop_thread_id or self.wake_pending:
+                return
+
+            self.wake_pending = True
+
+        try:
+            os.write(self.wake_write_fd, b'\x00')
+
+        except BlockingIOError:
+            pass
+
+    def flush_commands(self):
+        with self.pending_lock:
+            pending_motors = self.pending_motors
+            self.pending_motors = set()
+            self.wake_pending = False
+
+        for motor in pending_motors:
+            # Written once the port is reopened
+            if motor in self.disconnected_motors:
+                continue
+
+            try:
+                motor.write_serial_messages()
+
+            except Exception as e:
+                self.motor_exception(motor, e)
+
+    def run_once(self, timeout: float = None):
+        """
+        Description:
+            One pass of the I/O loop: wait for data or a wake up, read and dispatch every ready port,
+            then write every pending command.
+        """
+        events = self.selector.select(self.select_timeout if timeout is None else timeout)
+
+        for key, _ in events:
+            if key.data is None:
+                try:
+                    os.read(self.wake_read_fd, 4096)
+
+                except BlockingIOError:
+                    pass
+
+            else:
+                motor = key.data
+
+                try:
+                    motor.read_serial_messages()
+
+                except Exception as e:
+                    self.motor_exception(motor, e)
+
+                else:
+                    # The POSIX transport closes itself when the device goes away
+                    if not motor.ser.is_open:
+                        self.disconnect_motor(motor)
+
+        self.flush_commands()
+
+        for motor in self.motors:
+            try:
+                if motor in self.disconnected_motors:
+                    # Pending commands still time out, nothing is resent
+                    motor.command_tracker.check_deadlines(lambda frame: None)
+                else:
+                    motor.check_command_deadlines()
+
+            except Exception as e:
+                self.motor_exception(motor, e)
+
+        if self.disconnected_motors:
+            self.reconnect_motors()
+
+    def run_forever(self):
+        self.running = True
+        self.loop_thread_id = threading.get_ident()
+
+        while self.running:
+            self.run_once()
+
+    def start_metrics_server(self, port: int = 0, host: str = '127.0.0.1'):
+        """
+        Description:
+            Serves the metrics of every motor on the bus from one port, labelled by serial port.
+
+        Returns:
+            server: (MetricsServer)
+        """
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics_sources, host=host, port=port)
+
+        return self.metrics_server
+
+    def start(self):
+        """
+        Description:
+            Runs the I/O loop in one background thread.
+        """
+        self.loop_thread = threading.Thread(target=self.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def stop(self):
+        print("\nShutting down motors...")
+
+        # A disable drops whatever is still queued before it, so it waits for the cancel and sleep to be answered
+        shutdown_futures = [future for motor in self.motors for future in (motor.send_cancel_job(), motor.send_sleep_motor())]
+        futures.wait(shutdown_futures, timeout=0.5)
+
+        for motor in self.motors:
+            motor.send_disable_motor()
+
+        time.sleep(0.5)
+
+        self.running = False
+        os.write(self.wake_write_fd, b'\x00')
+
+        if self.loop_thread is not None:
+            self.loop_thread.join()
+
+        for motor in list(self.motors):
+            self.remove_motor(motor)
+            motor.ser.close()
+            motor.stop_recording()
+
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+        self.selector.close()
+        os.close(self.wake_read_fd)
+        os.close(self.wake_write_fd)
+
+        print("Complete")
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+    header_file = project_dir / 'arduino/engineering-team-motor/definitions.h'
+
+    bus = MotorBus()
+    motors = [bus.add_motor(Motor(definitions_filepath=header_file, serial_port=serial_port))
+              for serial_port in ['/dev/arduino_rp2040_0', '/dev/arduino_rp2040_1']]
+    bus.start()
+
+    for motor in motors:
+        motor.send_enable_motor()
+        motor.send_wake_motor()
+
+    try:
+        while True:
+            for motor in motors:
+                if motor.is_ready_for_job():
+                    motor.send_wake_motor()
+                    motor.send_motor_rotations_at_set_rpm(number_or_rotations=1,
+                                                          rpm=random.random() * 10,
+                                                          direction=random.choice([True, False]),
+                                                          job_id=1)
+            time.sleep(0.1)
+
+    except KeyboardInterrupt:
+        bus.stop()
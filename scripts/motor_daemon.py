@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Shares one motor controller between local processes. The daemon owns the serial port through a Motor and serves
+    clients over a Unix domain socket using the controller's own STX, length, data, ETX framing
+"""
+
+import os
+import time
+import socket
+import struct
+import selectors
+import threading
+from typing import Union
+from pathlib import Path
+
+from motor import Motor
+from serial_framer import SerialFramer
+from command_codec import CommandCodec
+from messages import MessageDispatcher
+from command_tracker import CommandTracker, MotorCommandError
+from command_scheduler import CommandQueueFullError, CommandPreemptedError, CANCEL
+from motor_protocol import load_protocol
+
+# Daemon commands, outside the firmware command and message id ranges
+SUBSCRIBE = 0x70
+UNSUBSCRIBE = 0x71
+ACQUIRE_CONTROL = 0x72
+RELEASE_CONTROL = 0x73
+
+# Response codes for commands the daemon answers itself
+BAD_FRAME_RESPONSE = 0x78
+NOT_FORWARDED_RESPONSE = 0x79
+CANCELLED_RESPONSE = 0x7A
+CONTROL_HELD_RESPONSE = 0x7B
+NOT_CONTROLLING_RESPONSE = 0x7C
+QUEUE_FULL_RESPONSE = 0x7D
+PREEMPTED_RESPONSE = 0x7E
+TIMEOUT_RESPONSE = 0x7F
+
+daemon_response_names = {BAD_FRAME_RESPONSE: 'BAD_FRAME_RESPONSE',
+                         NOT_FORWARDED_RESPONSE: 'NOT_FORWARDED_RESPONSE',
+                         CANCELLED_RESPONSE: 'CANCELLED_RESPONSE',
+                         CONTROL_HELD_RESPONSE: 'CONTROL_HELD_RESPONSE',
+                         NOT_CONTROLLING_RESPONSE: 'NOT_CONTROLLING_RESPONSE',
+                         QUEUE_FULL_RESPONSE: 'QUEUE_FULL_RESPONSE',
+                         PREEMPTED_RESPONSE: 'PREEMPTED_RESPONSE',
+                         TIMEOUT_RESPONSE: 'TIMEOUT_RESPONSE',
+                         }
+
+# {STX, length, SUBSCRIBE, message_id, decimation, ETX}, big endian like the firmware commands
+subscribe_struct = struct.Struct('!4BHB')
+message_id_struct = struct.Struct('!5B')
+static_struct = struct.Struct('!4B')
+# {STX, length, RESPONSE_MESSAGE_ID, COMMAND, JOB_ID, RESPONSE, [ACK or NAK], ETX}
+response_frame_struct = struct.Struct('8B')
+
+
+class DaemonClient:
+    def __init__(self, sock: socket.socket, framer: SerialFramer, max_buffered: int):
+        """
+        Description:
+            One connected client. Frames are sent straight from whichever thread produced them, what the socket
+            won't take is buffered and flushed by the daemon loop. A client that falls more than max_buffered
+            bytes behind loses whole frames, never part of one.
+        """
+        self.sock = sock
+        self.framer = framer
+        self.max_buffered = max_buffered
+
+        # message id -> [decimation, count]
+        self.subscriptions = {}
+        self.outgoing = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Statistics
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def send(self, frame: bytes):
+        with self.lock:
+            if self.closed:
+                return
+
+            if not self.outgoing:
+                try:
+                    sent = self.sock.send(frame)
+
+                except BlockingIOError:
+                    sent = 0
+
+                except OSError:
+                    self.closed = True
+                    return
+
+                if sent == len(frame):
+                    self.frames_sent += 1
+                    return
+
+                if sent > 0:
+                    # The rest of a partly sent frame is always kept
+                    self.outgoing += frame[sent:]
+                    self.frames_sent += 1
+                    return
+
+            if len(self.outgoing) + len(frame) > self.max_buffered:
+                self.frames_dropped += 1
+                return
+
+            self.outgoing += frame
+            self.frames_sent += 1
+
+    def forward(self, message_id: int, frame: bytes):
+        subscription = self.subscriptions.get(message_id)
+
+        if subscription is None:
+            return
+
+        subscription[1] += 1
+
+        if subscription[1] >= subscription[0]:
+            subscription[1] = 0
+            self.send(frame)
+
+    def flush(self):
+        with self.lock:
+            if self.outgoing and not self.closed:
+                try:
+                    sent = self.sock.send(self.outgoing)
+                    del self.outgoing[:sent]
+
+                except BlockingIOError:
+                    pass
+
+                except OSError:
+                    self.closed = True
+
+
+class MotorDaemon:
+    def __init__(self, motor: Motor, socket_path: Union[Path, str], max_buffered: int = 1 << 20, select_timeout: float = 0.005):
+        """
+        Description:
+            Frames from the controller are decoded once by the Motor and forwarded raw to every client subscribed
+            to their message id, every decimation-th frame per client. RESPONSE messages are never broadcast,
+            each client gets the response to its own commands only, so a client's pending commands are matched
+            exactly as if it owned the port.
+            Commands from clients go through motor.send_command. One client at a time can hold control with
+            ACQUIRE_CONTROL, while it does other clients can only send cancel / pause and safety stop commands.
+            With no client in control every client may command the motor.
+
+        Args:
+            motor (Motor): Motor owning the serial port, its threads are started by start() if not running
+            socket_path (Path): Unix domain socket path
+            max_buffered (int): Bytes kept per client before frames are dropped
+            select_timeout (float): Longest time the daemon loop sleeps, in seconds
+        """
+        self.motor = motor
+        self.socket_path = str(socket_path)
+        self.max_buffered = max_buffered
+        self.select_timeout = select_timeout
+
+        definitions = motor.definitions
+        self.STX = definitions['serial_settings']['STX']
+        self.ETX = definitions['serial_settings']['ETX']
+        self.ACK = definitions['serial_settings']['ACK']
+        self.NAK = definitions['serial_settings']['NAK']
+        self.response_message_id = definitions['message_types']['RESPONSE_MESSAGE_ID']
+        self.unknown_command_response = definitions['response_types']['UNKNOWN_MOTOR_COMMAND_RESPONSE']
+        self.firmware_commands = set(definitions['command_types'].values())
+        self.job_command_types = motor.command_tracker.job_command_types
+
+        self.selector = selectors.DefaultSelector()
+        self.server = None
+        self.clients = {}
+        self.subscribers = {}
+        self.controller = None
+
+        self.running = False
+        self.loop_thread = None
+
+    def start(self):
+        if not self.motor.running:
+            self.motor.start_threads()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+
+        self.motor.frame_taps = self.motor.frame_taps + (self.forward,)
+
+        self.running = True
+        self.loop_thread = threading.Thread(target=self.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    def stop(self):
+        self.running = False
+
+        if self.loop_thread is not None:
+            self.loop_thread.join()
+
+        self.motor.frame_taps = tuple(frame_tap for frame_tap in self.motor.frame_taps if frame_tap != self.forward)
+
+        for client in list(self.clients.values()):
+            self.disconnect(client)
+
+        self.selector.unregister(self.server)
+        self.server.close()
+        self.selector.close()
+        os.unlink(self.socket_path)
+
+    def forward(self, message_buffer):
+        """
+        Description:
+            Frame tap called in the Motor read thread with every received message buffer.
+        """
+        subscribers = self.subscribers.get(message_buffer[0])
+
+        if not subscribers:
+            return
+
+        frame = bytes((self.STX, len(message_buffer) + 2)) + message_buffer
+
+        for client in subscribers:
+            client.forward(message_buffer[0], frame)
+
+    def update_subscribers(self):
+        # Rebuilt rather than modified so forward() never sees a tuple change under it
+        subscribers = {}
+
+        for client in self.clients.values():
+            for message_id in client.subscriptions:
+                subscribers.setdefault(message_id, []).append(client)
+
+        self.subscribers = {message_id: tuple(clients) for message_id, clients in subscribers.items()}
+
+    def run_forever(self):
+        while self.running:
+            self.run_once()
+
+    def run_once(self):
+        for key, _ in self.selector.select(self.select_timeout):
+            if key.data is None:
+                self.accept()
+                continue
+
+            # A client that breaks the loop is dropped, the others carry on
+            try:
+                self.read_client(key.data)
+
+            except Exception as e:
+                print(f'Exception {e}, disconnecting client')
+                self.disconnect(key.data)
+
+        for client in list(self.clients.values()):
+            client.flush()
+
+            if client.closed:
+                self.disconnect(client)
+
+    def accept(self):
+        try:
+            sock, _ = self.server.accept()
+
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        client = DaemonClient(sock, SerialFramer(stx=self.STX, etx=self.ETX), self.max_buffered)
+        self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def disconnect(self, client: DaemonClient):
+        with client.lock:
+            client.closed = True
+
+        if self.clients.pop(client.sock.fileno(), None) is not None:
+            self.selector.unregister(client.sock)
+
+        client.sock.close()
+
+        if self.controller is client:
+            self.controller = None
+
+        self.update_subscribers()
+
+    def read_client(self, client: DaemonClient):
+        try:
+            data = client.sock.recv(4096)
+
+        except BlockingIOError:
+            return
+
+        except OSError:
+            data = b''
+
+        if not data:
+            self.disconnect(client)
+            return
+
+        client.framer.feed(data)
+        message_id, message_buffer = client.framer.next_frame()
+
+        while message_id != 0:
+            self.process_client_frame(client, message_id, bytes(message_buffer))
+            message_id, message_buffer = client.framer.next_frame()
+
+    def respond(self, client: DaemonClient, command: int, job_id: int, response: int, acknowledged: bool):
+        client.send(response_frame_struct.pack(self.STX, response_frame_struct.size, self.response_message_id,
+                                               command, job_id, response, self.ACK if acknowledged else self.NAK, self.ETX))
+
+    def process_client_frame(self, client: DaemonClient, command: int, message_buffer: bytes):
+        """
+        Description:
+            message_buffer holds the command byte, payload and ETX of one frame from a client.
+            Daemon commands of the wrong length are answered with BAD_FRAME_RESPONSE.
+        """
+        frame_length = len(message_buffer) + 2
+
+        if command == SUBSCRIBE:
+            if frame_length != subscribe_struct.size:
+                self.respond(client, command, 0, BAD_FRAME_RESPONSE, False)
+                return
+
+            _, _, _, message_id, decimation, _ = subscribe_struct.unpack(bytes((self.STX, frame_length)) + message_buffer)
+
+            if message_id == self.response_message_id:
+                self.respond(client, command, 0, NOT_FORWARDED_RESPONSE, False)
+                return
+
+            client.subscriptions[message_id] = [max(decimation, 1), 0]
+            self.update_subscribers()
+            self.respond(client, command, 0, 0, True)
+
+        elif command == UNSUBSCRIBE:
+            if frame_length != message_id_struct.size:
+                self.respond(client, command, 0, BAD_FRAME_RESPONSE, False)
+                return
+
+            client.subscriptions.pop(message_buffer[1], None)
+            self.update_subscribers()
+            self.respond(client, command, 0, 0, True)
+
+        elif command == ACQUIRE_CONTROL:
+            if self.controller is None or self.controller is client:
+                self.controller = client
+                self.respond(client, command, 0, 0, True)
+            else:
+                self.respond(client, command, 0, CONTROL_HELD_RESPONSE, False)
+
+        elif command == RELEASE_CONTROL:
+            if self.controller is client:
+                self.controller = None
+
+            self.respond(client, command, 0, 0, True)
+
+        elif command in self.firmware_commands:
+            job_id = message_buffer[3] if command in self.job_command_types and len(message_buffer) > 3 else 0
+
+            # Stops are always allowed, whoever holds control
+            if self.controller is not None and self.controller is not client and self.motor.command_scheduler.priorities[command] > CANCEL:
+                self.respond(client, command, job_id, NOT_CONTROLLING_RESPONSE, False)
+                return
+
+            future = self.motor.send_command(bytes((self.STX, frame_length)) + message_buffer)
+            future.add_done_callback(lambda done_future: self.reply(client, command, job_id, done_future))
+
+        else:
+            self.respond(client, command, 0, self.unknown_command_response, False)
+
+    def reply(self, client: DaemonClient, command: int, job_id: int, future):
+        if future.cancelled():
+            self.respond(client, command, job_id, CANCELLED_RESPONSE, False)
+            return
+
+        exception = future.exception()
+
+        if exception is None:
+            response_message = future.result()
+            self.respond(client, command, response_message.job_id, response_message.response, response_message.acknowledged)
+
+        elif isinstance(exception, MotorCommandError):
+            response_message = exception.response_message
+            self.respond(client, command, response_message.job_id, response_message.response, False)
+
+        elif isinstance(exception, CommandQueueFullError):
+            self.respond(client, command, job_id, QUEUE_FULL_RESPONSE, False)
+
+        elif isinstance(exception, CommandPreemptedError):
+            self.respond(client, command, job_id, PREEMPTED_RESPONSE, False)
+
+        else:
+            self.respond(client, command, job_id, TIMEOUT_RESPONSE, False)
+
+
+class MotorClient:
+    def __init__(self, definitions_filepath: Path, socket_path: Union[Path, str], command_timeout: float = 2.0):
+        """
+        Description:
+            Client of a MotorDaemon. Commands return futures resolved by the daemon's reply, exactly as
+            Motor.send_command, and subscribed messages are decoded and dispatched to registered handlers
+            from the client's read thread.
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            socket_path (Path): Unix domain socket the daemon listens on
+            command_timeout (float): Time to wait for the daemon's reply, in seconds
+        """
+        definitions = load_protocol(definitions_filepath).require_serial()
+        self.STX = definitions['serial_settings']['STX']
+        self.ETX = definitions['serial_settings']['ETX']
+        self.message_types = definitions['message_types']
+
+        self.codec = CommandCodec(definitions)
+        self.dispatcher = MessageDispatcher(definitions)
+        self.framer = SerialFramer(stx=self.STX, etx=self.ETX)
+        self.command_tracker = CommandTracker(definitions, timeout=command_timeout, retries=0)
+        self.command_tracker.response_names.update(daemon_response_names)
+        self.dispatcher.register_handler(self.message_types['RESPONSE_MESSAGE_ID'], self.command_tracker.resolve)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(socket_path))
+        self.sock.settimeout(0.01)
+        self.send_lock = threading.Lock()
+
+        self.running = True
+        self.read_thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.read_thread.start()
+
+    def close(self):
+        self.running = False
+        self.read_thread.join()
+        self.sock.close()
+        self.command_tracker.cancel_all()
+
+    def read_loop(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+
+                if not data:
+                    break
+
+                self.framer.feed(data)
+                message_id, message_buffer = self.framer.next_frame()
+
+                while message_id != 0:
+                    message = self.dispatcher.decode(message_id, message_buffer)
+
+                    if message is not None:
+                        self.dispatcher.dispatch(message_id, message)
+
+                    message_id, message_buffer = self.framer.next_frame()
+
+            except socket.timeout:
+                pass
+
+            except Exception as e:
+                print(f'Exception {e}')
+
+            # Nothing is ever resent, the daemon owns retries
+            self.command_tracker.check_deadlines(lambda frame: None)
+
+        self.running = False
+
+    def register_handler(self, message_id: int, handler):
+        self.dispatcher.register_handler(message_id, handler)
+
+    def send_command(self, frame: bytes):
+        future = self.command_tracker.track(frame)
+
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+        return future
+
+    def subscribe(self, message_id: int, decimation: int = 1):
+        """
+        Description:
+            Receive every decimation-th message with this id, e.g. decimation 10 gives 10 Hz feedback.
+        """
+        return self.send_command(subscribe_struct.pack(self.STX, subscribe_struct.size, SUBSCRIBE, message_id, decimation, self.ETX))
+
+    def unsubscribe(self, message_id: int):
+        return self.send_command(message_id_struct.pack(self.STX, message_id_struct.size, UNSUBSCRIBE, message_id, self.ETX))
+
+    def acquire_control(self):
+        return self.send_command(static_struct.pack(self.STX, static_struct.size, ACQUIRE_CONTROL, self.ETX))
+
+    def release_control(self):
+        return self.send_command(static_struct.pack(self.STX, static_struct.size, RELEASE_CONTROL, self.ETX))
+
+    def send_static_command(self, command_name: str):
+        """
+        Description:
+            Sends a command without payload e.g. 'WAKE_MOTOR'
+        """
+        return self.send_command(self.codec.get_static_frame(command_name))
+
+    def send_motor_pulses(self,
+                          direction: bool,
+                          microstep: int = 1,
+                          pulses: int = 0,
+                          pulse_interval: int = 1000,
+                          pulse_on_period: Union[int, None] = None,
+                          use_ramping: bool = False,
+                          ramping_steps: int = 0,
+                          ramp_scaler: Union[int, None] = None,
+                          job_id: int = 0,
+                          ):
+        command = self.codec.select_job_command(pulse_on_period=pulse_on_period, use_ramping=use_ramping, ramp_scaler=ramp_scaler)
+
+        return self.send_command(self.codec.encode_job(command=command,
+                                                       direction=direction,
+                                                       microstep=microstep,
+                                                       job_id=job_id,
+                                                       pulses=pulses,
+                                                       pulse_interval=pulse_interval,
+                                                       pulse_on_period=pulse_on_period,
+                                                       ramping_steps=ramping_steps,
+                                                       ramp_scaler=ramp_scaler,
+                                                       ))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    project_dir = Path(__file__).resolve().parents[1]
+
+    parser = argparse.ArgumentParser(description="Share one motor controller between local processes")
+    parser.add_argument('--serial-port', default='/dev/arduino_rp2040')
+    parser.add_argument('--socket', type=Path, default=Path('/tmp/arduino_rp2040.sock'))
+    parser.add_argument('--definitions', type=Path, default=project_dir / 'arduino/engineering-team-motor/definitions.h')
+    args = parser.parse_args()
+
+    daemon = MotorDaemon(Motor(definitions_filepath=args.definitions, serial_port=args.serial_port), args.socket)
+    daemon.start()
+    print(f"Serving {args.serial_port} on {args.socket}")
+
+    try:
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        daemon.stop()
+        daemon.motor.stop()
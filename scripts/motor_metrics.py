@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Counters, queue high-water marks and latency histograms for the host side protocol stack, read as a
+    snapshot dict or served as Prometheus style text on a localhost port
+"""
+
+import math
+import threading
+import numpy as np
+from typing import Union
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Summary quantiles reported for every histogram
+quantiles = (('p50', 50.0), ('p90', 90.0), ('p99', 99.0), ('p999', 99.9))
+
+
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits: int = 7, highest_trackable: int = 1 << 36):
+        """
+        Description:
+            HDR style log-linear histogram of non-negative integers, here nanoseconds. Values below
+            2 ** sub_bucket_bits get a bucket each, above that every power of two is split into
+            2 ** (sub_bucket_bits - 1) buckets, so any recorded value is known to within 1 / 64 of itself with the
+            default 7 bits. Recording is a bit_length and a list increment, no allocation, and the bucket count
+            stays small (1984 buckets up to 2 ** 36 ns, about 69 s). Values above highest_trackable are clamped.
+
+        Args:
+            sub_bucket_bits (int): log2 of the linear range, sets the precision
+            highest_trackable (int): Largest value kept exactly to the bucket precision
+        """
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_bucket_bits = sub_bucket_bits - 1
+        self.highest_trackable = highest_trackable
+
+        self.counts = [0] * (self.index_of(highest_trackable) + 1)
+        self.total_count = 0
+        self.total = 0
+        self.minimum = highest_trackable
+        self.maximum = 0
+
+    def index_of(self, value: int):
+        if value < self.sub_bucket_count:
+            return value
+
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift << self.half_bucket_bits) + (value >> shift)
+
+    def lowest_value_at(self, index: int):
+        if index < self.sub_bucket_count:
+            return index
+
+        shift = (index >> self.half_bucket_bits) - 1
+        return (index - (shift << self.half_bucket_bits)) << shift
+
+    def highest_value_at(self, index: int):
+        if index < self.sub_bucket_count:
+            return index
+
+        shift = (index >> self.half_bucket_bits) - 1
+        return self.lowest_value_at(index) + (1 << shift) - 1
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+
+        elif value > self.highest_trackable:
+            value = self.highest_trackable
+
+        if value < self.sub_bucket_count:
+            self.counts[value] += 1
+
+        else:
+            shift = value.bit_length() - self.sub_bucket_bits
+            self.counts[(shift << self.half_bucket_bits) + (value >> shift)] += 1
+
+        self.total_count += 1
+        self.total += value
+
+        if value < self.minimum:
+            self.minimum = value
+
+        if value > self.maximum:
+            self.maximum = value
+
+    def value_at_percentile(self, percentile: float, counts: Union[np.ndarray, None] = None):
+        """
+        Description:
+            Highest value equivalent to the bucket holding the given percentile, capped at the recorded maximum.
+        """
+        counts = np.asarray(self.counts, dtype=np.int64) if counts is None else counts
+        cumulative = np.cumsum(counts)
+        total_count = int(cumulative[-1])
+
+        if total_count == 0:
+            return 0
+
+        target = max(1, math.ceil(percentile / 100.0 * total_count))
+        index = int(np.searchsorted(cumulative, target))
+        return min(self.highest_value_at(index), self.maximum)
+
+    def summary(self, scale: float = 1e-3):
+        """
+        Description:
+            Count, sum, min, mean, quantiles and max, values multiplied by scale, microseconds from nanoseconds
+            by default.
+
+        Returns:
+            summary: (dict)
+        """
+        counts = np.asarray(self.counts, dtype=np.int64)
+        total_count = int(counts.sum())
+
+        if total_count == 0:
+            return {'count': 0, 'sum': 0.0}
+
+        summary = {'count': total_count,
+                   'sum': self.total * scale,
+                   'min': self.minimum * scale,
+                   'mean': self.total / max(self.total_count, 1) * scale,
+                   }
+
+        for name, percentile in quantiles:
+            summary[name] = self.value_at_percentile(percentile, counts) * scale
+
+        summary['max'] = self.maximum * scale
+        return summary
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.total_count = 0
+        self.total = 0
+        self.minimum = self.highest_trackable
+        self.maximum = 0
+
+
+class MotorMetrics:
+    def __init__(self, definitions: dict, framer=None, command_scheduler=None, command_tracker=None):
+        """
+        Description:
+            Instrumentation shared by the read, write and processing paths of one Motor. The hot paths only do
+            list increments and histogram records from the thread that owns the port, snapshot() gathers them
+            together with the statistics the framer, command scheduler and command tracker already keep.
+
+            Histograms, all in nanoseconds:
+                decode_time: dispatcher.decode of one frame
+                receive_queue_dwell: put on receive_queue until processing_loop takes it
+                command_queue_dwell: submit to command_scheduler until the frame is written
+                command_to_ack: send_command until the RESPONSE resolves its future, includes queueing and resends
+
+        Args:
+            definitions (dict): Output of parse_definitions_file or a Protocol
+            framer (SerialFramer): Source of bytes received, discarded and recovered frames
+            command_scheduler (CommandScheduler): Source of queue depth and submit statistics
+            command_tracker (CommandTracker): Source of response, resend and timeout counts
+        """
+        self.command_names = {value: key for key, value in definitions['command_types'].items()}
+        self.message_names = {value: key for key, value in definitions['message_types'].items()}
+
+        self.framer = framer
+        self.command_scheduler = command_scheduler
+        self.command_tracker = command_tracker
+
+        # Indexed by message / command byte
+        self.messages_received = [0] * 256
+        self.commands_sent = [0] * 256
+
+        self.bytes_sent = 0
+        self.unknown_messages = 0
+        self.framing_errors = 0
+        self.receive_queue_dropped = 0
+        self.receive_queue_high_water = 0
+        self.loop_exceptions = 0
+
+        self.decode_time = LatencyHistogram()
+        self.receive_queue_dwell = LatencyHistogram()
+        self.command_queue_dwell = LatencyHistogram()
+        self.command_to_ack = LatencyHistogram()
+
+        if command_scheduler is not None:
+            command_scheduler.dwell_histogram = self.command_queue_dwell
+
+        if command_tracker is not None:
+            command_tracker.ack_histogram = self.command_to_ack
+
+    def record_received(self, message_id: int, decoded: bool, decode_time_ns: int, known: bool = False):
+        """
+        Description:
+            A frame that did not decode is a framing error when its message id is known, i.e. it was too short.
+        """
+        self.messages_received[message_id] += 1
+
+        if not decoded:
+            if known:
+                self.framing_errors += 1
+            else:
+                self.unknown_messages += 1
+
+        self.decode_time.record(decode_time_ns)
+
+    def record_queued(self, depth: int):
+        if depth > self.receive_queue_high_water:
+            self.receive_queue_high_water = depth
+
+    def record_sent(self, frame: bytes):
+        self.commands_sent[frame[2]] += 1
+        self.bytes_sent += len(frame)
+
+    def histograms(self):
+        return {'decode_time': self.decode_time,
+                'receive_queue_dwell': self.receive_queue_dwell,
+                'command_queue_dwell': self.command_queue_dwell,
+                'command_to_ack': self.command_to_ack,
+                }
+
+    def snapshot(self):
+        """
+        Description:
+            Copy of every counter and a summary of every histogram, latencies in microseconds.
+
+        Returns:
+            snapshot: (dict) counters, messages_received, commands_sent, high_water and latency_us
+        """
+        counters = {'bytes_sent': self.bytes_sent,
+                    'unknown_messages': self.unknown_messages,
+                    'framing_errors': self.framing_errors,
+                    'receive_queue_dropped': self.receive_queue_dropped,
+                    'loop_exceptions': self.loop_exceptions,
+                    }
+        high_water = {'receive_queue': self.receive_queue_high_water}
+
+        if self.framer is not None:
+            counters.update(self.framer.get_statistics())
+
+        if self.command_scheduler is not None:
+            scheduler = self.command_scheduler
+            counters.update(commands_submitted=scheduler.submitted,
+                            commands_coalesced=scheduler.coalesced,
+                            commands_rejected=scheduler.rejected,
+                            commands_preempted=scheduler.preempted,
+                            )
+            high_water['command_queue'] = scheduler.high_water
+
+        if self.command_tracker is not None:
+            counters.update(self.command_tracker.get_statistics())
+
+        return {'counters': counters,
+                'messages_received': {self.message_names.get(message_id, f"0x{message_id:02X}"): count
+                                      for message_id, count in enumerate(self.messages_received) if count},
+                'commands_sent': {self.command_names.get(command, f"0x{command:02X}"): count
+                                  for command, count in enumerate(self.commands_sent) if count},
+                'high_water': high_water,
+                'latency_us': {name: histogram.summary() for name, histogram in self.histograms().items()},
+                }
+
+    def reset(self):
+        """
+        Description:
+            Zeroes the counters, high-water marks and histograms kept here, not the framer, scheduler or tracker ones.
+        """
+        self.messages_received = [0] * 256
+        self.commands_sent = [0] * 256
+        self.bytes_sent = 0
+        self.unknown_messages = 0
+        self.framing_errors = 0
+        self.receive_queue_dropped = 0
+        self.receive_queue_high_water = 0
+        self.loop_exceptions = 0
+
+        for histogram in self.histograms().values():
+            histogram.reset()
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metrics(snapshots: dict, prefix: str = 'motor'):
+    """
+    Description:
+        Prometheus text exposition of MotorMetrics snapshots. Counters get a _total suffix, high-water marks are
+        gauges and histograms are summaries in seconds.
+
+    Args:
+        snapshots (dict): Motor label, e.g. the serial port, -> MotorMetrics.snapshot()
+        prefix (str): Metric name prefix
+
+    Returns:
+        text: (str)
+    """
+    families = {}
+
+    def add(family: str, metric_type: str, labels: dict, value, suffix: str = ''):
+        samples = families.setdefault(family, (metric_type, []))[1]
+        label_text = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        samples.append(f"{family}{suffix}{{{label_text}}} {value}")
+
+    for motor, snapshot in snapshots.items():
+        labels = {'motor': motor}
+
+        for name, value in snapshot['counters'].items():
+            add(f"{prefix}_{name}_total", 'counter', labels, value)
+
+        for message, count in snapshot['messages_received'].items():
+            add(f"{prefix}_messages_received_total", 'counter', dict(labels, message=message), count)
+
+        for command, count in snapshot['commands_sent'].items():
+            add(f"{prefix}_commands_sent_total", 'counter', dict(labels, command=command), count)
+
+        for name, value in snapshot['high_water'].items():
+            add(f"{prefix}_{name}_high_water", 'gauge', labels, value)
+
+        for name, summary in snapshot['latency_us'].items():
+            family = f"{prefix}_{name}_seconds"
+
+            for quantile_name, percentile in quantiles:
+                if quantile_name in summary:
+                    add(family, 'summary', dict(labels, quantile=percentile / 100.0), summary[quantile_name] * 1e-6)
+
+            add(family, 'summary', labels, summary['sum'] * 1e-6, suffix='_sum')
+            add(family, 'summary', labels, summary['count'], suffix='_count')
+
+    lines = []
+
+    for family, (metric_type, samples) in families.items():
+        lines.append(f"# TYPE {family} {metric_type}")
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, sources: dict, host: str = '127.0.0.1', port: int = 0):
+        """
+        Description:
+            Serves format_metrics of the given MotorMetrics on GET /metrics from a daemon thread, bound to
+            localhost unless told otherwise. Port 0 picks a free port, see self.port.
+
+        Args:
+            sources (dict): Motor label -> MotorMetrics, can be added to while serving
+            host (str): Address to bind
+            port (int): TCP port
+        """
+        self.sources = sources
+        server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        self.host, self.port = self.http_server.server_address[:2]
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def render(self):
+        return format_metrics({label: metrics.snapshot() for label, metrics in list(self.sources.items())})
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.thread.join()
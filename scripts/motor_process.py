@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Runs each Motor's serial I/O and decoding in its own worker process. The latest feedback, status and job state
+    are published to a shared memory block under a sequence lock, method calls go over a pipe
+"""
+
+import math
+import time
+import struct
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Future
+from typing import Union
+from pathlib import Path
+
+from motor import Motor
+from messages import StatusBits, StatusMessage
+from motor_protocol import load_protocol
+
+# Even while the block is consistent, odd while the worker is writing it
+sequence_struct = struct.Struct('<Q')
+
+state_fields = ('feedback_timestamp',
+                'velocity',
+                'position',
+                'absolute_position',
+                'encoder_count',
+                'absolute_count',
+                'feedback_count',
+                'pulses_remaining',
+                'status_byte',
+                'status_job_id',
+                'microstep',
+                'current_job_id',
+                'job_active',
+                'job_pending',
+                'at_commanded_position',
+                'connected',
+                )
+state_struct = struct.Struct('<ddddqqQI4B4?')
+field_index = {name: index for index, name in enumerate(state_fields)}
+
+# Pipe messages, parent to worker
+CALL = 'call'
+GET = 'get'
+EXIT = 'exit'
+
+# Worker to parent
+STARTED = 'started'
+VALUE = 'value'
+PENDING = 'pending'
+RESULT = 'result'
+ERROR = 'error'
+
+
+class WorkerExitedError(Exception):
+    pass
+
+
+class SharedMotorState:
+    size = sequence_struct.size + state_struct.size
+
+    def __init__(self, buffer: memoryview):
+        """
+        Description:
+            Sequence lock over one state_struct. There must be a single writer, readers never block it and retry
+            when the sequence changed while they copied the block.
+        """
+        self.buffer = buffer
+        self.sequence = sequence_struct.unpack_from(buffer, 0)[0]
+
+    def publish(self, values: tuple):
+        sequence_struct.pack_into(self.buffer, 0, self.sequence + 1)
+        state_struct.pack_into(self.buffer, sequence_struct.size, *values)
+        self.sequence += 2
+        sequence_struct.pack_into(self.buffer, 0, self.sequence)
+
+    def read(self, max_spins: int = 1000):
+        """
+        Description:
+            Consistent copy of the block.
+
+        Returns:
+            values: (tuple) in state_fields order
+        """
+        spins = 0
+
+        while True:
+            before = sequence_struct.unpack_from(self.buffer, 0)[0]
+
+            if before & 1 == 0:
+                values = state_struct.unpack_from(self.buffer, sequence_struct.size)
+
+                if sequence_struct.unpack_from(self.buffer, 0)[0] == before:
+                    return values
+
+            spins += 1
+
+            if spins >= max_spins:
+                # Let the writer run if it was preempted mid write
+                time.sleep(0)
+                spins = 0
+
+    def snapshot(self):
+        return dict(zip(state_fields, self.read()))
+
+
+class MotorWorker:
+    def __init__(self, motor: Motor, state: SharedMotorState, connection):
+        """
+        Description:
+            Worker side, publishes the motor state from the message handlers and after every call, and executes
+            the parent's calls in order. Futures returned by the motor are answered when they complete.
+        """
+        self.motor = motor
+        self.state = state
+        self.connection = connection
+        self.publish_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.feedback_count = 0
+        self.running = False
+
+        for message_id in (motor.motor_status_message_id,
+                           motor.response_message_id,
+                           motor.job_complete_message_id,
+                           motor.job_cancelled_message_id):
+            motor.register_handler(message_id, self.publish_message_state)
+
+        motor.register_handler(motor.motor_feedback_message_id, self.publish_feedback_state)
+
+        if motor.motor_feedback_batch_message_id is not None:
+            motor.register_handler(motor.motor_feedback_batch_message_id, self.publish_feedback_batch_state)
+
+    def publish_feedback_state(self, feedback_message):
+        self.feedback_count += 1
+        self.publish()
+
+    def publish_feedback_batch_state(self, feedback_batch_message):
+        self.feedback_count += len(feedback_batch_message)
+        self.publish()
+
+    def publish_message_state(self, message):
+        self.publish()
+
+    def publish(self):
+        motor = self.motor
+        latest_sample = motor.feedback_history.latest()
+        status_message = motor.status_message
+
+        if latest_sample is None:
+            feedback = (0.0, 0.0, 0.0)
+            encoder_count = 0
+        else:
+            feedback = latest_sample[:3]
+            encoder_count = latest_sample[3]
+
+        with self.publish_lock:
+            self.state.publish(feedback + (motor.position_tracker.absolute_position,
+                                           encoder_count,
+                                           motor.position_tracker.absolute_count,
+                                           self.feedback_count,
+                                           status_message.pulses_remaining,
+                                           status_message.status_byte,
+                                           status_message.job_id,
+                                           status_message.microstep,
+                                           motor.current_job_id,
+                                           motor.job_active,
+                                           motor.job_pending,
+                                           motor.at_commanded_position,
+                                           motor.connected,
+                                           ))
+
+    def send(self, message: tuple):
+        with self.send_lock:
+            try:
+                self.connection.send(message)
+
+            except Exception as e:
+                # Unpicklable result, the parent still gets an answer
+                if message[0] in (VALUE, RESULT):
+                    self.connection.send((ERROR, message[1], TypeError(f"Result can't be sent to the parent: {e}")))
+
+    def send_result(self, call_id: int, future: Future):
+        if future.cancelled():
+            self.send((ERROR, call_id, None))
+
+        elif future.exception() is not None:
+            self.send((ERROR, call_id, future.exception()))
+
+        else:
+            self.send((RESULT, call_id, future.result()))
+
+    def run(self):
+        self.motor.start_threads()
+        self.running = True
+        self.publish()
+        self.send((STARTED, 0, self.motor.connected))
+
+        while self.running:
+            try:
+                message = self.connection.recv()
+
+            except (EOFError, OSError):
+                break
+
+            kind, call_id = message[:2]
+
+            if kind == EXIT:
+                self.running = False
+
+            elif kind == GET:
+                try:
+                    self.send((VALUE, call_id, getattr(self.motor, message[2])))
+
+                except Exception as e:
+                    self.send((ERROR, call_id, e))
+
+            elif kind == CALL:
+                name, args, kwargs = message[2:]
+
+                try:
+                    result = getattr(self.motor, name)(*args, **kwargs)
+
+                except Exception as e:
+                    self.send((ERROR, call_id, e))
+
+                else:
+                    if isinstance(result, Future):
+                        self.send((PENDING, call_id, None))
+                        result.add_done_callback(lambda done_future, done_id=call_id: self.send_result(done_id, done_future))
+                    else:
+                        self.send((VALUE, call_id, result))
+
+                self.publish()
+
+        if self.motor.running:
+            self.motor.running = False
+            self.motor.read_thread.join()
+            self.motor.updating_thread.join()
+            self.motor.ser.close()
+            self.motor.command_scheduler.clear()
+            self.motor.command_tracker.cancel_all()
+            self.motor.stop_recording()
+
+        self.motor.connected = False
+        self.publish()
+        self.send((VALUE, 0, None))
+
+
+def run_motor_worker(definitions_filepath: Path,
+                     serial_port: Union[str, None],
+                     motor_kwargs: dict,
+                     shared_memory_name: str,
+                     connection,
+                     worker_setup,
+                     ):
+    """
+    Description:
+        Worker process entry point.
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+
+    try:
+        motor = Motor(definitions_filepath=definitions_filepath, serial_port=serial_port, **motor_kwargs)
+        worker = MotorWorker(motor, SharedMotorState(shared_memory.buf), connection)
+
+        if worker_setup is not None:
+            worker_setup(motor)
+
+        worker.run()
+
+    finally:
+        connection.close()
+        shared_memory.close()
+
+
+class MotorProcess:
+    def __init__(self,
+                 definitions_filepath: Path,
+                 serial_port: Union[str, None] = None,
+                 worker_setup=None,
+                 call_timeout: float = 5.0,
+                 start_method: str = 'spawn',
+                 **motor_kwargs,
+                 ):
+        """
+        Description:
+            Drop in for Motor with its I/O in a worker process, so many axes no longer share one GIL.
+            Position, velocity, status and job state are read straight from shared memory without a round trip.
+            Any other Motor method is called in the worker and returns what it returns there, Futures are
+            completed in this process when the worker's complete.
+            Handlers and other code that must run next to the motor go in worker_setup(motor), which has to be
+            picklable, e.g. a module level function.
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            serial_port (str): Default serial port path as string
+            worker_setup (callable): Called with the worker's Motor before its threads start
+            call_timeout (float): Time to wait for the worker to accept a call, in seconds
+            start_method (str): multiprocessing start method, spawn avoids forking the caller's threads
+            motor_kwargs: Passed to Motor, e.g. command_timeout, settle_mode
+        """
+        self.definitions_filepath = definitions_filepath
+        self.serial_port_name = serial_port
+        self.call_timeout = call_timeout
+
+        definitions = load_protocol(definitions_filepath).require_serial()
+        self.definitions = definitions
+        self.status_bits = StatusBits(definitions)
+        self.radians_per_encoder_pulse = 2 * math.pi / definitions['encoder_settings']['ENCODER_PULSES_PER_REVOLUTION']
+        self.encoder_setpoint_tolerance = definitions['encoder_settings']['ENCODER_SETPOINT_TOLERANCE']
+
+        self.shared_memory = SharedMemory(create=True, size=SharedMotorState.size)
+        self.state = SharedMotorState(self.shared_memory.buf)
+        self.state.publish((0.0, 0.0, 0.0, 0.0, 0, 0, 0, 0, 0, 0, 1, 0, False, False, True, False))
+
+        context = multiprocessing.get_context(start_method)
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=run_motor_worker,
+                                       args=(definitions_filepath,
+                                             serial_port,
+                                             motor_kwargs,
+                                             self.shared_memory.name,
+                                             worker_connection,
+                                             worker_setup),
+                                       daemon=True)
+
+        self.worker_connection = worker_connection
+        self.call_ids = itertools.count(1)
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.started = Future()
+        self.exited = Future()
+        self.reply_thread = None
+
+    def start_threads(self):
+        """
+        Description:
+            Starts the worker, which opens the serial port and starts the motor's threads.
+
+        Returns:
+            connected: (bool)
+        """
+        self.process.start()
+        self.worker_connection.close()
+        self.reply_thread = threading.Thread(target=self.reply_loop, daemon=True)
+        self.reply_thread.start()
+
+        return self.started.result(timeout=self.call_timeout + 10.0)
+
+    def reply_loop(self):
+        while True:
+            try:
+                kind, call_id, value = self.connection.recv()
+
+            except (EOFError, OSError):
+                break
+
+            if kind == STARTED:
+                self.started.set_result(value)
+                continue
+
+            if call_id == 0:
+                self.exited.set_result(None)
+                continue
+
+            with self.calls_lock:
+                accepted, completed = self.calls.get(call_id, (None, None))
+
+                if kind != PENDING:
+                    self.calls.pop(call_id, None)
+
+            if accepted is None:
+                continue
+
+            if kind == PENDING:
+                accepted.set_result(completed)
+
+            elif kind == VALUE:
+                accepted.set_result(value)
+
+            elif kind == RESULT:
+                completed.set_result(value)
+
+            elif kind == ERROR:
+                target = accepted if not accepted.done() else completed
+
+                if value is None:
+                    target.cancel()
+                else:
+                    target.set_exception(value)
+
+        # Worker gone, nothing outstanding will be answered
+        error = WorkerExitedError("Motor worker process exited")
+
+        with self.calls_lock:
+            outstanding = list(self.calls.values())
+            self.calls.clear()
+
+        for accepted, completed in outstanding:
+            for future in (accepted, completed):
+                if not future.done():
+                    future.set_exception(error)
+
+        for future in (self.started, self.exited):
+            if not future.done():
+                future.set_exception(error)
+
+    def request(self, message: tuple):
+        call_id = next(self.call_ids)
+        accepted = Future()
+
+        with self.calls_lock:
+            self.calls[call_id] = (accepted, Future())
+
+        try:
+            with self.send_lock:
+                self.connection.send((message[0], call_id) + message[1:])
+
+        except Exception:
+            with self.calls_lock:
+                self.calls.pop(call_id, None)
+            raise
+
+        return accepted.result(timeout=self.call_timeout)
+
+    def call(self, name: str, *args, **kwargs):
+        """
+        Description:
+            Calls a Motor method in the worker, exceptions raised there are raised here.
+
+        Returns:
+            result: what the method returned, a Future resolved from the worker when it returned one
+        """
+        return self.request((CALL, name, args, kwargs))
+
+    def get_remote_attribute(self, name: str):
+        return self.request((GET, name))
+
+    def __getattr__(self, name: str):
+        # Only reached for names not defined here
+        if name.startswith('_') or 'connection' not in self.__dict__:
+            raise AttributeError(name)
+
+        if callable(getattr(Motor, name, None)):
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+        return self.get_remote_attribute(name)
+
+    def stop(self):
+        """
+        Description:
+            Stops the motor as Motor.stop does, then the worker, and frees the shared memory.
+        """
+        if self.process.is_alive() and self.state.read()[field_index['connected']]:
+            self.call('stop')
+
+        self.close()
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                with self.send_lock:
+                    self.connection.send((EXIT, 0))
+
+                self.exited.result(timeout=self.call_timeout)
+
+            except Exception:
+                pass
+
+        self.process.join(timeout=self.call_timeout)
+
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.connection.close()
+
+        if self.reply_thread is not None:
+            self.reply_thread.join()
+
+        self.state.buffer = None
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+    def state_value(self, name: str):
+        return self.state.read()[field_index[name]]
+
+    def snapshot(self):
+        """
+        Description:
+            Every published field from one consistent read, see state_fields.
+        """
+        return self.state.snapshot()
+
+    @property
+    def connected(self):
+        return self.state_value('connected')
+
+    @property
+    def job_active(self):
+        return self.state_value('job_active')
+
+    @property
+    def job_pending(self):
+        return self.state_value('job_pending')
+
+    @property
+    def at_commanded_position(self):
+        return self.state_value('at_commanded_position')
+
+    @property
+    def current_job_id(self):
+        return self.state_value('current_job_id')
+
+    @property
+    def current_motor_velocity(self):
+        return self.state_value('velocity')
+
+    @property
+    def current_motor_position(self):
+        return self.state_value('position')
+
+    @property
+    def current_motor_encoder_count(self):
+        return self.state_value('encoder_count')
+
+    @property
+    def status_message(self):
+        values = self.state.read()
+        return StatusMessage(values[field_index['status_byte']],
+                             values[field_index['status_job_id']],
+                             values[field_index['microstep']],
+                             values[field_index['pulses_remaining']],
+                             self.status_bits)
+
+    @property
+    def status_message_dict(self):
+        return self.status_message.as_dict()
+
+    def get_rotor_position(self):
+        return self.current_motor_position
+
+    def get_absolute_rotor_position(self):
+        return self.state_value('absolute_position')
+
+    def motor_is_at_count(self, target_count: int):
+        return abs(target_count - self.state_value('absolute_count')) < self.encoder_setpoint_tolerance
+
+    def is_ready_for_job(self):
+        values = self.state.read()
+        return not values[field_index['job_active']] and not values[field_index['job_pending']]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs one worker process per motor and prints their positions")
+    parser.add_argument('serial_ports', nargs='+')
+    parser.add_argument('--definitions', type=Path, default=Path(__file__).resolve().parents[1] / 'arduino/engineering-team-motor/definitions.h')
+    parser.add_argument('--period', type=float, default=0.5)
+    arguments = parser.parse_args()
+
+    motors = [MotorProcess(definitions_filepath=arguments.definitions, serial_port=port) for port in arguments.serial_ports]
+
+    for motor in motors:
+        motor.start_threads()
+
+    try:
+        while True:
+            time.sleep(arguments.period)
+            print(" ".join(f"{motor.serial_port_name}: {motor.get_rotor_position():.3f}" for motor in motors))
+
+    except KeyboardInterrupt:
+        for motor in motors:
+            motor.stop()
@@ -0,0 +1,39 @@
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Compiled, cached firmware protocol definitions. Names are imported on first use so importing the package
+    costs nothing until a protocol is needed
+"""
+
+import importlib
+
+_exports = {'Protocol': '.protocol',
+            'ProtocolError': '.protocol',
+            'compile_header': '.compiler',
+            'load_protocol': '.compiler',
+            'find_definitions': '.compiler',
+            'tokenise_header': '.compiler',
+            'validate_sections': '.compiler',
+            'default_cache_directory': '.compiler',
+            'COMPILER_VERSION': '.compiler',
+            }
+
+__all__ = list(_exports)
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
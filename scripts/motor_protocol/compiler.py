@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Compiles a firmware definitions.h into a validated Protocol. Compiled sections are cached on disk keyed by the
+    header's content hash, so a restarted process skips tokenising and validation
+"""
+
+import os
+import re
+import json
+import struct
+import hashlib
+from pathlib import Path
+from typing import Union
+
+from .protocol import Protocol, ProtocolError, static_command_names, job_command_formats, message_formats, short_feedback_format, timestamped_message_formats
+from .protocol import feedback_batch_sample_format
+
+# Part of every cache key, bump when compiled output changes
+COMPILER_VERSION = 2
+
+# Section names that differ between firmware variants, the basic firmware calls motor_settings "motor"
+section_aliases = {'motor': 'motor_settings'}
+
+# What a header must define to be used over the serial protocol
+serial_requirements = {'serial_settings': ('BAUD_RATE', 'STX', 'ETX', 'ACK', 'NAK'),
+                       'encoder_settings': ('ENCODER_UPDATE_PERIOD_US', 'ENCODER_PULSES_PER_REVOLUTION', 'ENCODER_SETPOINT_TOLERANCE'),
+                       'status_message_bits': ('STATUS_DIRECTION_BIT', 'STATUS_FAULT_BIT', 'STATUS_PAUSED_BIT', 'STATUS_RAMPING_BIT',
+                                               'STATUS_ENABLED_BIT', 'STATUS_RUNNING_BIT', 'STATUS_SLEEP_BIT'),
+                       'message_types': ('MOTOR_STATUS_MESSAGE_ID', 'MOTOR_FEEDBACK_MESSAGE_ID', 'RESPONSE_MESSAGE_ID',
+                                         'JOB_COMPLETE_MESSAGE_ID', 'JOB_CANCELLED_MESSAGE_ID'),
+                       'command_types': static_command_names + ('SEND_JOB', 'SEND_JOB_WITH_RAMPING', 'SEND_JOB_ALL_VARIABLES',
+                                                                'SEND_JOB_ALL_VARIABLES_WITH_RAMPING'),
+                       'response_types': (),
+                       'motor_settings': ('MOTOR_STEPS_PER_REV', 'DEFAULT_PULSE_ON_PERIOD', 'DEFAULT_PULSE_INTERVAL',
+                                          'MINIMUM_PULSE_INTERVAL', 'MAXIMUM_PULSE_INTERVAL'),
+                       }
+basic_requirements = {'encoder_settings': ('ENCODER_PULSES_PER_REVOLUTION',),
+                      'motor_settings': ('MOTOR_STEPS_PER_REV',),
+                      }
+
+section_pattern = re.compile(r'^//\s*([A-Za-z_][A-Za-z0-9_]*)\s*$')
+define_pattern = re.compile(r'^#define\s+([A-Za-z_][A-Za-z0-9_]*)(?:\s+(.*?))?\s*$')
+integer_pattern = re.compile(r'^(0[xX][0-9A-Fa-f]+|[0-9]+)[uUlL]*$')
+
+# In process memo, (content hash, header path) -> Protocol
+compiled_protocols = {}
+
+
+def default_cache_directory():
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'engineering-team-motor' / 'protocols'
+
+
+def default_firmware_directory():
+    return Path(__file__).resolve().parents[2] / 'arduino'
+
+
+def content_hash(header_bytes: bytes):
+    return hashlib.sha256(f"motor_protocol {COMPILER_VERSION}\n".encode() + header_bytes).hexdigest()
+
+
+def tokenise_header(text: str, header_path: Union[Path, None] = None):
+    """
+    Description:
+        Splits a definitions.h into sections. "// name" starts a section, "#define NAME value" adds to it.
+        Other comment lines are skipped, anything else that can't be represented is an error rather than being
+        dropped: defines before the first section, defines without an integer value, repeated names or sections.
+        Comments after a define's value are allowed.
+
+    Returns:
+        sections: (dict) section name -> {define name -> int}, aliases resolved
+    """
+    sections = {}
+    defined = {}
+    section = None
+
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        section_match = section_pattern.match(line)
+
+        if section_match:
+            section = section_aliases.get(section_match.group(1), section_match.group(1))
+
+            if section in sections:
+                raise ProtocolError(f"Section {section} appears twice", header_path, line_number)
+
+            sections[section] = {}
+            continue
+
+        if line.startswith('//') or line.startswith('/*') or line.startswith('*'):
+            continue
+
+        define_match = define_pattern.match(line.split('//')[0].strip())
+
+        if define_match is None:
+            raise ProtocolError(f"Unexpected line {line!r}", header_path, line_number)
+
+        name, value = define_match.groups()
+
+        if section is None:
+            raise ProtocolError(f"{name} is defined before the first section comment", header_path, line_number)
+
+        if value is None or integer_pattern.match(value) is None:
+            raise ProtocolError(f"{name} needs an integer value, got {value!r}", header_path, line_number)
+
+        if name in defined:
+            raise ProtocolError(f"{name} is already defined on line {defined[name]}", header_path, line_number)
+
+        sections[section][name] = int(value.rstrip('uUlL'), 0)
+        defined[name] = line_number
+
+    return sections
+
+
+def validate_sections(sections: dict, header_path: Union[Path, None] = None):
+    """
+    Description:
+        Checks a header has what its variant needs and that ids can be told apart on the wire.
+
+    Returns:
+        serial_protocol: (bool) the header describes the binary serial protocol
+    """
+    serial_protocol = 'serial_settings' in sections
+    requirements = serial_requirements if serial_protocol else basic_requirements
+
+    for section, names in requirements.items():
+        if section not in sections:
+            raise ProtocolError(f"Missing section {section}", header_path)
+
+        missing = [name for name in names if name not in sections[section]]
+
+        if missing:
+            raise ProtocolError(f"Section {section} is missing {', '.join(missing)}", header_path)
+
+    if not serial_protocol:
+        return False
+
+    serial_settings = sections['serial_settings']
+
+    for name in ('STX', 'ETX', 'ACK', 'NAK'):
+        if not 0 <= serial_settings[name] <= 0xFF:
+            raise ProtocolError(f"{name} 0x{serial_settings[name]:X} does not fit in a byte", header_path)
+
+    if serial_settings['STX'] == serial_settings['ETX'] or serial_settings['ACK'] == serial_settings['NAK']:
+        raise ProtocolError("STX / ETX and ACK / NAK must differ", header_path)
+
+    for section in ('message_types', 'command_types', 'response_types'):
+        values = sections[section]
+
+        for name, value in values.items():
+            if not 0 <= value <= 0xFF:
+                raise ProtocolError(f"{name} 0x{value:X} does not fit in a byte", header_path)
+
+        if len(set(values.values())) != len(values):
+            duplicates = sorted(name for name, value in values.items() if list(values.values()).count(value) > 1)
+            raise ProtocolError(f"{section} share ids: {', '.join(duplicates)}", header_path)
+
+    overlap = set(sections['message_types'].values()) & set(sections['command_types'].values())
+
+    if overlap:
+        raise ProtocolError(f"Ids used as both message and command: {', '.join(f'0x{value:02X}' for value in sorted(overlap))}", header_path)
+
+    bits = sections['status_message_bits']
+
+    if any(not 0 <= bit <= 7 for bit in bits.values()) or len(set(bits.values())) != len(bits):
+        raise ProtocolError("status_message_bits must be distinct bits of one byte", header_path)
+
+    # Lengths count the message bytes between the length byte and ETX
+    message_lengths = sections.get('message_lengths', {})
+
+    for id_name, message_format in message_formats.items():
+        length_name = id_name.replace('_ID', '_LENGTH')
+
+        if length_name in message_lengths:
+            expected = {len_from(message_format)}
+
+            if id_name == 'MOTOR_FEEDBACK_MESSAGE_ID':
+                expected.add(len_from(short_feedback_format))
+
+            if message_lengths[length_name] not in expected:
+                raise ProtocolError(f"{length_name} {message_lengths[length_name]} does not match the decoder, expected {sorted(expected)}", header_path)
+
+    for id_name, message_format in timestamped_message_formats.items():
+        length_name = id_name.replace('_MESSAGE_ID', '_TIMESTAMPED_MESSAGE_LENGTH')
+
+        if length_name in message_lengths and message_lengths[length_name] != len_from(message_format):
+            raise ProtocolError(f"{length_name} {message_lengths[length_name]} does not match the decoder, expected {len_from(message_format)}", header_path)
+
+    sample_length = message_lengths.get('MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH')
+
+    if sample_length is not None:
+        if sample_length != struct.calcsize(feedback_batch_sample_format):
+            raise ProtocolError(f"MOTOR_FEEDBACK_BATCH_SAMPLE_LENGTH {sample_length} does not match the decoder, expected {struct.calcsize(feedback_batch_sample_format)}", header_path)
+
+        # The length byte counts STX, length, ID, sample count, samples and ETX
+        if 5 + message_lengths.get('MOTOR_FEEDBACK_BATCH_MAX_SAMPLES', 1) * sample_length > 255:
+            raise ProtocolError("MOTOR_FEEDBACK_BATCH_MAX_SAMPLES samples do not fit in one frame", header_path)
+
+    buffer_length = serial_settings.get('SERIAL_BUFFER_LENGTH')
+
+    if buffer_length is not None:
+        for name, job_format in job_command_formats.items():
+            if name in sections['command_types'] and len_from(job_format) + 1 > buffer_length:
+                raise ProtocolError(f"{name} frame is longer than SERIAL_BUFFER_LENGTH", header_path)
+
+    return True
+
+
+def len_from(struct_format: str):
+    # Message length as the firmware counts it, without ETX
+    return struct.calcsize(struct_format) - 1
+
+
+def compile_header(header_path: Path, cache_directory: Union[Path, None] = None, use_cache: bool = True):
+    """
+    Description:
+        Compiles a definitions.h, from the in process memo or disk cache when its contents have been seen before.
+        A cache that can't be read or written is ignored.
+
+    Args:
+        header_path (Path): Path to a definitions.h
+        cache_directory (Path): Where compiled headers are kept, default_cache_directory() if None
+        use_cache (bool): Read and write the disk cache
+
+    Returns:
+        protocol: (Protocol)
+    """
+    header_path = Path(header_path)
+
+    if not header_path.is_file():
+        raise ProtocolError("Filepath is not a file", header_path)
+
+    header_bytes = header_path.read_bytes()
+    key = content_hash(header_bytes)
+    variant = header_path.resolve().parent.name
+
+    protocol = compiled_protocols.get((key, header_path))
+
+    if protocol is not None:
+        return protocol
+
+    cache_path = (default_cache_directory() if cache_directory is None else Path(cache_directory)) / f"{key}.json"
+    sections = None
+
+    if use_cache:
+        try:
+            with open(cache_path, "r") as cache_file:
+                cached = json.load(cache_file)
+
+            if cached.get("compiler_version") == COMPILER_VERSION:
+                sections = cached["sections"]
+
+        except (OSError, ValueError, KeyError):
+            sections = None
+
+    if sections is None:
+        sections = tokenise_header(header_bytes.decode(), header_path)
+        validate_sections(sections, header_path)
+
+        if use_cache:
+            write_cache(cache_path, sections)
+
+    protocol = Protocol(sections, variant=variant, header_path=header_path, content_hash=key)
+    compiled_protocols[(key, header_path)] = protocol
+
+    return protocol
+
+
+def write_cache(cache_path: Path, sections: dict):
+    temporary_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(temporary_path, "w") as cache_file:
+            json.dump({"compiler_version": COMPILER_VERSION, "sections": sections}, cache_file)
+
+        # Atomic, concurrent writers leave one complete file
+        os.replace(temporary_path, cache_path)
+
+    except OSError:
+        try:
+            os.unlink(temporary_path)
+        except OSError:
+            pass
+
+
+def find_definitions(firmware_directory: Union[Path, None] = None, variant: Union[str, None] = None):
+    """
+    Description:
+        Picks a definitions.h from the firmware directories, e.g. arduino/engineering-team-motor.
+        With no variant the header speaking the serial protocol is chosen, there must be exactly one.
+
+    Args:
+        firmware_directory (Path): Directory holding one directory per firmware, the repository's arduino/ if None
+        variant (str): Firmware directory name, '-' and '_' are treated alike
+
+    Returns:
+        header path: (Path)
+    """
+    firmware_directory = default_firmware_directory() if firmware_directory is None else Path(firmware_directory)
+    candidates = sorted(firmware_directory.glob('*/definitions.h'))
+
+    if not candidates:
+        raise ProtocolError("No */definitions.h found", firmware_directory)
+
+    if variant is not None:
+        wanted = variant.replace('-', '_')
+
+        for candidate in candidates:
+            if candidate.parent.name.replace('-', '_') == wanted:
+                return candidate
+
+        raise ProtocolError(f"No firmware named {variant}, found {', '.join(candidate.parent.name for candidate in candidates)}", firmware_directory)
+
+    serial_candidates = [candidate for candidate in candidates if compile_header(candidate).serial_protocol]
+
+    if len(serial_candidates) != 1:
+        raise ProtocolError(f"{len(serial_candidates)} firmware variants speak the serial protocol, pass variant", firmware_directory)
+
+    return serial_candidates[0]
+
+
+def load_protocol(source: Union[Protocol, Path, str, None] = None,
+                  variant: Union[str, None] = None,
+                  cache_directory: Union[Path, None] = None,
+                  use_cache: bool = True,
+                  ):
+    """
+    Description:
+        Protocol from whatever identifies a firmware.
+
+    Args:
+        source: A Protocol (returned as is), a definitions.h, a firmware directory, a directory of firmware
+                directories, or None for the repository's arduino/
+        variant (str): Firmware directory name when source holds several
+        cache_directory (Path): See compile_header
+        use_cache (bool): See compile_header
+
+    Returns:
+        protocol: (Protocol)
+    """
+    if isinstance(source, Protocol):
+        return source
+
+    if source is None or Path(source).is_dir():
+        directory = None if source is None else Path(source)
+
+        if directory is not None and (directory / 'definitions.h').is_file():
+            header_path = directory / 'definitions.h'
+        else:
+            header_path = find_definitions(directory, variant)
+
+    else:
+        header_path = Path(source)
+
+    return compile_header(header_path, cache_directory=cache_directory, use_cache=use_cache)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Immutable, validated view of a firmware definitions.h with the lookup tables and struct codecs built from it
+"""
+
+import struct
+from types import MappingProxyType
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Union
+
+
+class ProtocolError(Exception):
+    def __init__(self, message: str, header_path: Union[Path, None] = None, line_number: Union[int, None] = None):
+        location = ""
+
+        if header_path is not None:
+            location = f"{header_path}:{line_number}: " if line_number is not None else f"{header_path}: "
+
+        super().__init__(location + message)
+        self.header_path = header_path
+        self.line_number = line_number
+
+    def __reduce__(self):
+        return self.__class__, (self.args[0], None, None)
+
+
+# Commands without a payload, sent as {STX, length, COMMAND, ETX}
+static_command_names = ('PAUSE_JOB',
+                        'RESUME_JOB',
+                        'CANCEL_JOB',
+                        'ENABLE_MOTOR',
+                        'DISABLE_MOTOR',
+                        'SLEEP_MOTOR',
+                        'WAKE_MOTOR',
+                        'RESET_MOTOR',
+                        )
+
+# {STX, length, COMMAND, direction, microstep, job_id, fields..., ETX}, see CommandCodec
+job_command_formats = {'SEND_JOB': '!6BIB',
+                       'SEND_JOB_WITH_RAMPING': '!6B2IB',
+                       'SEND_JOB_ALL_VARIABLES': '!6B3IB',
+                       'SEND_JOB_ALL_VARIABLES_WITH_RAMPING': '!6B4IB',
+                       'SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE': '!6B4I2B',
+                       }
+
+# Message contents followed by ETX, see MessageDispatcher. Feedback depends on MOTOR_FEEDBACK_MESSAGE_LENGTH
+message_formats = {'MOTOR_STATUS_MESSAGE_ID': '<4BLB',
+                   'MOTOR_FEEDBACK_MESSAGE_ID': '<B2fiB',
+                   'MOTOR_FAULT_MESSAGE_ID': '<2B',
+                   'RESPONSE_MESSAGE_ID': '<6B',
+                   'JOB_COMPLETE_MESSAGE_ID': '<3B',
+                   'JOB_CANCELLED_MESSAGE_ID': '<3B',
+                   }
+short_feedback_format = '<B2fhB'
+
+# Status and feedback once SET_TIMESTAMPS is acknowledged, the firmware micros() of the sample is appended
+timestamped_message_formats = {'MOTOR_STATUS_MESSAGE_ID': '<4BLLB',
+                               'MOTOR_FEEDBACK_MESSAGE_ID': '<B2fiLB',
+                               }
+
+# Commands carrying one setting byte, sent as {STX, length, COMMAND, value, ETX}
+setting_command_names = ('SET_TIMESTAMPS',)
+
+# MOTOR_FEEDBACK_BATCH messages are {ID, sample count, samples..., ETX}, each sample {micros, velocity, encoder count}
+feedback_batch_sample_format = '<Lfi'
+
+
+class Protocol(Mapping):
+    __slots__ = ('sections',
+                 'variant',
+                 'header_path',
+                 'content_hash',
+                 'serial_protocol',
+                 'command_ids',
+                 'command_names',
+                 'message_ids',
+                 'message_names',
+                 'response_names',
+                 'status_masks',
+                 'static_frames',
+                 'job_structs',
+                 'message_structs',
+                 )
+
+    def __init__(self, sections: dict, variant: str, header_path: Union[Path, None] = None, content_hash: str = ''):
+        """
+        Description:
+            Built by motor_protocol.compile_header from sections that have already been validated.
+            Reads like the dict from parse_definitions_file, protocol['command_types']['CANCEL_JOB'], so it can
+            be handed to anything taking definitions, but neither it nor its sections can be changed.
+
+        Args:
+            sections (dict): Section name -> {define name -> int}
+            variant (str): Firmware directory the header belongs to, e.g. engineering-team-motor
+            header_path (Path): Header the protocol was compiled from
+            content_hash (str): sha256 of the header contents and compiler version
+        """
+        frozen = {name: MappingProxyType(dict(values)) for name, values in sections.items()}
+        setter = object.__setattr__
+        setter(self, 'sections', MappingProxyType(frozen))
+        setter(self, 'variant', variant)
+        setter(self, 'header_path', header_path)
+        setter(self, 'content_hash', content_hash)
+        setter(self, 'serial_protocol', 'serial_settings' in frozen)
+
+        command_types = frozen.get('command_types', {})
+        message_types = frozen.get('message_types', {})
+        response_types = frozen.get('response_types', {})
+        status_bits = frozen.get('status_message_bits', {})
+
+        setter(self, 'command_ids', command_types)
+        setter(self, 'command_names', MappingProxyType({value: name for name, value in command_types.items()}))
+        setter(self, 'message_ids', message_types)
+        setter(self, 'message_names', MappingProxyType({value: name for name, value in message_types.items()}))
+        setter(self, 'response_names', MappingProxyType({value: name for name, value in response_types.items()}))
+        setter(self, 'status_masks', MappingProxyType({name: 1 << bit for name, bit in status_bits.items()}))
+
+        static_frames = {}
+        job_structs = {}
+        message_structs = {}
+
+        if self.serial_protocol:
+            serial_settings = frozen['serial_settings']
+            static_struct = struct.Struct('!4B')
+
+            for name in static_command_names:
+                if name in command_types:
+                    static_frames[name] = static_struct.pack(serial_settings['STX'], static_struct.size, command_types[name], serial_settings['ETX'])
+
+            for name, job_format in job_command_formats.items():
+                if name in command_types:
+                    job_structs[command_types[name]] = struct.Struct(job_format)
+
+            for name, message_format in message_formats.items():
+                if name in message_types:
+                    message_structs[message_types[name]] = struct.Struct(message_format)
+
+            if frozen.get('message_lengths', {}).get('MOTOR_FEEDBACK_MESSAGE_LENGTH') == struct.calcsize(short_feedback_format) - 1:
+                message_structs[message_types['MOTOR_FEEDBACK_MESSAGE_ID']] = struct.Struct(short_feedback_format)
+
+        setter(self, 'static_frames', MappingProxyType(static_frames))
+        setter(self, 'job_structs', MappingProxyType(job_structs))
+        setter(self, 'message_structs', MappingProxyType(message_structs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Protocol is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Protocol is immutable")
+
+    def __getitem__(self, section: str):
+        return self.sections[section]
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __hash__(self):
+        return hash(self.content_hash)
+
+    def __eq__(self, other):
+        if isinstance(other, Protocol):
+            return self.content_hash == other.content_hash and self.variant == other.variant
+
+        return Mapping.__eq__(self, other)
+
+    def __reduce__(self):
+        return self.__class__, (self.as_dict(), self.variant, self.header_path, self.content_hash)
+
+    def __repr__(self):
+        return f"Protocol(variant={self.variant!r}, serial_protocol={self.serial_protocol}, content_hash={self.content_hash[:12]!r})"
+
+    def as_dict(self):
+        """
+        Description:
+            Plain, mutable copy of the sections, as parse_definitions_file returns.
+        """
+        return {name: dict(values) for name, values in self.sections.items()}
+
+    def require_serial(self):
+        """
+        Description:
+            Raises ProtocolError unless the firmware speaks the binary serial protocol, e.g. the basic firmware doesn't.
+        """
+        if not self.serial_protocol:
+            raise ProtocolError(f"{self.variant} firmware has no serial protocol (no serial_settings section)", self.header_path)
+
+        return self
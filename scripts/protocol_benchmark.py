@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Latency and throughput benchmarks for the host side protocol stack, results are written as JSON
+    so runs can be compared between changes.
+"""
+
+import io
+import sys
+import json
+import time
+import struct
+import random
+import argparse
+import platform
+import contextlib
+import numpy as np
+from typing import Union
+from pathlib import Path
+
+from motor import Motor
+from virtual_motor import VirtualMotor
+
+BENCHMARKS = ('frame_parse', 'command_encode', 'round_trip', 'feedback_visibility')
+
+
+def summarise(name: str, latencies_ns: Union[list, np.ndarray], elapsed_s: float, count: int, **extra):
+    """
+    Description:
+        Percentile summary of a list of latencies in nanoseconds.
+    """
+    latencies_us = np.asarray(latencies_ns, dtype=np.float64) / 1e3
+
+    result = {"benchmark": name,
+              "count": count,
+              "elapsed_s": elapsed_s,
+              "throughput_per_s": count / elapsed_s if elapsed_s > 0 else None,
+              }
+
+    if len(latencies_us) > 0:
+        result["latency_us"] = {"mean": float(latencies_us.mean()),
+                                "p50": float(np.percentile(latencies_us, 50)),
+                                "p90": float(np.percentile(latencies_us, 90)),
+                                "p99": float(np.percentile(latencies_us, 99)),
+                                "p999": float(np.percentile(latencies_us, 99.9)),
+                                "max": float(latencies_us.max()),
+                                }
+
+    result.update(extra)
+    return result
+
+
+class RecordedSerial:
+    def __init__(self, stream: bytes, chunk_length: int = 4096):
+        """
+        Description:
+            Stands in for serial.Serial, hands out a recorded byte stream in chunks as in_waiting / readinto
+        """
+        self.stream = memoryview(stream)
+        self.position = 0
+        self.chunk_length = chunk_length
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk_length, len(self.stream) - self.position)
+
+    def readinto(self, buffer):
+        length = min(len(buffer), len(self.stream) - self.position)
+        buffer[:length] = self.stream[self.position:self.position + length]
+        self.position += length
+        return length
+
+    def fill_framer(self, framer):
+        return framer.fill_from(self, self.in_waiting)
+
+
+def synthetic_stream(motor: Motor, number_of_frames: int, corruption_rate: float = 0.0, seed: int = 0):
+    """
+    Description:
+        Builds a byte stream with the firmware's mix of frames, 25 feedback frames per status frame plus
+        responses and job complete messages. Optionally corrupts a fraction of the frames.
+    """
+    generator = random.Random(seed)
+    frames = []
+
+    for index in range(number_of_frames):
+        selector = index % 28
+
+        if selector < 25:
+            message = struct.pack('<B2fi', motor.motor_feedback_message_id, generator.random(), generator.random() * 6.28, index % 2400)
+        elif selector == 25:
+            message = struct.pack('<4BL', motor.motor_status_message_id, 0x60, 1, 4, index)
+        elif selector == 26:
+            message = bytes((motor.response_message_id, motor.command_dict['SEND_JOB'], 1, 0, motor.ACK))
+        else:
+            message = bytes((motor.job_complete_message_id, 1))
+
+        frame = bytearray((motor.STX, len(message) + 3)) + message + bytes((motor.ETX,))
+
+        if corruption_rate > 0 and generator.random() < corruption_rate:
+            del frame[generator.randrange(len(frame))]
+
+        frames.append(bytes(frame))
+
+    return b''.join(frames)
+
+
+def benchmark_frame_parse(motor: Motor, stream: bytes, chunk_length: int = 4096):
+    """
+    Description:
+        Frames per second through get_serial_message, latency is per returned frame.
+    """
+    motor.ser = RecordedSerial(stream, chunk_length=chunk_length)
+    motor.framer.reset()
+
+    latencies = []
+    frames = 0
+    perf_counter_ns = time.perf_counter_ns
+    get_serial_message = motor.get_serial_message
+
+    start = time.perf_counter()
+    t0 = perf_counter_ns()
+    message_id, _ = get_serial_message()
+
+    while message_id != 0 or motor.ser.in_waiting > 0:
+        t1 = perf_counter_ns()
+
+        if message_id != 0:
+            latencies.append(t1 - t0)
+            frames += 1
+
+        t0 = t1
+        message_id, _ = get_serial_message()
+
+    elapsed = time.perf_counter() - start
+
+    return summarise("frame_parse", latencies, elapsed, frames,
+                     stream_bytes=len(stream),
+                     chunk_length=chunk_length,
+                     framer=motor.framer.get_statistics())
+
+
+def benchmark_command_encode(motor: Motor, iterations: int = 100000):
+    """
+    Description:
+        Encode rate of every send_motor_pulses variant, frames go to a sink instead of the send queue.
+    """
+    variants = {"SEND_JOB": {},
+                "SEND_JOB_WITH_RAMPING": {"use_ramping": True, "ramping_steps": 50},
+                "SEND_JOB_ALL_VARIABLES": {"pulse_on_period": 500},
+                "SEND_JOB_ALL_VARIABLES_WITH_RAMPING": {"pulse_on_period": 500, "use_ramping": True, "ramping_steps": 50},
+                "SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE": {"pulse_on_period": 500, "use_ramping": True, "ramping_steps": 50, "ramp_scaler": 4},
+                }
+
+    sink = []
+    motor.send_command = sink.append
+    results = []
+    perf_counter_ns = time.perf_counter_ns
+
+    for variant, kwargs in variants.items():
+        latencies = np.empty(iterations, dtype=np.int64)
+        sink.clear()
+        start = time.perf_counter()
+
+        for index in range(iterations):
+            t0 = perf_counter_ns()
+            motor.send_motor_pulses(direction=True, microstep=8, pulses=1600, pulse_interval=2000, job_id=index & 0xFF, **kwargs)
+            latencies[index] = perf_counter_ns() - t0
+
+        elapsed = time.perf_counter() - start
+        results.append(summarise(f"command_encode.{variant}", latencies, elapsed, iterations, frame_length=len(sink[-1])))
+
+    del motor.send_command
+    return results
+
+
+class StampedVirtualMotor(VirtualMotor):
+    def __init__(self, *args, **kwargs):
+        """
+        Description:
+            Virtual motor that gives every feedback frame a unique encoder count and records when it was written
+        """
+        super().__init__(*args, **kwargs)
+        self.feedback_sequence = 0
+        self.feedback_write_times = {}
+
+    def update(self, micros_now: Union[int, None] = None):
+        if micros_now is None:
+            micros_now = self.micros()
+
+        if micros_now - self.feedback_task_micros >= self.motor_feedback_interval_us:
+            self.feedback_sequence = self.feedback_sequence % (self.encoder_pulses_per_revolution - 1) + 1
+            self.angle_count = self.feedback_sequence
+            self.feedback_write_times[self.feedback_sequence] = time.perf_counter_ns()
+
+        super().update(micros_now)
+
+
+def benchmark_round_trip(definitions_filepath: Path, iterations: int = 200):
+    """
+    Description:
+        Time from send_* until processing_loop flips job_active, against a virtual motor.
+    """
+    virtual_motor = VirtualMotor(definitions_filepath)
+    virtual_motor.start(loop_period=0.0001)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        motor = Motor(definitions_filepath=definitions_filepath, serial_port=virtual_motor.port_name)
+        motor.start_threads()
+
+    motor.send_enable_motor()
+    time.sleep(0.05)
+
+    latencies = []
+    timeouts = 0
+    start = time.perf_counter()
+
+    for index in range(iterations):
+        motor.send_wake_motor()
+        t0 = time.perf_counter_ns()
+        motor.send_motor_pulses(direction=True, microstep=1, pulses=1, job_id=index % 255 + 1)
+        deadline = time.perf_counter() + 1.0
+
+        while not motor.job_active and time.perf_counter() < deadline:
+            time.sleep(0)
+
+        if motor.job_active:
+            latencies.append(time.perf_counter_ns() - t0)
+        else:
+            timeouts += 1
+
+        while not motor.is_ready_for_job() and time.perf_counter() < deadline:
+            time.sleep(0)
+
+    elapsed = time.perf_counter() - start
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        motor.stop()
+
+    virtual_motor.close()
+
+    return summarise("command_ack_round_trip", latencies, elapsed, len(latencies), timeouts=timeouts)
+
+
+def benchmark_feedback_visibility(definitions_filepath: Path, duration: float = 2.0):
+    """
+    Description:
+        Time from the virtual motor writing a feedback frame until get_rotor_position returns it.
+    """
+    virtual_motor = StampedVirtualMotor(definitions_filepath)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        motor = Motor(definitions_filepath=definitions_filepath, serial_port=virtual_motor.port_name)
+        motor.start_threads()
+
+    virtual_motor.start(loop_period=0.0001)
+
+    latencies = []
+    radians_per_count = motor.two_pi / motor.encoder_pulses_per_revolution
+    last_position = None
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < duration:
+        position = motor.get_rotor_position()
+
+        if position != last_position:
+            seen = time.perf_counter_ns()
+            last_position = position
+            written = virtual_motor.feedback_write_times.get(round(position / radians_per_count))
+
+            if written is not None:
+                latencies.append(seen - written)
+
+    elapsed = time.perf_counter() - start
+    virtual_motor.close()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        motor.running = False
+        motor.read_thread.join()
+        motor.updating_thread.join()
+
+    return summarise("feedback_visibility", latencies, elapsed, len(latencies))
+
+
+def run_benchmarks(definitions_filepath: Path,
+                   selected: Union[list, None] = None,
+                   frames: int = 200000,
+                   iterations: int = 100000,
+                   round_trips: int = 200,
+                   duration: float = 2.0,
+                   recording: Union[Path, None] = None,
+                   corruption_rate: float = 0.0,
+                   ):
+    motor = Motor(definitions_filepath=definitions_filepath)
+    results = []
+
+    if selected is None or 'frame_parse' in selected:
+        stream = recording.read_bytes() if recording is not None else synthetic_stream(motor, frames, corruption_rate=corruption_rate)
+        results.append(benchmark_frame_parse(motor, stream))
+
+    if selected is None or 'command_encode' in selected:
+        results.extend(benchmark_command_encode(motor, iterations=iterations))
+
+    if selected is None or 'round_trip' in selected:
+        results.append(benchmark_round_trip(definitions_filepath, iterations=round_trips))
+
+    if selected is None or 'feedback_visibility' in selected:
+        results.append(benchmark_feedback_visibility(definitions_filepath, duration=duration))
+
+    return {"timestamp": time.time(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "results": results,
+            }
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the motor host protocol stack")
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run from {', '.join(BENCHMARKS)}, default all")
+    parser.add_argument('--definitions', type=Path, default=project_dir / 'arduino/engineering-team-motor/definitions.h')
+    parser.add_argument('--frames', type=int, default=200000, help="synthetic frames for frame_parse")
+    parser.add_argument('--recording', type=Path, default=None, help="raw serial byte stream for frame_parse")
+    parser.add_argument('--corruption-rate', type=float, default=0.0, help="fraction of synthetic frames to corrupt")
+    parser.add_argument('--iterations', type=int, default=100000, help="encodes per command variant")
+    parser.add_argument('--round-trips', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=2.0, help="feedback_visibility run time in seconds")
+    parser.add_argument('--output', type=Path, default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f"unknown benchmark {benchmark}")
+
+    report = run_benchmarks(args.definitions,
+                            selected=args.benchmarks or None,
+                            frames=args.frames,
+                            iterations=args.iterations,
+                            round_trips=args.round_trips,
+                            duration=args.duration,
+                            recording=args.recording,
+                            corruption_rate=args.corruption_rate,
+                            )
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        args.output.write_text(json.dumps(report, indent=2))
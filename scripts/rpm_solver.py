@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Maps a requested motor speed in rpm to the microstep and pulse interval sent to the motor controller
+"""
+
+import functools
+import numpy as np
+from typing import Union
+from pathlib import Path
+
+from definition_file_parser import parse_definitions_file
+
+
+class RpmSolver:
+    def __init__(self, definitions: dict, tolerance: float = 1e-3, cache_size: int = 4096, maximum_pulse_interval: int = 999999):
+        """
+        Description:
+            Built once from definitions.h. For every microstep the table holds rpm * pulse_interval, so a speed maps to
+            a pulse interval with one division and a rounding, not a truncation.
+            Among the microsteps whose rounded interval gives a relative speed error within tolerance the finest
+            microstep is chosen, as the motor runs smoothest there. When none is within tolerance the microstep with
+            the smallest error is used. Scalar results are kept in an LRU cache.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            tolerance (float): Relative speed error accepted in exchange for a finer microstep, 0 always minimises error
+            cache_size (int): Number of rpm values kept in the LRU cache
+            maximum_pulse_interval (int): Longest pulse interval in microseconds, StartJob replaces longer ones with its default
+        """
+        self.tolerance = tolerance
+        self.microsteps = (1, 2, 4, 8, 16, 32)
+        self.minimum_pulse_interval = definitions['motor_settings']['MINIMUM_PULSE_INTERVAL']
+        self.maximum_pulse_interval = maximum_pulse_interval
+        motor_pulses_per_revolution = definitions['motor_settings']['MOTOR_STEPS_PER_REV']
+
+        # rpm * pulse_interval for each microstep, finest microstep last
+        self.rpm_interval_products = tuple(60e6 / (motor_pulses_per_revolution * microstep) for microstep in self.microsteps)
+        self.microstep_table = np.array(self.microsteps, dtype=np.int64)
+        self.rpm_interval_table = np.array(self.rpm_interval_products, dtype=np.float64)
+
+        self.max_rpm = self.rpm_interval_products[0] / self.minimum_pulse_interval
+        self.min_rpm = self.rpm_interval_products[-1] / self.maximum_pulse_interval
+
+        self.solve = functools.lru_cache(maxsize=cache_size)(self.solve_uncached)
+
+    def solve_uncached(self, rpm: Union[float, int]):
+        """
+        Description:
+            Speeds above max_rpm run at microstep 1 and the minimum pulse interval, below min_rpm at the finest
+            microstep and the maximum interval, the relative error reports the difference.
+
+        Returns:
+            microstep: (int)
+            pulse_interval: (int) microseconds
+            achieved rpm: (float)
+            relative error: (float) (achieved rpm - rpm) / rpm
+        """
+        if rpm <= 0:
+            raise ValueError(f"rpm must be positive, got {rpm}")
+
+        best = None
+        best_error = None
+
+        for microstep, rpm_interval_product in zip(self.microsteps, self.rpm_interval_products):
+            pulse_interval = round(rpm_interval_product / rpm)
+
+            if pulse_interval < self.minimum_pulse_interval or pulse_interval > self.maximum_pulse_interval:
+                continue
+
+            achieved_rpm = rpm_interval_product / pulse_interval
+            relative_error = (achieved_rpm - rpm) / rpm
+
+            if abs(relative_error) <= self.tolerance:
+                best = (microstep, pulse_interval, achieved_rpm, relative_error)
+                best_error = -1.0
+
+            elif best_error is None or (best_error >= 0 and abs(relative_error) <= best_error):
+                best = (microstep, pulse_interval, achieved_rpm, relative_error)
+                best_error = abs(relative_error)
+
+        if best is None:
+            if rpm > self.max_rpm:
+                microstep, pulse_interval = self.microsteps[0], self.minimum_pulse_interval
+                achieved_rpm = self.rpm_interval_products[0] / pulse_interval
+            else:
+                microstep, pulse_interval = self.microsteps[-1], self.maximum_pulse_interval
+                achieved_rpm = self.rpm_interval_products[-1] / pulse_interval
+
+            best = (microstep, pulse_interval, achieved_rpm, (achieved_rpm - rpm) / rpm)
+
+        return best
+
+    def solve_batch(self, rpms: np.ndarray):
+        """
+        Description:
+            Vectorised solve over an array of positive rpms, gives the same choices as solve.
+
+        Returns:
+            microsteps: (np.ndarray) int64
+            pulse_intervals: (np.ndarray) int64 microseconds
+            achieved rpms: (np.ndarray)
+            relative errors: (np.ndarray)
+        """
+        rpms = np.asarray(rpms, dtype=np.float64)
+
+        if np.any(rpms <= 0):
+            raise ValueError("rpm must be positive")
+
+        # rpms x microsteps
+        pulse_intervals = np.rint(self.rpm_interval_table / rpms[..., None])
+        valid = (pulse_intervals >= self.minimum_pulse_interval) & (pulse_intervals <= self.maximum_pulse_interval)
+        achieved_rpms = self.rpm_interval_table / np.where(valid, pulse_intervals, 1.0)
+        absolute_errors = np.where(valid, np.abs(achieved_rpms - rpms[..., None]) / rpms[..., None], np.inf)
+
+        # Finest microstep within tolerance, otherwise the smallest error with ties going to the finer microstep
+        within_tolerance = absolute_errors <= self.tolerance
+        last = len(self.microsteps) - 1
+        finest_within = last - np.argmax(within_tolerance[..., ::-1], axis=-1)
+        smallest_error = last - np.argmin(absolute_errors[..., ::-1], axis=-1)
+        choice = np.where(within_tolerance.any(axis=-1), finest_within, smallest_error)
+
+        chosen_intervals = np.take_along_axis(pulse_intervals, choice[..., None], axis=-1)[..., 0]
+        microsteps = self.microstep_table[choice]
+
+        any_valid = valid.any(axis=-1)
+        too_fast = ~any_valid & (rpms > self.max_rpm)
+        too_slow = ~any_valid & ~too_fast
+        microsteps = np.where(too_fast, self.microsteps[0], np.where(too_slow, self.microsteps[-1], microsteps))
+        chosen_intervals = np.where(too_fast, self.minimum_pulse_interval, np.where(too_slow, self.maximum_pulse_interval, chosen_intervals))
+        chosen_intervals = chosen_intervals.astype(np.int64)
+
+        achieved_rpms = self.rpm_interval_table[np.searchsorted(self.microstep_table, microsteps)] / chosen_intervals
+        return microsteps, chosen_intervals, achieved_rpms, (achieved_rpms - rpms) / rpms
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+    solver = RpmSolver(parse_definitions_file(project_dir / 'arduino/engineering-team-motor/definitions.h'))
+
+    for rpm in (0.005, 0.5, 7.3, 60.0, 299.0, 500.0):
+        print(f"{rpm=}: {solver.solve(rpm)}")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Incremental framer for the AT style serial protocol used by the motor controller.
+    Frames have the byte structure STX, length, data, ETX where length counts every byte in the frame.
+"""
+
+from typing import Union
+
+
+class SerialFramer:
+    def __init__(self, stx: int = 0x02, etx: int = 0x03, buffer_length: int = 4096, max_frame_length: int = 255):
+        """
+        Description:
+            Bulk reads are appended to a reusable receive buffer and every complete frame is pulled out of it.
+            When a frame fails validation only the STX byte is dropped and the search restarts at the next STX,
+            so good frames sitting behind a corrupted one are not lost.
+
+        Args:
+            stx (int): Start of message token
+            etx (int): End of message token
+            buffer_length (int): Size of the preallocated receive buffer in bytes
+            max_frame_length (int): Largest frame length byte that will be accepted
+        """
+        self.STX = stx
+        self.ETX = etx
+        self.max_frame_length = max_frame_length
+        self.min_frame_length = 4  # STX, length, message id, ETX
+
+        self.buffer = bytearray(buffer_length)
+        self.buffer_view = memoryview(self.buffer)
+        self.read_index = 0
+        self.write_index = 0
+
+        # Statistics
+        self.bytes_received = 0
+        self.bytes_discarded = 0
+        self.frames_received = 0
+        self.frames_recovered = 0
+        self.resyncing = False
+
+    def available(self):
+        """
+        Description:
+            Number of buffered bytes that have not been consumed yet.
+        """
+        return self.write_index - self.read_index
+
+    def free_space(self):
+        """
+        Description:
+            Makes the unread bytes contiguous at the start of the buffer and returns the free space after them.
+        """
+        if self.read_index > 0:
+            unread = self.write_index - self.read_index
+
+            if unread > 0:
+                self.buffer[:unread] = self.buffer_view[self.read_index:self.write_index]
+
+            self.read_index = 0
+            self.write_index = unread
+
+        return len(self.buffer) - self.write_index
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]):
+        """
+        Description:
+            Copies a chunk of received bytes into the receive buffer.
+
+        Args:
+            data (bytes): Raw bytes read from the serial port
+
+        Returns:
+            number of bytes stored: (int)
+        """
+        data_length = len(data)
+
+        if data_length > self.free_space():
+            # Buffer overflow, the oldest bytes can no longer form a frame with the new ones
+            self.bytes_discarded += self.available()
+            self.read_index = 0
+            self.write_index = 0
+            self.resyncing = True
+
+            if data_length > len(self.buffer):
+                self.bytes_discarded += data_length - len(self.buffer)
+                data = data[-len(self.buffer):]
+                data_length = len(self.buffer)
+
+        self.buffer[self.write_index:self.write_index + data_length] = data
+        self.write_index += data_length
+        self.bytes_received += data_length
+
+        return data_length
+
+    def fill_from(self, reader, bytes_waiting: int):
+        """
+        Description:
+            Reads everything the port reports as waiting straight into the receive buffer.
+
+        Args:
+            reader: Object providing readinto(), e.g. serial.Serial
+            bytes_waiting (int): Number of bytes reported by in_waiting
+
+        Returns:
+            number of bytes read: (int)
+        """
+        if bytes_waiting <= 0:
+            return 0
+
+        space = self.free_space()
+
+        if space == 0:
+            # Nothing in the buffer can be a valid frame, start again
+            self.bytes_discarded += self.available()
+            self.read_index = 0
+            self.write_index = 0
+            self.resyncing = True
+            space = len(self.buffer)
+
+        bytes_read = reader.readinto(self.buffer_view[self.write_index:self.write_index + min(space, bytes_waiting)])
+
+        if bytes_read:
+            self.write_index += bytes_read
+            self.bytes_received += bytes_read
+            return bytes_read
+
+        return 0
+
+    def next_frame(self):
+        """
+        Description:
+            Looks for the next complete and valid frame in the receive buffer.
+            The returned memoryview is only valid until the next call to feed() or fill_from().
+
+        Returns:
+            message id: (int) message identifier, 0 if no complete frame is buffered
+            message buffer: (memoryview) message contents followed by ETX
+        """
+        buffer = self.buffer
+
+        while self.write_index - self.read_index >= self.min_frame_length:
+            start = self.read_index
+
+            if buffer[start] != self.STX:
+                stx_index = buffer.find(self.STX, start, self.write_index)
+
+                if stx_index < 0:
+                    stx_index = self.write_index
+
+                self.bytes_discarded += stx_index - start
+                self.read_index = stx_index
+                self.resyncing = True
+                continue
+
+            frame_length = buffer[start + 1]
+
+            if frame_length < self.min_frame_length or frame_length > self.max_frame_length:
+                self.bytes_discarded += 1
+                self.read_index = start + 1
+                self.resyncing = True
+                continue
+
+            end = start + frame_length
+
+            if end > self.write_index:
+                # Wait for the rest of the frame
+                break
+
+            if buffer[end - 1] != self.ETX:
+                self.bytes_discarded += 1
+                self.read_index = start + 1
+                self.resyncing = True
+                continue
+
+            self.read_index = end
+            self.frames_received += 1
+
+            if self.resyncing:
+                self.resyncing = False
+                self.frames_recovered += 1
+
+            return buffer[start + 2], self.buffer_view[start + 2:end]
+
+        return 0, None
+
+    def frames(self):
+        """
+        Description:
+            Generator over every complete frame currently buffered.
+        """
+        message_id, message_buffer = self.next_frame()
+
+        while message_id != 0:
+            yield message_id, message_buffer
+            message_id, message_buffer = self.next_frame()
+
+    def reset(self):
+        self.read_index = 0
+        self.write_index = 0
+        self.resyncing = False
+
+    def get_statistics(self):
+        return {"bytes_received": self.bytes_received,
+                "bytes_discarded": self.bytes_discarded,
+                "frames_received": self.frames_received,
+                "frames_recovered": self.frames_recovered,
+                }
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Byte transports for the motor controller's serial port. The POSIX backend configures the tty with termios and
+    reads straight into the framer's buffer with os.readv, pyserial is kept as the portable fallback
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+from typing import Union
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+    termios = None
+
+# <linux/serial.h>, struct serial_struct {int type; int line; unsigned int port; int irq; int flags; ...}
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 1 << 13
+SERIAL_STRUCT_LENGTH = 72
+SERIAL_FLAGS_OFFSET = 16
+
+
+class PySerialTransport:
+    selectable = False
+
+    def __init__(self, port: str, baud_rate: int, timeout: float = 2.0):
+        """
+        Description:
+            pyserial backend, works wherever pyserial does.
+        """
+        import serial
+
+        self.serial = serial.Serial(port, baud_rate, timeout=timeout)
+        self.port = port
+
+    @property
+    def is_open(self):
+        return self.serial.is_open
+
+    def isOpen(self):
+        return self.serial.is_open
+
+    @property
+    def in_waiting(self):
+        return self.serial.in_waiting
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def readinto(self, buffer):
+        return self.serial.readinto(buffer)
+
+    def fill_framer(self, framer):
+        """
+        Description:
+            Reads everything waiting into the framer's receive buffer.
+
+        Returns:
+            number of bytes read: (int)
+        """
+        return framer.fill_from(self.serial, self.serial.in_waiting)
+
+    def write(self, data: bytes):
+        return self.serial.write(data)
+
+    def close(self):
+        self.serial.close()
+
+
+class PosixSerialTransport:
+    selectable = True
+
+    def __init__(self,
+                 port: str,
+                 baud_rate: int,
+                 timeout: Union[float, None] = None,
+                 low_latency: bool = True,
+                 write_timeout: float = 2.0,
+                 ):
+        """
+        Description:
+            Opens the tty non-blocking in raw mode, 8N1 without flow control, VMIN = VTIME = 0 so a read returns
+            whatever has arrived. Reads go straight into the caller's buffer, there is no in_waiting ioctl before
+            each read. ASYNC_LOW_LATENCY is set where the driver supports it, e.g. FTDI and CDC ACM adapters,
+            pseudo terminals don't. fileno() can be handed to select / epoll.
+
+        Args:
+            port (str): Device path
+            baud_rate (int): Must have a termios B<rate> constant
+            timeout (float): pyserial's read timeout, accepted so open_transport can pass it to either backend.
+                Ignored, reads here never block and writes use write_timeout
+            low_latency (bool): Try to set ASYNC_LOW_LATENCY
+            write_timeout (float): Longest wait for the port to accept a write, in seconds
+        """
+        if termios is None:
+            raise OSError("termios is not available on this platform")
+
+        speed = getattr(termios, f"B{baud_rate}", None)
+
+        if speed is None:
+            raise ValueError(f"No termios speed for {baud_rate} baud")
+
+        self.port = port
+        self.write_timeout = write_timeout
+        self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+        try:
+            self.configure(speed)
+
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        self.low_latency = self.set_low_latency() if low_latency else False
+        self.in_waiting_buffer = bytearray(4)
+
+        # With VMIN = VTIME = 0 a read returns 0 both when nothing has arrived and after a hangup
+        self.hangup_poll = select.poll()
+        self.hangup_poll.register(self.fd, select.POLLIN)
+
+    def configure(self, speed: int):
+        iflag, oflag, cflag, lflag, _, _, control_characters = termios.tcgetattr(self.fd)
+
+        # cfmakeraw
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR | termios.IGNCR
+                   | termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | getattr(termios, 'CRTSCTS', 0))
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+
+        control_characters[termios.VMIN] = 0
+        control_characters[termios.VTIME] = 0
+
+        termios.tcsetattr(self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, control_characters])
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+    def set_low_latency(self):
+        """
+        Returns:
+            set: (bool) ASYNC_LOW_LATENCY is now set
+        """
+        try:
+            serial_struct = bytearray(SERIAL_STRUCT_LENGTH)
+            fcntl.ioctl(self.fd, TIOCGSERIAL, serial_struct)
+            flags = struct.unpack_from('i', serial_struct, SERIAL_FLAGS_OFFSET)[0]
+            struct.pack_into('i', serial_struct, SERIAL_FLAGS_OFFSET, flags | ASYNC_LOW_LATENCY)
+            fcntl.ioctl(self.fd, TIOCSSERIAL, serial_struct)
+            return True
+
+        except OSError:
+            return False
+
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    def isOpen(self):
+        return self.fd is not None
+
+    @property
+    def in_waiting(self):
+        if self.fd is None:
+            return 0
+
+        fcntl.ioctl(self.fd, termios.FIONREAD, self.in_waiting_buffer)
+        return struct.unpack('i', self.in_waiting_buffer)[0]
+
+    def fileno(self):
+        return self.fd
+
+    def readinto(self, buffer):
+        """
+        Description:
+            One non-blocking read into buffer. A port that has gone away (EIO / ENXIO, or a hangup on unplug)
+            is closed, so the read loop can reconnect.
+
+        Returns:
+            number of bytes read: (int) 0 when nothing was waiting
+        """
+        if self.fd is None:
+            return 0
+
+        try:
+            bytes_read = os.readv(self.fd, (buffer,))
+
+        except BlockingIOError:
+            return 0
+
+        except InterruptedError:
+            return 0
+
+        except OSError:
+            self.close()
+            return 0
+
+        if bytes_read == 0 and any(events & (select.POLLHUP | select.POLLERR) for _, events in self.hangup_poll.poll(0)):
+            self.close()
+
+        return bytes_read
+
+    def fill_framer(self, framer):
+        return framer.fill_from(self, len(framer.buffer))
+
+    def write(self, data: Union[bytes, bytearray, memoryview]):
+        """
+        Description:
+            Writes all of data, waiting for the port to drain when the output queue is full.
+            A closed port raises OSError EBADF, as a write to a closed file descriptor does.
+        """
+        if self.fd is None:
+            raise OSError(errno.EBADF, f"{self.port} is closed")
+
+        view = memoryview(data)
+        written = 0
+        deadline = None
+
+        while written < len(view):
+            try:
+                written += os.write(self.fd, view[written:])
+
+            except BlockingIOError:
+                deadline = time.monotonic() + self.write_timeout if deadline is None else deadline
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    raise TimeoutError(f"Write to {self.port} timed out")
+
+                select.select([], [self.fd], [], remaining)
+
+        return written
+
+    def close(self):
+        if self.fd is not None:
+            fd = self.fd
+            self.fd = None
+            self.hangup_poll.unregister(fd)
+            os.close(fd)
+
+
+transports = {'posix': PosixSerialTransport,
+              'pyserial': PySerialTransport,
+              }
+
+
+def open_transport(transport: Union[str, type], port: str, baud_rate: int, timeout: float = 2.0):
+    """
+    Description:
+        Opens a port with the named backend, a class taking (port, baud_rate, timeout=...) or 'auto'.
+        'auto' uses the POSIX backend where termios is available and the rate has a termios constant,
+        pyserial otherwise.
+
+    Returns:
+        transport: object with is_open, fileno(), readinto(), fill_framer(), write() and close()
+    """
+    if transport == 'auto':
+        usable = termios is not None and hasattr(termios, f"B{baud_rate}")
+        transport = 'posix' if usable else 'pyserial'
+
+    transport_class = transports[transport] if isinstance(transport, str) else transport
+
+    return transport_class(port, baud_rate, timeout=timeout)
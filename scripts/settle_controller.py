@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Closed loop settling for goto moves, waits for the rotor to stop then sends one correction sized for the residual
+"""
+
+import time
+from collections import deque
+from typing import Union
+
+
+class SettleController:
+    def __init__(self,
+                 definitions: dict,
+                 max_iterations: int = 3,
+                 stable_samples: int = 2,
+                 stopped_velocity: float = 0.05,
+                 stop_timeout: float = 0.5,
+                 settle_rpm: float = 10.0,
+                 max_correction_pulses: int = 64,
+                 history_length: int = 1000,
+                 ):
+        """
+        Description:
+            Fed from the JOB_COMPLETE and feedback handlers. After a job completes off target the controller waits
+            for feedback that arrived after completion to show the same encoder count stable_samples times in a row
+            with the reported velocity below stopped_velocity, so the residual is measured on a stopped rotor rather than on a frame sent while it was still moving.
+            The correction uses the finest microstep that covers the residual in at most max_correction_pulses,
+            at settle_rpm.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            max_iterations (int): Most corrections per goto
+            stable_samples (int): Consecutive identical encoder counts taken as stopped
+            stopped_velocity (float): Largest feedback velocity magnitude taken as stopped, in rad/s
+            stop_timeout (float): Longest wait for the rotor to stop, in seconds, before measuring anyway
+            settle_rpm (float): Correction speed
+            max_correction_pulses (int): Upper bound on the correction job length in pulses
+            history_length (int): Number of settle records kept
+        """
+        self.max_iterations = max_iterations
+        self.stable_samples = stable_samples
+        self.stopped_velocity = stopped_velocity
+        self.stop_timeout = stop_timeout
+        self.settle_rpm = settle_rpm
+        self.max_correction_pulses = max_correction_pulses
+
+        self.microsteps = (1, 2, 4, 8, 16, 32)
+        self.encoder_pulses_per_revolution = definitions['encoder_settings']['ENCODER_PULSES_PER_REVOLUTION']
+        self.encoder_setpoint_tolerance = definitions['encoder_settings']['ENCODER_SETPOINT_TOLERANCE']
+        self.motor_pulses_per_revolution = definitions['motor_settings']['MOTOR_STEPS_PER_REV']
+        self.minimum_pulse_interval_us = definitions['motor_settings']['MINIMUM_PULSE_INTERVAL']
+        self.default_pulse_on_period = definitions['motor_settings']['DEFAULT_PULSE_ON_PERIOD']
+
+        self.history = deque(maxlen=history_length)
+        self.session = None
+
+    @property
+    def active(self):
+        return self.session is not None
+
+    def start(self, target_count: int, now: Union[float, None] = None):
+        """
+        Description:
+            Called on the JOB_COMPLETE of a goto that may be off target, starts a settle or its next iteration.
+        """
+        now = time.monotonic() if now is None else now
+
+        if self.session is None:
+            self.session = {"target_count": target_count,
+                            "start_time": now,
+                            "iterations": 0,
+                            "residuals": [],
+                            }
+
+        self.session["target_count"] = target_count
+        self.session["waiting_since"] = now
+        self.session["last_count"] = None
+        self.session["stable_count"] = 0
+        self.session["waiting"] = True
+
+    def cancel(self):
+        if self.session is not None:
+            self.finish(self.session.get("last_count"), settled=False)
+
+    def update(self, timestamp: float, unwrapped_count: int, velocity: float):
+        """
+        Description:
+            Called with every feedback sample while a settle is active.
+
+        Returns:
+            action: (None | dict) None while waiting, {"done": stats} when finished or {"correction": delta_count}
+        """
+        session = self.session
+
+        if session is None or not session["waiting"] or timestamp < session["waiting_since"]:
+            return None
+
+        if unwrapped_count == session["last_count"] and abs(velocity) <= self.stopped_velocity:
+            session["stable_count"] += 1
+        else:
+            session["last_count"] = unwrapped_count
+            session["stable_count"] = 1 if abs(velocity) <= self.stopped_velocity else 0
+
+        if session["stable_count"] < self.stable_samples and timestamp - session["waiting_since"] < self.stop_timeout:
+            return None
+
+        session["waiting"] = False
+        residual = session["target_count"] - unwrapped_count
+        session["residuals"].append(residual)
+
+        if abs(residual) < self.encoder_setpoint_tolerance:
+            return {"done": self.finish(unwrapped_count, settled=True, now=timestamp)}
+
+        if session["iterations"] >= self.max_iterations:
+            return {"done": self.finish(unwrapped_count, settled=False, now=timestamp)}
+
+        session["iterations"] += 1
+        return {"correction": residual}
+
+    def finish(self, final_count: Union[int, None], settled: bool, now: Union[float, None] = None):
+        session = self.session
+        self.session = None
+
+        stats = {"settled": settled,
+                 "iterations": session["iterations"],
+                 "residuals": session["residuals"],
+                 "final_error": None if final_count is None else session["target_count"] - final_count,
+                 "settle_time": (time.monotonic() if now is None else now) - session["start_time"],
+                 }
+
+        self.history.append(stats)
+        return stats
+
+    def correction_job(self, delta_count: int):
+        """
+        Description:
+            send_motor_pulses arguments for a correction of delta_count encoder counts.
+        """
+        counts = abs(delta_count)
+        microstep = self.microsteps[0]
+
+        for candidate in self.microsteps:
+            if round(counts * self.motor_pulses_per_revolution * candidate / self.encoder_pulses_per_revolution) <= self.max_correction_pulses:
+                microstep = candidate
+
+        pulses = max(1, round(counts * self.motor_pulses_per_revolution * microstep / self.encoder_pulses_per_revolution))
+        pulse_interval = max(self.minimum_pulse_interval_us,
+                             round(60e6 / (self.settle_rpm * self.motor_pulses_per_revolution * microstep)))
+
+        return {"direction": delta_count > 0,
+                "microstep": microstep,
+                "pulses": pulses,
+                "pulse_interval": pulse_interval,
+                "pulse_on_period": self.default_pulse_on_period,
+                }
+
+    def summary(self):
+        """
+        Description:
+            Aggregate statistics over the kept settle records.
+
+        Returns:
+            summary: (dict) count, settled fraction, mean / max iterations and settle time, max final error
+        """
+        if len(self.history) == 0:
+            return {"count": 0}
+
+        settle_times = [stats["settle_time"] for stats in self.history]
+        iterations = [stats["iterations"] for stats in self.history]
+        final_errors = [abs(stats["final_error"]) for stats in self.history if stats["final_error"] is not None]
+
+        return {"count": len(self.history),
+                "settled_fraction": sum(stats["settled"] for stats in self.history) / len(self.history),
+                "mean_iterations": sum(iterations) / len(iterations),
+                "max_iterations": max(iterations),
+                "mean_settle_time": sum(settle_times) / len(settle_times),
+                "max_settle_time": max(settle_times),
+                "max_final_error": max(final_errors) if final_errors else None,
+                }
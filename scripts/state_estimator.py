@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Constant acceleration Kalman filter giving rotor position, velocity and acceleration from the raw encoder counts,
+    host arrival times and the commanded pulse rate, with a latency compensated position now query
+"""
+
+import math
+import time
+import numpy as np
+from typing import Union
+
+
+estimate_dtype = np.dtype([('timestamp', 'f8'),
+                           ('position', 'f8'),
+                           ('velocity', 'f8'),
+                           ('acceleration', 'f8'),
+                           ])
+
+
+def predict(state: tuple, dt, process_noise: float):
+    """
+    Description:
+        Advances (position, velocity, acceleration, p00, p01, p02, p11, p12, p22) by dt under constant acceleration
+        with white jerk process noise. Written element by element so it runs on floats or NumPy arrays alike.
+    """
+    position, velocity, acceleration, p00, p01, p02, p11, p12, p22 = state
+    half_dt_squared = 0.5 * dt * dt
+
+    # F P, row by row
+    r00 = p00 + dt * p01 + half_dt_squared * p02
+    r01 = p01 + dt * p11 + half_dt_squared * p12
+    r02 = p02 + dt * p12 + half_dt_squared * p22
+    r11 = p11 + dt * p12
+    r12 = p12 + dt * p22
+
+    dt_2 = dt * dt
+    dt_3 = dt_2 * dt
+
+    return (position + dt * velocity + half_dt_squared * acceleration,
+            velocity + dt * acceleration,
+            acceleration,
+            r00 + dt * r01 + half_dt_squared * r02 + process_noise * dt_3 * dt_2 / 20.0,
+            r01 + dt * r02 + process_noise * dt_3 * dt / 8.0,
+            r02 + process_noise * dt_3 / 6.0,
+            r11 + dt * r12 + process_noise * dt_3 / 3.0,
+            r12 + process_noise * dt_2 / 2.0,
+            p22 + process_noise * dt,
+            )
+
+
+def update_position(state: tuple, measured_position, variance):
+    position, velocity, acceleration, p00, p01, p02, p11, p12, p22 = state
+    innovation = measured_position - position
+    k0 = p00 / (p00 + variance)
+    k1 = p01 / (p00 + variance)
+    k2 = p02 / (p00 + variance)
+
+    return (position + k0 * innovation,
+            velocity + k1 * innovation,
+            acceleration + k2 * innovation,
+            p00 - k0 * p00,
+            p01 - k0 * p01,
+            p02 - k0 * p02,
+            p11 - k1 * p01,
+            p12 - k1 * p02,
+            p22 - k2 * p02,
+            )
+
+
+def update_velocity(state: tuple, measured_velocity, variance):
+    position, velocity, acceleration, p00, p01, p02, p11, p12, p22 = state
+    innovation = measured_velocity - velocity
+    k0 = p01 / (p11 + variance)
+    k1 = p11 / (p11 + variance)
+    k2 = p12 / (p11 + variance)
+
+    return (position + k0 * innovation,
+            velocity + k1 * innovation,
+            acceleration + k2 * innovation,
+            p00 - k0 * p01,
+            p01 - k0 * p11,
+            p02 - k0 * p12,
+            p11 - k1 * p11,
+            p12 - k1 * p12,
+            p22 - k2 * p12,
+            )
+
+
+class StateEstimator:
+    def __init__(self,
+                 counts_per_revolution: int,
+                 process_noise: float = 1e6,
+                 arrival_jitter: float = 0.002,
+                 command_velocity_std: float = 0.5,
+                 latency: float = 0.001,
+                 max_extrapolation: float = 0.05,
+                 ):
+        """
+        Description:
+            State is kept in radians of the unwrapped encoder count. Each feedback sample is a position measurement
+            with the encoder quantisation variance plus the position error from host arrival jitter at the current
+            speed. While a job runs without ramping its commanded pulse rate is fused as a velocity measurement, and
+            a motor with no job is known to be stopped.
+            Samples are taken to have been measured latency seconds before they arrived.
+
+        Args:
+            counts_per_revolution (int): ENCODER_PULSES_PER_REVOLUTION
+            process_noise (float): White jerk spectral density, rad^2/s^5
+            arrival_jitter (float): Standard deviation of host arrival time around the sample time, in seconds
+            command_velocity_std (float): Standard deviation of the commanded velocity as a measurement, in rad/s
+            latency (float): Mean delay from sample to host arrival, in seconds
+            max_extrapolation (float): Longest time position_now predicts past the newest sample, in seconds
+        """
+        self.radians_per_count = 2 * math.pi / counts_per_revolution
+        self.process_noise = process_noise
+        self.arrival_jitter = arrival_jitter
+        self.command_velocity_variance = command_velocity_std ** 2
+        self.latency = latency
+        self.max_extrapolation = max_extrapolation
+
+        # Uniform quantisation of one count
+        self.quantisation_variance = self.radians_per_count ** 2 / 12.0
+        self.initial_variance = (self.quantisation_variance, 0.0, 0.0, 100.0, 0.0, 1e6)
+
+        self.state = None
+        self.sample_time = None
+
+    def reset(self):
+        self.state = None
+        self.sample_time = None
+
+    def update(self,
+               timestamp: float,
+               unwrapped_count: int,
+               commanded_velocity: Union[float, None] = None,
+               latency: Union[float, None] = None,
+               ):
+        """
+        Description:
+            Adds one feedback sample, must only be called from one thread.
+
+        Args:
+            timestamp (float): Host time.monotonic() arrival time
+            unwrapped_count (int): Multi-turn encoder count, see PositionTracker
+            commanded_velocity (float): Velocity the active job is stepping at in rad/s, None when unknown
+            latency (float): Delay from sample to timestamp, self.latency when None, 0.0 for device clock sample times
+
+        Returns:
+            position, velocity, acceleration: (float) rad, rad/s, rad/s^2
+        """
+        sample_time = timestamp - (self.latency if latency is None else latency)
+        measured_position = unwrapped_count * self.radians_per_count
+
+        if self.state is None:
+            self.state = (measured_position, 0.0 if commanded_velocity is None else commanded_velocity, 0.0) + self.initial_variance
+
+        else:
+            self.state = predict(self.state, max(sample_time - self.sample_time, 0.0), self.process_noise)
+            self.state = update_position(self.state,
+                                         measured_position,
+                                         self.quantisation_variance + (self.arrival_jitter * self.state[1]) ** 2)
+
+            if commanded_velocity is not None:
+                self.state = update_velocity(self.state, commanded_velocity, self.command_velocity_variance)
+
+        self.sample_time = sample_time
+        return self.state[:3]
+
+    def estimate_at(self, when: Union[float, None] = None):
+        """
+        Description:
+            Latency compensated state at a host time.monotonic() time, extrapolated from the newest sample
+            by at most max_extrapolation.
+
+        Returns:
+            position, velocity, acceleration: (float) rad, rad/s, rad/s^2, None before the first sample
+        """
+        if self.state is None:
+            return None
+
+        when = time.monotonic() if when is None else when
+        dt = min(max(when - self.sample_time, 0.0), self.max_extrapolation)
+        position, velocity, acceleration = self.state[:3]
+
+        return position + dt * velocity + 0.5 * dt * dt * acceleration, velocity + dt * acceleration, acceleration
+
+    def position_now(self):
+        estimate = self.estimate_at()
+        return None if estimate is None else estimate[0]
+
+    def filter_batch(self,
+                     timestamps: np.ndarray,
+                     unwrapped_counts: np.ndarray,
+                     commanded_velocities: Union[np.ndarray, None] = None,
+                     ):
+        """
+        Description:
+            Re-runs the filter over recorded logs, e.g. FeedbackHistory samples['timestamp'] and
+            samples['unwrapped_count']. The recursion steps through time once, vectorised across every log,
+            and gives the same estimates as calling update() sample by sample. Does not touch the online state.
+
+        Args:
+            timestamps (np.ndarray): Arrival times, shape (samples,) or (logs, samples), logs may end in NaN padding
+            unwrapped_counts (np.ndarray): Encoder counts, same shape
+            commanded_velocities (np.ndarray): rad/s, NaN where unknown, same shape or None
+
+        Returns:
+            estimates: (np.ndarray) estimate_dtype array of the input shape, padded samples repeat the last estimate
+        """
+        timestamps = np.atleast_2d(np.asarray(timestamps, dtype=np.float64))
+        measured_positions = np.atleast_2d(np.asarray(unwrapped_counts, dtype=np.float64)) * self.radians_per_count
+        sample_times = timestamps - self.latency
+
+        if commanded_velocities is None:
+            commanded_velocities = np.full(timestamps.shape, np.nan)
+        else:
+            commanded_velocities = np.atleast_2d(np.asarray(commanded_velocities, dtype=np.float64))
+
+        number_of_logs, number_of_samples = timestamps.shape
+        estimates = np.zeros((number_of_logs, number_of_samples), dtype=estimate_dtype)
+        estimates['timestamp'] = timestamps
+
+        if number_of_samples == 0:
+            return estimates.reshape(np.shape(unwrapped_counts))
+
+        initial_velocities = np.nan_to_num(commanded_velocities[:, 0])
+        state = (measured_positions[:, 0], initial_velocities, np.zeros(number_of_logs)) + tuple(np.full(number_of_logs, variance)
+                                                                                                for variance in self.initial_variance)
+        previous_times = sample_times[:, 0]
+        positions = np.empty((number_of_logs, number_of_samples))
+        velocities = np.empty((number_of_logs, number_of_samples))
+        accelerations = np.empty((number_of_logs, number_of_samples))
+        positions[:, 0], velocities[:, 0], accelerations[:, 0] = state[:3]
+
+        for index in range(1, number_of_samples):
+            valid = ~np.isnan(sample_times[:, index])
+            dt = np.where(valid, np.maximum(sample_times[:, index] - previous_times, 0.0), 0.0)
+
+            updated = predict(state, dt, self.process_noise)
+            updated = update_position(updated,
+                                      np.where(valid, measured_positions[:, index], 0.0),
+                                      self.quantisation_variance + (self.arrival_jitter * updated[1]) ** 2)
+
+            command_known = ~np.isnan(commanded_velocities[:, index])
+            commanded = update_velocity(updated, np.where(command_known, commanded_velocities[:, index], 0.0), self.command_velocity_variance)
+            updated = tuple(np.where(command_known, fused, value) for fused, value in zip(commanded, updated))
+
+            state = tuple(np.where(valid, value, previous) for value, previous in zip(updated, state))
+            previous_times = np.where(valid, sample_times[:, index], previous_times)
+            positions[:, index], velocities[:, index], accelerations[:, index] = state[:3]
+
+        estimates['position'] = positions
+        estimates['velocity'] = velocities
+        estimates['acceleration'] = accelerations
+
+        return estimates.reshape(np.shape(unwrapped_counts))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Fixed capacity history of motor feedback samples backed by a preallocated NumPy structured array
+"""
+
+import time
+import numpy as np
+from typing import Union
+
+
+feedback_dtype = np.dtype([('timestamp', 'f8'),
+                           ('velocity', 'f4'),
+                           ('position', 'f4'),
+                           ('encoder_count', 'i4'),
+                           ('unwrapped_count', 'i8'),
+                           ])
+
+
+class FeedbackHistory:
+    def __init__(self, capacity: int = 65536, dtype: np.dtype = feedback_dtype):
+        """
+        Description:
+            Single writer, many reader ring buffer. Every sample is written twice, at index and index + capacity,
+            so the newest N samples are always contiguous and window() can return a view without copying.
+            The writer publishes a sample by incrementing sample_count after it has been stored, readers never
+            take a lock.
+
+        Args:
+            capacity (int): Number of samples kept
+            dtype (np.dtype): Structured dtype of a sample, first field must be timestamp
+        """
+        self.capacity = capacity
+        self.dtype = dtype
+        self.samples = np.zeros(2 * capacity, dtype=dtype)
+        self.sample_count = 0
+        self.latest_sample = None
+
+    def __len__(self):
+        return min(self.sample_count, self.capacity)
+
+    def append(self, *sample):
+        """
+        Description:
+            Stores one sample, must only be called from one thread.
+
+        Args:
+            sample: Values for every field in dtype order, timestamp first
+        """
+        index = self.sample_count % self.capacity
+        self.samples[index] = sample
+        self.samples[index + self.capacity] = sample
+        self.latest_sample = sample
+        self.sample_count += 1
+
+    def append_batch(self, batch: np.ndarray):
+        """
+        Description:
+            Stores a structured array of samples in one vectorised step, must only be called from one thread.
+
+        Args:
+            batch (np.ndarray): Samples with this history's dtype, oldest first
+        """
+        batch_length = len(batch)
+
+        if batch_length == 0:
+            return
+
+        if batch_length > self.capacity:
+            self.sample_count += batch_length - self.capacity
+            batch = batch[-self.capacity:]
+            batch_length = self.capacity
+
+        start = self.sample_count % self.capacity
+
+        if start + batch_length <= self.capacity:
+            self.samples[start:start + batch_length] = batch
+            self.samples[start + self.capacity:start + self.capacity + batch_length] = batch
+        else:
+            indices = (start + np.arange(batch_length)) % self.capacity
+            self.samples[indices] = batch
+            self.samples[indices + self.capacity] = batch
+        self.latest_sample = batch[-1].item()
+        self.sample_count += batch_length
+
+    def latest(self):
+        """
+        Description:
+            Most recent sample as a tuple in dtype order, None before the first sample. O(1) and lock free.
+        """
+        return self.latest_sample
+
+    def last(self, number_of_samples: int):
+        """
+        Description:
+            View of the newest samples, oldest first.
+
+        Args:
+            number_of_samples (int): Requested samples, limited to the number stored
+
+        Returns:
+            samples: (np.ndarray) view into the history, valid until capacity more samples are written
+        """
+        number_of_samples = min(number_of_samples, self.sample_count, self.capacity)
+        end = self.sample_count % self.capacity + self.capacity
+
+        return self.samples[end - number_of_samples:end]
+
+    def window(self, seconds: float, now: Union[float, None] = None):
+        """
+        Description:
+            View of every sample newer than now - seconds, oldest first.
+
+        Args:
+            seconds (float): Length of the window in seconds
+            now (float): End of the window on the time.monotonic() clock, defaults to the current time
+
+        Returns:
+            samples: (np.ndarray) view into the history, valid until capacity more samples are written
+        """
+        if now is None:
+            now = time.monotonic()
+
+        samples = self.last(self.capacity)
+        start = np.searchsorted(samples['timestamp'], now - seconds, side='left')
+
+        return samples[start:]
+
+    def clear(self):
+        self.sample_count = 0
+        self.latest_sample = None
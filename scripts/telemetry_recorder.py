@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Always on recording of every frame sent to and received from a motor controller into fixed size records in
+    memory mapped files, a reader returning NumPy views of the records and a replayer feeding the recorded byte
+    stream back through the client parser
+"""
+
+import os
+import mmap
+import time
+import struct
+import threading
+import numpy as np
+from typing import Union, Iterable
+from pathlib import Path
+
+from serial_framer import SerialFramer
+from messages import MessageDispatcher
+
+RECEIVED = 0
+SENT = 1
+
+# The length byte limits a frame to 255 bytes, so every frame is kept whole, a full MOTOR_FEEDBACK_BATCH included
+FRAME_BYTES = 255
+FRAME_OFFSET = 12
+FILE_MAGIC = b'MOTORREC'
+FILE_VERSION = 2
+
+# {magic, version, record size, capacity, record count, monotonic start time} padded to 64 bytes
+file_header_struct = struct.Struct('<8s2I2Qd24x')
+record_count_offset = 24
+
+record_dtype = np.dtype([('timestamp', '<f8'),
+                         ('direction', 'u1'),
+                         ('message_id', 'u1'),
+                         ('job_id', 'u1'),
+                         ('frame_length', 'u1'),
+                         ('frame', 'u1', (FRAME_BYTES,)),
+                         ])
+
+
+def frame_view_dtype(fields: Iterable):
+    """
+    Description:
+        Structured dtype picking fields out of the raw frame bytes of a record, so a message type can be read
+        as columns without decoding. Field offsets are positions in the frame, STX is 0.
+    """
+    names, formats, offsets = ['timestamp'], ['<f8'], [0]
+
+    for name, field_format, frame_offset in fields:
+        names.append(name)
+        formats.append(field_format)
+        offsets.append(FRAME_OFFSET + frame_offset)
+
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': record_dtype.itemsize})
+
+
+# Same layouts as the MessageDispatcher structs, STX and length come first in the frame
+feedback_view_dtype = frame_view_dtype((('velocity', '<f4', 3), ('position', '<f4', 7), ('encoder_count', '<i4', 11)))
+status_view_dtype = frame_view_dtype((('status_byte', 'u1', 3), ('job_id', 'u1', 4), ('microstep', 'u1', 5), ('pulses_remaining', '<u4', 6)))
+response_view_dtype = frame_view_dtype((('command', 'u1', 3), ('job_id', 'u1', 4), ('response', 'u1', 5), ('ack', 'u1', 6)))
+job_view_dtype = frame_view_dtype((('job_id', 'u1', 3),))
+
+
+class TelemetryRecorder:
+    def __init__(self,
+                 definitions: dict,
+                 directory: Union[Path, str],
+                 prefix: str = 'motor',
+                 capacity: int = 1 << 20,
+                 max_files: Union[int, None] = None,
+                 ):
+        """
+        Description:
+            Each frame is written with struct.pack_into straight into a memory mapped file, one fixed size record of
+            host time.monotonic(), direction, message id or command byte, job id and the raw frame. The record
+            count in the file header is updated after every record so a reader always sees complete records.
+            When a file is full recording moves on to the next one, prefix_00000.rec, prefix_00001.rec, ...
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            directory (Path): Folder the recording files are written to
+            prefix (str): File name prefix e.g. the serial port name
+            capacity (int): Records per file, 1 << 20 records is 267 MiB and about 2 hours of one motor's feedback,
+                the file is sparse so only written records take disk space
+            max_files (int): Oldest files are deleted beyond this number, None keeps every file
+        """
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.capacity = capacity
+        self.max_files = max_files
+        self.STX = definitions['serial_settings']['STX']
+
+        # Frame offset of the job id for each received message id and each sent job command
+        message_types = definitions['message_types']
+        self.received_job_id_offsets = {message_types[name]: offset for name, offset in (('MOTOR_STATUS_MESSAGE_ID', 4),
+                                                                                         ('RESPONSE_MESSAGE_ID', 4),
+                                                                                         ('JOB_COMPLETE_MESSAGE_ID', 3),
+                                                                                         ('JOB_CANCELLED_MESSAGE_ID', 3))
+                                         if name in message_types}
+        self.job_command_types = {value for key, value in definitions['command_types'].items() if key.startswith('SEND_JOB')}
+
+        self.record_header_struct = struct.Struct('<d4B')
+        self.received_header_struct = struct.Struct('<d6B')
+        self.record_count_struct = struct.Struct('<Q')
+        self.record_size = record_dtype.itemsize
+
+        self.lock = threading.Lock()
+        self.file_index = -1
+        self.file_paths = []
+        self.file = None
+        self.mm = None
+        self.record_count = 0
+        self.records_written = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.open_next_file()
+
+    def open_next_file(self):
+        self.close_file()
+
+        self.file_index += 1
+        file_path = self.directory / f"{self.prefix}_{self.file_index:05d}.rec"
+        file_length = file_header_struct.size + self.capacity * self.record_size
+
+        self.file = open(file_path, 'w+b')
+        self.file.truncate(file_length)
+        self.mm = mmap.mmap(self.file.fileno(), file_length)
+        file_header_struct.pack_into(self.mm, 0, FILE_MAGIC, FILE_VERSION, self.record_size, self.capacity, 0, time.monotonic())
+        self.record_count = 0
+
+        self.file_paths.append(file_path)
+
+        if self.max_files is not None:
+            while len(self.file_paths) > self.max_files:
+                os.remove(self.file_paths.pop(0))
+
+    def close_file(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+            self.file = None
+
+    def close(self):
+        with self.lock:
+            self.close_file()
+
+    def write_record(self, header_struct: struct.Struct, header: tuple, frame, frame_offset: int):
+        """
+        Description:
+            Packs the record header and copies the frame bytes after it, frame_offset is where the frame bytes start.
+        """
+        with self.lock:
+            if self.mm is None:
+                return
+
+            if self.record_count == self.capacity:
+                self.open_next_file()
+
+            offset = file_header_struct.size + self.record_count * self.record_size
+            header_struct.pack_into(self.mm, offset, time.monotonic(), *header)
+
+            frame_start = offset + frame_offset
+            frame_bytes = min(len(frame), offset + self.record_size - frame_start)
+            self.mm[frame_start:frame_start + frame_bytes] = frame[:frame_bytes]
+
+            # Published after the record is complete
+            self.record_count += 1
+            self.records_written += 1
+            self.record_count_struct.pack_into(self.mm, record_count_offset, self.record_count)
+
+    def record_received(self, message_buffer):
+        """
+        Description:
+            Records a frame from SerialFramer.next_frame, the message buffer starts at the message id and ends with ETX.
+        """
+        message_id = message_buffer[0]
+        message_length = len(message_buffer)
+        job_id_offset = self.received_job_id_offsets.get(message_id)
+        job_id = message_buffer[job_id_offset - 2] if job_id_offset is not None and job_id_offset - 2 < message_length else 0
+
+        self.write_record(self.received_header_struct,
+                          (RECEIVED, message_id, job_id, message_length + 2, self.STX, message_length + 2),
+                          message_buffer,
+                          FRAME_OFFSET + 2)
+
+    def record_sent(self, frame: bytes):
+        """
+        Description:
+            Records an encoded command frame {STX, length, COMMAND, [direction, microstep, job_id, ...], ETX}.
+        """
+        command = frame[2]
+        job_id = frame[5] if command in self.job_command_types else 0
+
+        self.write_record(self.record_header_struct, (SENT, command, job_id, len(frame)), frame, FRAME_OFFSET)
+
+
+class TelemetryReader:
+    def __init__(self, definitions: dict, paths: Union[Path, str, Iterable]):
+        """
+        Description:
+            Memory maps recording files read only, records are NumPy views of the files and are never copied
+            unless several files are joined.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            paths (Path): A recording file, a folder of them or a list of files, read in name order
+        """
+        if isinstance(paths, (str, Path)):
+            paths = Path(paths)
+            paths = sorted(paths.glob('*.rec')) if paths.is_dir() else [paths]
+
+        self.paths = sorted(Path(path) for path in paths)
+        self.message_types = definitions['message_types']
+        self.job_command_types = np.array([value for key, value in definitions['command_types'].items() if key.startswith('SEND_JOB')], dtype=np.uint8)
+
+        self.files = []
+        self.refresh()
+
+    def refresh(self):
+        """
+        Description:
+            Re-reads the record counts, picks up records written since the files were opened.
+        """
+        self.files = []
+
+        for path in self.paths:
+            with open(path, 'rb') as file:
+                magic, version, record_size, capacity, record_count, start_time = file_header_struct.unpack(file.read(file_header_struct.size))
+
+            if magic != FILE_MAGIC or version != FILE_VERSION or record_size != record_dtype.itemsize:
+                raise ValueError(f"{path} is not a version {FILE_VERSION} motor recording")
+
+            if record_count > 0:
+                self.files.append(np.memmap(path, dtype=record_dtype, mode='r', offset=file_header_struct.size, shape=(record_count,)))
+
+    @property
+    def records(self):
+        """
+        Description:
+            Every record oldest first, a view for a single file and a copy when there are several.
+        """
+        if len(self.files) == 1:
+            return self.files[0]
+
+        if len(self.files) == 0:
+            return np.zeros(0, dtype=record_dtype)
+
+        return np.concatenate(self.files)
+
+    def __len__(self):
+        return sum(len(records) for records in self.files)
+
+    def received(self, message_name: str, records: Union[np.ndarray, None] = None):
+        records = self.records if records is None else records
+        return records[(records['direction'] == RECEIVED) & (records['message_id'] == self.message_types[message_name])]
+
+    def feedback(self, records: Union[np.ndarray, None] = None):
+        """
+        Description:
+            Feedback records as columns timestamp, velocity, position and encoder_count read straight from the frame
+            bytes. Frames from firmware sending the 11 byte feedback message only have a 2 byte encoder_count.
+        """
+        return self.received('MOTOR_FEEDBACK_MESSAGE_ID', records).view(feedback_view_dtype)
+
+    def status(self, records: Union[np.ndarray, None] = None):
+        return self.received('MOTOR_STATUS_MESSAGE_ID', records).view(status_view_dtype)
+
+    def responses(self, records: Union[np.ndarray, None] = None):
+        return self.received('RESPONSE_MESSAGE_ID', records).view(response_view_dtype)
+
+    def sent(self, records: Union[np.ndarray, None] = None):
+        records = self.records if records is None else records
+        return records[records['direction'] == SENT]
+
+    def job_index(self):
+        """
+        Description:
+            Where every job command was sent.
+
+        Returns:
+            index: (dict) job id -> list of (file index, record index), oldest first
+        """
+        index = {}
+
+        for file_index, records in enumerate(self.files):
+            starts = np.flatnonzero((records['direction'] == SENT) & np.isin(records['message_id'], self.job_command_types))
+
+            for record_index, job_id in zip(starts, records['job_id'][starts]):
+                index.setdefault(int(job_id), []).append((file_index, int(record_index)))
+
+        return index
+
+    def job_records(self, job_id: int, occurrence: int = -1):
+        """
+        Description:
+            Every record from a job command being sent to its JOB_COMPLETE or JOB_CANCELLED, including feedback.
+            Adjustment jobs reuse the job id, so each of them is its own occurrence.
+
+        Args:
+            job_id (int): Job id
+            occurrence (int): Which time the job id was sent, -1 the most recent
+
+        Returns:
+            records: (np.ndarray) view of the records, None if the job id was never sent
+        """
+        starts = self.job_index().get(job_id)
+
+        if starts is None:
+            return None
+
+        file_index, start = starts[occurrence]
+        end_ids = [self.message_types[name] for name in ('JOB_COMPLETE_MESSAGE_ID', 'JOB_CANCELLED_MESSAGE_ID') if name in self.message_types]
+        parts = []
+
+        # A job can run on into the following files
+        for records in self.files[file_index:]:
+            records = records[start:]
+            start = 0
+            ends = np.flatnonzero((records['direction'] == RECEIVED) & np.isin(records['message_id'], end_ids) & (records['job_id'] == job_id))
+
+            if len(ends) > 0:
+                parts.append(records[:ends[0] + 1])
+                break
+
+            parts.append(records)
+
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def raw_stream(self, records: Union[np.ndarray, None] = None, direction: int = RECEIVED):
+        """
+        Description:
+            The recorded frames joined back into the byte stream that crossed the serial port.
+        """
+        records = self.records if records is None else records
+        records = records[records['direction'] == direction]
+        frame_lengths = np.minimum(records['frame_length'], FRAME_BYTES)
+        keep = np.arange(FRAME_BYTES) < frame_lengths[:, None]
+
+        return records['frame'][keep].tobytes()
+
+
+class TelemetryReplayer:
+    def __init__(self, definitions: dict, records: np.ndarray):
+        """
+        Description:
+            Feeds the received frames of a recording through a SerialFramer and MessageDispatcher, the same parser
+            Motor uses, so handlers registered here see the messages a live Motor saw.
+
+        Args:
+            definitions (dict): Output of parse_definitions_file
+            records (np.ndarray): record_dtype records, e.g. TelemetryReader.records or job_records()
+        """
+        received = records[records['direction'] == RECEIVED]
+        frame_lengths = np.minimum(received['frame_length'], FRAME_BYTES).astype(np.int64)
+        keep = np.arange(FRAME_BYTES) < frame_lengths[:, None]
+
+        self.stream = memoryview(received['frame'][keep].tobytes())
+        self.frame_ends = np.cumsum(frame_lengths)
+        self.timestamps = received['timestamp'].copy()
+
+        self.framer = SerialFramer(stx=definitions['serial_settings']['STX'], etx=definitions['serial_settings']['ETX'])
+        self.dispatcher = MessageDispatcher(definitions)
+        self.frames_dispatched = 0
+
+    def register_handler(self, message_id: int, handler):
+        self.dispatcher.register_handler(message_id, handler)
+
+    def feed(self, start: int, end: int):
+        chunk_length = len(self.framer.buffer) // 2
+
+        for chunk_start in range(start, end, chunk_length):
+            self.framer.feed(self.stream[chunk_start:min(chunk_start + chunk_length, end)])
+            message_id, message_buffer = self.framer.next_frame()
+
+            while message_id != 0:
+                message = self.dispatcher.decode(message_id, message_buffer)
+
+                if message is not None:
+                    self.dispatcher.dispatch(message_id, message)
+                    self.frames_dispatched += 1
+
+                message_id, message_buffer = self.framer.next_frame()
+
+    def run(self, speed: Union[float, None] = None):
+        """
+        Description:
+            Replays the recording, as fast as possible when speed is None, otherwise at speed times real time
+            with frames released in the same bursts they arrived in.
+
+        Returns:
+            frames dispatched: (int)
+            elapsed: (float) seconds
+        """
+        start_time = time.monotonic()
+        self.frames_dispatched = 0
+
+        if speed is None or len(self.timestamps) == 0:
+            self.feed(0, len(self.stream))
+            return self.frames_dispatched, time.monotonic() - start_time
+
+        first_timestamp = self.timestamps[0]
+        frame_index = 0
+        byte_index = 0
+
+        while frame_index < len(self.timestamps):
+            now = time.monotonic()
+            next_time = start_time + (self.timestamps[frame_index] - first_timestamp) / speed
+
+            if next_time > now:
+                time.sleep(next_time - now)
+                now = time.monotonic()
+
+            # Every frame due by now
+            frame_index = int(np.searchsorted(self.timestamps, first_timestamp + (now - start_time) * speed, side='right'))
+            frame_end = int(self.frame_ends[frame_index - 1])
+            self.feed(byte_index, frame_end)
+            byte_index = frame_end
+
+        return self.frames_dispatched, time.monotonic() - start_time
+
+
+if __name__ == "__main__":
+    import argparse
+
+    project_dir = Path(__file__).resolve().parents[1]
+
+    parser = argparse.ArgumentParser(description="Summarise and replay a motor recording")
+    parser.add_argument('recording', type=Path, help="recording file or folder")
+    parser.add_argument('--definitions', type=Path, default=project_dir / 'arduino/engineering-team-motor/definitions.h')
+    parser.add_argument('--speed', type=float, default=None, help="replay speed, as fast as possible by default")
+    parser.add_argument('--raw-stream', type=Path, default=None, help="write the received byte stream here, see protocol_benchmark --recording")
+    args = parser.parse_args()
+
+    from definition_file_parser import parse_definitions_file
+    definitions = parse_definitions_file(args.definitions)
+    reader = TelemetryReader(definitions, args.recording)
+    records = reader.records
+
+    print(f"{len(records)} records from {len(reader.files)} file(s)")
+
+    for name, message_id in definitions['message_types'].items():
+        print(f"{name}: {np.count_nonzero((records['direction'] == RECEIVED) & (records['message_id'] == message_id))}")
+
+    print(f"commands sent: {np.count_nonzero(records['direction'] == SENT)}, job ids: {sorted(reader.job_index())}")
+
+    if args.raw_stream is not None:
+        args.raw_stream.write_bytes(reader.raw_stream(records))
+
+    frames, elapsed = TelemetryReplayer(definitions, records).run(speed=args.speed)
+    print(f"replayed {frames} frames in {elapsed:.3f} s")
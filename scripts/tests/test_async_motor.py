@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    AsyncMotor against a VirtualMotor on a pseudo terminal, run with python -m pytest scripts/tests or directly
+"""
+
+import sys
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from async_motor import AsyncMotor
+from virtual_motor import VirtualMotor
+from messages import FeedbackBatchMessage
+
+
+def run_with_virtual_motor(test):
+    """
+    Description:
+        Runs the coroutine function test(motor, virtual_motor) with a connected AsyncMotor.
+    """
+    virtual_motor = VirtualMotor(None)
+    virtual_motor.start(loop_period=0.0001)
+
+    async def run():
+        async with AsyncMotor(serial_port=virtual_motor.port_name) as motor:
+            await asyncio.wait_for(test(motor, virtual_motor), 10.0)
+
+    try:
+        asyncio.run(run())
+
+    finally:
+        virtual_motor.close()
+
+
+def test_set_feedback_batch():
+    async def test(motor, virtual_motor):
+        # The Motor method returns a concurrent future on AsyncMotor as well
+        assert await asyncio.wrap_future(motor.set_feedback_batch(5, interval_us=2000))
+        assert motor.feedback_batch_size == 5
+        assert virtual_motor.feedback_batch_size == 5
+
+        async for message in motor.feedback():
+            if isinstance(message, FeedbackBatchMessage):
+                assert len(message.samples) == 5
+                break
+
+        assert await motor.batch_feedback(1, interval_us=10000)
+        assert motor.feedback_batch_size == 1
+
+    run_with_virtual_motor(test)
+
+
+def test_enable_device_timestamps():
+    async def test(motor, virtual_motor):
+        assert await asyncio.wrap_future(motor.enable_device_timestamps(True))
+        assert motor.device_timestamps_enabled
+        assert virtual_motor.timestamps_enabled
+
+        assert not await motor.enable_timestamps(False)
+        assert not motor.device_timestamps_enabled
+
+    run_with_virtual_motor(test)
+
+
+def test_close_ends_feedback_iteration():
+    async def test(motor, virtual_motor):
+        async def consume():
+            async for _ in motor.feedback():
+                pass
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0.1)
+        await motor.close()
+        await asyncio.wait_for(consumer, 1.0)
+
+    run_with_virtual_motor(test)
+
+
+def test_close_after_unplug():
+    virtual_motor = VirtualMotor(None)
+    virtual_motor.start()
+
+    async def run():
+        motor = AsyncMotor(serial_port=virtual_motor.port_name)
+        await motor.connect()
+        virtual_motor.close()
+
+        # The transport closes itself on the hangup
+        for _ in range(100):
+            if not motor.ser.is_open:
+                break
+
+            await asyncio.sleep(0.01)
+
+        assert not motor.ser.is_open
+        await motor.close()
+        assert motor.reader_fd is None
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_set_feedback_batch()
+    test_enable_device_timestamps()
+    test_close_ends_feedback_iteration()
+    test_close_after_unplug()
+    print("passed")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    CommandScheduler send order, capacities, stop preemption and coalescing
+"""
+
+import sys
+from pathlib import Path
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor_protocol import load_protocol
+from command_codec import CommandCodec
+from command_scheduler import (CommandScheduler, CommandQueueFullError, CommandPreemptedError, QUEUED, COALESCED,
+                               REJECTED, SAFETY_STOP, CANCEL, CONTROL, JOB)
+
+definitions = load_protocol()
+commands = definitions['command_types']
+codec = CommandCodec(definitions)
+
+
+def static(command_name: str):
+    return codec.get_static_frame(command_name)
+
+
+def job(job_id: int):
+    return codec.encode_job(command=commands['SEND_JOB'], direction=True, job_id=job_id, pulses=100)
+
+
+def submit(scheduler: CommandScheduler, frame: bytes):
+    return scheduler.submit(frame, Future())
+
+
+def test_priority_classes():
+    scheduler = CommandScheduler(definitions)
+
+    assert scheduler.priorities[commands['DISABLE_MOTOR']] == SAFETY_STOP
+    assert scheduler.priorities[commands['RESET_MOTOR']] == SAFETY_STOP
+    assert scheduler.priorities[commands['CANCEL_JOB']] == CANCEL
+    assert scheduler.priorities[commands['PAUSE_JOB']] == CANCEL
+    assert scheduler.priorities[commands['ENABLE_MOTOR']] == CONTROL
+    assert scheduler.priorities[commands['SEND_JOB']] == JOB
+
+
+def test_drain_keeps_send_order():
+    scheduler = CommandScheduler(definitions)
+    frames = [static('ENABLE_MOTOR'), static('WAKE_MOTOR'), job(1), static('PAUSE_JOB'), static('RESUME_JOB')]
+
+    for frame in frames:
+        assert submit(scheduler, frame)[0] == QUEUED
+
+    assert len(scheduler) == len(frames)
+    assert scheduler.drain() == frames
+    assert len(scheduler) == 0
+    assert scheduler.drain() == []
+
+
+def test_full_class_rejects_without_blocking_the_others():
+    scheduler = CommandScheduler(definitions, capacities=(4, 4, 4, 2))
+    submit(scheduler, job(1))
+    submit(scheduler, job(2))
+
+    status, future = submit(scheduler, job(3))
+    assert status == REJECTED
+    assert isinstance(future.exception(0), CommandQueueFullError)
+
+    # Other classes still have room
+    assert submit(scheduler, static('ENABLE_MOTOR'))[0] == QUEUED
+    assert scheduler.rejected == 1
+    assert scheduler.drain() == [job(1), job(2), static('ENABLE_MOTOR')]
+
+    # Capacity is freed by the drain
+    assert submit(scheduler, job(3))[0] == QUEUED
+
+
+def test_safety_stop_drops_everything_queued_before_it():
+    scheduler = CommandScheduler(definitions)
+    _, job_future = submit(scheduler, job(1))
+    _, wake_future = submit(scheduler, static('WAKE_MOTOR'))
+    submit(scheduler, static('DISABLE_MOTOR'))
+    submit(scheduler, static('ENABLE_MOTOR'))
+
+    for future in (job_future, wake_future):
+        assert isinstance(future.exception(0), CommandPreemptedError)
+
+    assert scheduler.preempted == 2
+    assert scheduler.drain() == [static('DISABLE_MOTOR'), static('ENABLE_MOTOR')]
+
+
+def test_cancel_drops_queued_jobs_only():
+    scheduler = CommandScheduler(definitions)
+    _, job_future = submit(scheduler, job(1))
+    submit(scheduler, static('WAKE_MOTOR'))
+    submit(scheduler, static('CANCEL_JOB'))
+
+    assert job_future.exception(0).preempted_by == commands['CANCEL_JOB']
+    assert scheduler.drain() == [static('WAKE_MOTOR'), static('CANCEL_JOB')]
+
+
+def test_pause_is_never_written_before_its_job():
+    scheduler = CommandScheduler(definitions)
+    submit(scheduler, job(1))
+    submit(scheduler, static('PAUSE_JOB'))
+
+    assert scheduler.drain() == [job(1), static('PAUSE_JOB')]
+
+
+def test_repeated_commands_are_coalesced():
+    scheduler = CommandScheduler(definitions)
+    _, first_future = submit(scheduler, static('WAKE_MOTOR'))
+    status, future = submit(scheduler, static('WAKE_MOTOR'))
+
+    assert status == COALESCED
+    assert future is first_future
+
+    # Only against the last frame waiting, so the order of different commands is kept
+    submit(scheduler, static('SLEEP_MOTOR'))
+    assert submit(scheduler, static('WAKE_MOTOR'))[0] == QUEUED
+
+    # Jobs are never merged
+    submit(scheduler, job(1))
+    assert submit(scheduler, job(1))[0] == QUEUED
+
+    assert scheduler.coalesced == 1
+    assert len(scheduler.drain()) == 5
+
+
+def test_clear_cancels_waiting_futures():
+    scheduler = CommandScheduler(definitions)
+    pending_futures = [submit(scheduler, frame)[1] for frame in (static('ENABLE_MOTOR'), job(1))]
+    scheduler.clear()
+
+    assert all(future.cancelled() for future in pending_futures)
+    assert len(scheduler) == 0
+    assert not scheduler.wait(0)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
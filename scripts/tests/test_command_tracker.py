@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    CommandTracker response matching, resends, timeouts and pruning of finished futures
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor_protocol import load_protocol
+from messages import ResponseMessage
+from command_codec import CommandCodec
+from command_tracker import CommandTracker, MotorCommandError, CommandTimeoutError
+
+definitions = load_protocol()
+commands = definitions['command_types']
+responses = definitions['response_types']
+codec = CommandCodec(definitions)
+
+
+def job_frame(job_id: int):
+    return codec.encode_job(command=commands['SEND_JOB'], direction=True, job_id=job_id, pulses=100)
+
+
+def latest_deadline(tracker: CommandTracker):
+    return max(pending_command.deadline for pending in tracker.pending.values() for pending_command in pending)
+
+
+def ack(command: int, job_id: int = 0):
+    return ResponseMessage(command, job_id, 0, True)
+
+
+def test_ack_and_nak():
+    tracker = CommandTracker(definitions)
+    enable_future = tracker.track(codec.get_static_frame('ENABLE_MOTOR'))
+    wake_future = tracker.track(codec.get_static_frame('WAKE_MOTOR'))
+
+    assert tracker.resolve(ack(commands['ENABLE_MOTOR']))
+    assert enable_future.result(0).acknowledged
+
+    assert tracker.resolve(ResponseMessage(commands['WAKE_MOTOR'], 0, responses['MOTOR_ALREADY_AWAKE_RESPONSE'], False))
+
+    with pytest.raises(MotorCommandError) as error:
+        wake_future.result(0)
+
+    assert error.value.response_name == 'MOTOR_ALREADY_AWAKE_RESPONSE'
+    assert tracker.pending_count == 0
+    assert tracker.get_statistics()['responses_acknowledged'] == 1
+    assert tracker.get_statistics()['responses_rejected'] == 1
+
+
+def test_matching_order():
+    tracker = CommandTracker(definitions)
+
+    # Commands without a job id are matched oldest first, jobs by their job id
+    first, second = (tracker.track(codec.get_static_frame('SLEEP_MOTOR')) for _ in range(2))
+    job_1, job_2 = tracker.track(job_frame(1)), tracker.track(job_frame(2))
+
+    tracker.resolve(ack(commands['SEND_JOB'], 2))
+    tracker.resolve(ack(commands['SLEEP_MOTOR']))
+
+    assert job_2.done() and not job_1.done()
+    assert first.done() and not second.done()
+
+    assert not tracker.resolve(ack(commands['SEND_JOB'], 7))
+    assert tracker.get_statistics()['responses_unmatched'] == 1
+    assert tracker.pending_count == 2
+
+
+def test_resend_then_timeout():
+    tracker = CommandTracker(definitions, timeout=1.0, retries=2)
+    frame = codec.get_static_frame('ENABLE_MOTOR')
+    future = tracker.track(frame)
+    resent = []
+    now = latest_deadline(tracker)
+
+    # Nothing is due before the deadline
+    tracker.check_deadlines(resent.append, now=now - 0.5)
+    assert resent == []
+
+    for _ in range(2):
+        tracker.check_deadlines(resent.append, now=now)
+        now += 1.0
+
+    assert resent == [frame, frame]
+    assert not future.done()
+
+    tracker.check_deadlines(resent.append, now=now)
+
+    with pytest.raises(CommandTimeoutError) as error:
+        future.result(0)
+
+    assert error.value.attempts == 3
+    assert tracker.pending_count == 0
+    assert tracker.get_statistics()['commands_resent'] == 2
+    assert tracker.get_statistics()['commands_timed_out'] == 1
+
+
+def test_failing_resend_still_times_out_expired_commands():
+    tracker = CommandTracker(definitions, timeout=1.0)
+    expiring = tracker.track(codec.get_static_frame('ENABLE_MOTOR'))
+    tracker.track(codec.get_static_frame('WAKE_MOTOR'), retries=1)
+
+    def failing_resend(frame):
+        raise OSError("port closed")
+
+    with pytest.raises(OSError):
+        tracker.check_deadlines(failing_resend, now=latest_deadline(tracker))
+
+    assert isinstance(expiring.exception(0), CommandTimeoutError)
+
+
+def test_finished_futures_are_pruned():
+    tracker = CommandTracker(definitions)
+    cancelled = tracker.track(codec.get_static_frame('SLEEP_MOTOR'))
+    waiting = tracker.track(codec.get_static_frame('SLEEP_MOTOR'))
+    cancelled.cancel()
+
+    # A cancelled command never takes a response meant for the next one
+    assert tracker.resolve(ack(commands['SLEEP_MOTOR']))
+    assert waiting.result(0).acknowledged
+    assert tracker.pending_count == 0
+    assert tracker.pending == {}
+
+    dropped = tracker.track(codec.get_static_frame('RESUME_JOB'))
+    dropped.cancel()
+    tracker.check_deadlines(lambda frame: None, now=0.0)
+
+    assert tracker.pending_count == 0
+    assert tracker.pending == {}
+
+
+def test_cancel_all():
+    tracker = CommandTracker(definitions)
+    pending_futures = [tracker.track(codec.get_static_frame('ENABLE_MOTOR')), tracker.track(job_frame(3))]
+    tracker.cancel_all()
+
+    assert all(future.cancelled() for future in pending_futures)
+    assert tracker.pending_count == 0
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    DeviceClock offset and drift estimation, micros() unwrapping, resyncs and update_batch
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from device_clock import DeviceClock, MICROS_MASK
+
+INTERVAL_US = 10000
+HOST_START = 1000.0
+DRIFT = 50e-6
+LATENCY_FLOOR = 150e-6
+
+
+def simulate(samples: int, start_micros: int = 0, seed: int = 0):
+    """
+    Description:
+        Firmware micros() of samples every INTERVAL_US, the host time each was taken and the time it arrived.
+    """
+    random = np.random.default_rng(seed)
+    device_micros = start_micros + INTERVAL_US * np.arange(samples, dtype=np.int64)
+    sample_times = HOST_START + (device_micros - start_micros) * 1e-6 * (1.0 + DRIFT)
+    arrival_times = sample_times + LATENCY_FLOOR + random.exponential(300e-6, samples)
+    return device_micros & MICROS_MASK, sample_times, arrival_times
+
+
+def test_offset_and_drift():
+    clock = DeviceClock(nominal_interval_us=INTERVAL_US)
+    raw_micros, sample_times, arrival_times = simulate(3000)
+
+    mapped = np.array([clock.update(int(raw), arrival) for raw, arrival in zip(raw_micros, arrival_times)])
+
+    # Late by the latency floor, none of the jitter
+    errors = (mapped - sample_times)[-1000:]
+    assert np.all(np.abs(errors - LATENCY_FLOOR) < 100e-6)
+    assert abs(clock.get_statistics()['drift_ppm'] - DRIFT * 1e6) < 5.0
+    assert np.all(mapped <= arrival_times + 1e-9)
+
+
+def test_micros_wraparound():
+    clock = DeviceClock(nominal_interval_us=INTERVAL_US)
+    raw_micros, sample_times, arrival_times = simulate(500, start_micros=MICROS_MASK - 200 * INTERVAL_US)
+
+    mapped = np.array([clock.update(int(raw), arrival) for raw, arrival in zip(raw_micros, arrival_times)])
+
+    assert clock.wraps == 1
+    assert clock.resets == 0
+    assert np.all(np.diff(mapped) > 0)
+    assert abs(mapped[-1] - sample_times[-1] - LATENCY_FLOOR) < 500e-6
+
+    # Times on either side of the latest sample unwrap against it
+    assert abs(clock.to_host_time(int(raw_micros[-2])) - mapped[-2]) < 1e-6
+
+
+def test_restart_resyncs():
+    clock = DeviceClock(nominal_interval_us=INTERVAL_US)
+    raw_micros, _, arrival_times = simulate(100, start_micros=5_000_000)
+
+    for raw, arrival in zip(raw_micros, arrival_times):
+        clock.update(int(raw), arrival)
+
+    # The controller restarted, micros() starts again from zero
+    restart_time = arrival_times[-1] + 0.5
+    assert abs(clock.update(1000, restart_time) - restart_time) < 1e-9
+    assert clock.resets == 1
+    assert clock.sample_count == 1
+
+    # A sample arriving well before the model says it was taken
+    clock.update(1000 + INTERVAL_US, restart_time + 0.01)
+    clock.update(1000 + 2 * INTERVAL_US, restart_time + 0.01 - clock.resync_threshold - 0.1)
+    assert clock.resets == 2
+
+
+def test_update_batch_matches_update():
+    single = DeviceClock(nominal_interval_us=INTERVAL_US)
+    batched = DeviceClock(nominal_interval_us=INTERVAL_US)
+    raw_micros, sample_times, _ = simulate(2000, start_micros=MICROS_MASK - 500 * INTERVAL_US)
+    batch_length = 10
+
+    batch_times = []
+
+    for start in range(0, len(raw_micros), batch_length):
+        # A batch is sent once its newest sample is taken
+        arrival_time = sample_times[start + batch_length - 1] + LATENCY_FLOOR + 50e-6 * (start % 7)
+        batch = raw_micros[start:start + batch_length]
+
+        for raw in batch:
+            single.update(int(raw), arrival_time)
+
+        batch_times.append(batched.update_batch(batch, arrival_time))
+
+    batch_times = np.concatenate(batch_times)
+
+    assert batched.wraps == single.wraps == 1
+    assert batched.sample_count == single.sample_count == len(raw_micros)
+    assert batched.resets == 0
+    assert abs(batched.drift - single.drift) < 5e-6
+    assert abs(batched.to_host_time(int(raw_micros[-1])) - single.to_host_time(int(raw_micros[-1]))) < 50e-6
+    assert np.all(np.abs(batch_times[-500:] - sample_times[-500:] - LATENCY_FLOOR) < 300e-6)
+
+
+def test_update_batch_going_backwards_falls_back_to_update():
+    clock = DeviceClock(nominal_interval_us=INTERVAL_US)
+    clock.update(5_000_000, HOST_START)
+    clock.update_batch(np.array([5_010_000, 1000, 11000], dtype=np.uint32), HOST_START + 0.02)
+
+    assert clock.resets == 1
+    assert clock.sample_count == 2
+    assert len(clock.update_batch(np.zeros(0, dtype=np.uint32), HOST_START)) == 0
+
+
+if __name__ == "__main__":
+    test_offset_and_drift()
+    test_micros_wraparound()
+    test_restart_resyncs()
+    test_update_batch_matches_update()
+    test_update_batch_going_backwards_falls_back_to_update()
+    print("passed")
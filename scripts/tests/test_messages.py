@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    MessageDispatcher decoding of well formed and short message buffers
+"""
+
+import sys
+import struct
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor_protocol import load_protocol
+from messages import MessageDispatcher, FeedbackMessage, FeedbackBatchMessage, feedback_batch_dtype
+from motor_metrics import MotorMetrics
+
+definitions = load_protocol()
+message_types = definitions['message_types']
+ETX = definitions['serial_settings']['ETX']
+
+
+def test_decode_full_messages():
+    dispatcher = MessageDispatcher(definitions)
+
+    feedback = dispatcher.decode(message_types['MOTOR_FEEDBACK_MESSAGE_ID'],
+                                 struct.pack('<B2fiB', message_types['MOTOR_FEEDBACK_MESSAGE_ID'], 1.5, 2.5, 1000, ETX))
+    assert isinstance(feedback, FeedbackMessage)
+    assert feedback.encoder_count == 1000
+
+    batch_id = message_types['MOTOR_FEEDBACK_BATCH_MESSAGE_ID']
+    batch = dispatcher.decode(batch_id, bytes([batch_id, 2]) + bytes(2 * feedback_batch_dtype.itemsize) + bytes([ETX]))
+    assert isinstance(batch, FeedbackBatchMessage)
+    assert len(batch) == 2
+
+
+def test_short_messages_return_none():
+    dispatcher = MessageDispatcher(definitions)
+
+    for message_name in ('MOTOR_STATUS_MESSAGE_ID', 'MOTOR_FEEDBACK_MESSAGE_ID', 'MOTOR_FEEDBACK_BATCH_MESSAGE_ID',
+                         'RESPONSE_MESSAGE_ID', 'JOB_COMPLETE_MESSAGE_ID', 'JOB_CANCELLED_MESSAGE_ID'):
+        message_id = message_types[message_name]
+
+        # A correctly framed message holding only the message id and ETX
+        assert dispatcher.decode(message_id, bytes([message_id, ETX])) is None, message_name
+        assert dispatcher.decode(message_id, memoryview(bytes([message_id]))) is None, message_name
+
+
+def test_short_messages_count_as_framing_errors():
+    metrics = MotorMetrics(definitions)
+    metrics.record_received(message_types['RESPONSE_MESSAGE_ID'], False, 0, known=True)
+    metrics.record_received(0x7F, False, 0)
+
+    counters = metrics.snapshot()['counters']
+    assert counters['framing_errors'] == 1
+    assert counters['unknown_messages'] == 1
+
+
+if __name__ == "__main__":
+    test_decode_full_messages()
+    test_short_messages_return_none()
+    test_short_messages_count_as_framing_errors()
+    print("passed")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    MotorBus serving several VirtualMotors, an error on one motor must not stop the others
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor import Motor
+from motor_bus import MotorBus
+from virtual_motor import VirtualMotor
+
+
+@pytest.fixture
+def bus():
+    virtual_motors = [VirtualMotor(None) for _ in range(2)]
+
+    for virtual_motor in virtual_motors:
+        virtual_motor.start()
+
+    motor_bus = MotorBus()
+    motors = [motor_bus.add_motor(Motor(serial_port=virtual_motor.port_name, metrics=True)) for virtual_motor in virtual_motors]
+    motor_bus.start()
+
+    yield motor_bus, motors, virtual_motors
+
+    motor_bus.stop()
+
+    for virtual_motor in virtual_motors:
+        virtual_motor.close()
+
+
+def wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+def test_handler_error_only_affects_its_motor(bus):
+    motor_bus, (failing_motor, motor), _ = bus
+
+    def failing_handler(message):
+        raise ValueError("handler error")
+
+    failing_motor.register_handler(failing_motor.motor_feedback_message_id, failing_handler)
+
+    assert wait_for(lambda: failing_motor.metrics.loop_exceptions > 0)
+    assert motor.send_enable_motor().result(1).acknowledged
+    assert failing_motor.send_enable_motor().result(1).acknowledged
+    assert motor.metrics.loop_exceptions == 0
+    assert motor_bus.loop_thread.is_alive()
+
+
+def test_unplugged_motor_is_disconnected_and_reconnected(bus):
+    motor_bus, (unplugged_motor, motor), virtual_motors = bus
+    virtual_motors.pop(0).close()
+
+    assert wait_for(lambda: unplugged_motor in motor_bus.disconnected_motors)
+    assert motor.send_enable_motor().result(1).acknowledged
+    assert motor_bus.loop_thread.is_alive()
+
+    # Plugged back in, here as a new pseudo terminal
+    virtual_motor = VirtualMotor(None)
+    virtual_motor.start()
+    virtual_motors.append(virtual_motor)
+    unplugged_motor.serial_port_name = virtual_motor.port_name
+
+    assert wait_for(lambda: unplugged_motor not in motor_bus.disconnected_motors, timeout=3.0)
+    assert unplugged_motor.send_enable_motor().result(1).acknowledged
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
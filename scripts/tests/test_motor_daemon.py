@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    MotorDaemon serving clients of a VirtualMotor, a misbehaving client must not affect the others
+"""
+
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor import Motor
+from virtual_motor import VirtualMotor
+from motor_daemon import MotorDaemon, MotorClient, BAD_FRAME_RESPONSE
+from command_tracker import MotorCommandError
+
+
+@pytest.fixture
+def daemon():
+    virtual_motor = VirtualMotor(None)
+    virtual_motor.start()
+    motor = Motor(serial_port=virtual_motor.port_name)
+    socket_path = Path(tempfile.mkdtemp()) / 'motor.sock'
+    motor_daemon = MotorDaemon(motor, socket_path)
+    motor_daemon.start()
+
+    yield motor_daemon
+
+    motor_daemon.stop()
+    motor.stop()
+    virtual_motor.close()
+
+
+def test_short_subscribe_is_rejected(daemon):
+    good_client = MotorClient(None, daemon.socket_path)
+    bad_client = MotorClient(None, daemon.socket_path)
+
+    # SUBSCRIBE without its decimation, UNSUBSCRIBE without its message id
+    for frame in (bytes.fromhex('020570FE03'), bytes.fromhex('02047103')):
+        with pytest.raises(MotorCommandError) as error:
+            bad_client.send_command(frame).result(1)
+
+        assert error.value.response_message.response == BAD_FRAME_RESPONSE
+
+    assert daemon.loop_thread.is_alive()
+    assert good_client.send_static_command('ENABLE_MOTOR').result(1).acknowledged
+
+    good_client.close()
+    bad_client.close()
+
+
+def test_client_error_only_disconnects_that_client(daemon):
+    good_client = MotorClient(None, daemon.socket_path)
+    bad_client = MotorClient(None, daemon.socket_path)
+    assert bad_client.acquire_control().result(1).acknowledged
+
+    process_client_frame = daemon.process_client_frame
+
+    def failing_process_client_frame(client, command, message_buffer):
+        if client is daemon.controller:
+            raise ValueError("client error")
+
+        process_client_frame(client, command, message_buffer)
+
+    daemon.process_client_frame = failing_process_client_frame
+    bad_client.send_static_command('ENABLE_MOTOR')
+    deadline = time.monotonic() + 1.0
+
+    while len(daemon.clients) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Control is released with the disconnect, so the other client may command the motor
+    assert good_client.send_static_command('ENABLE_MOTOR').result(1).acknowledged
+    assert daemon.loop_thread.is_alive()
+    assert len(daemon.clients) == 1
+
+    good_client.close()
+    bad_client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
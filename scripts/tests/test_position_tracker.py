@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    PositionTracker unwrapping across the encoder wraparound, origins and wrapped differences
+"""
+
+import sys
+import math
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from motor_protocol import load_protocol
+from position_tracker import PositionTracker
+
+counts_per_revolution = load_protocol()['encoder_settings']['ENCODER_PULSES_PER_REVOLUTION']
+
+
+def true_counts(start: int, step: int, samples: int):
+    return start + step * np.arange(samples, dtype=np.int64)
+
+
+def test_forward_and_backward_wraparound():
+    tracker = PositionTracker(counts_per_revolution)
+
+    assert tracker.update(counts_per_revolution - 10) == counts_per_revolution - 10
+    assert tracker.update(5) == counts_per_revolution + 5
+    assert tracker.turns == 1
+
+    assert tracker.update(counts_per_revolution - 10) == counts_per_revolution - 10
+    assert tracker.update(counts_per_revolution - 20) == counts_per_revolution - 20
+    assert tracker.turns == 0
+
+    tracker.update(5)
+    tracker.update(counts_per_revolution - 5)
+    assert tracker.unwrapped_count == counts_per_revolution + 5 - 10
+    assert tracker.turns == 0
+
+
+def test_many_turns_in_both_directions():
+    tracker = PositionTracker(counts_per_revolution)
+    step = counts_per_revolution // 3 + 1
+
+    for count in true_counts(7, step, 100):
+        tracker.update(int(count) % counts_per_revolution)
+
+    assert tracker.unwrapped_count == 7 + step * 99
+
+    for count in true_counts(7 + step * 99, -step, 200):
+        tracker.update(int(count) % counts_per_revolution)
+
+    assert tracker.unwrapped_count == 7 + step * 99 - step * 199
+    assert tracker.turns == (tracker.unwrapped_count - tracker.angle_count) // counts_per_revolution
+
+
+def test_update_batch_matches_update():
+    step = counts_per_revolution // 4 - 3
+    angle_counts = np.concatenate((true_counts(counts_per_revolution - 100, step, 40),
+                                   true_counts(counts_per_revolution - 100 + step * 39, -step, 90))) % counts_per_revolution
+
+    single = PositionTracker(counts_per_revolution)
+    expected = [single.update(int(count)) for count in angle_counts]
+
+    batched = PositionTracker(counts_per_revolution)
+    unwrapped = np.concatenate([batched.update_batch(chunk) for chunk in np.array_split(angle_counts, 7)])
+
+    assert unwrapped.tolist() == expected
+    assert batched.unwrapped_count == single.unwrapped_count
+    assert batched.angle_count == single.angle_count
+    assert batched.turns == single.turns
+    assert len(batched.update_batch(np.zeros(0, dtype=np.int32))) == 0
+
+
+def test_origin():
+    tracker = PositionTracker(counts_per_revolution)
+    tracker.update(100)
+    tracker.set_origin()
+
+    assert tracker.absolute_count == 0
+
+    tracker.update(counts_per_revolution // 4 + 100)
+    assert tracker.absolute_count == counts_per_revolution // 4
+    assert math.isclose(tracker.absolute_position, counts_per_revolution // 4 * 2 * math.pi / counts_per_revolution)
+
+    tracker.set_origin(0)
+    assert tracker.absolute_count == tracker.unwrapped_count
+
+    tracker.reset()
+    assert tracker.angle_count is None
+    assert tracker.absolute_count == 0
+
+
+def test_wrapped_difference_and_conversion():
+    tracker = PositionTracker(counts_per_revolution)
+
+    assert tracker.wrapped_difference(counts_per_revolution - 5, 5) == 10
+    assert tracker.wrapped_difference(5, counts_per_revolution - 5) == -10
+    assert tracker.wrapped_difference(3 * counts_per_revolution + 20, 10) == -10
+    assert tracker.counts_from_radians(math.pi) == counts_per_revolution // 2
+    assert tracker.counts_from_radians(-2 * math.pi) == -counts_per_revolution
+
+
+if __name__ == "__main__":
+    test_forward_and_backward_wraparound()
+    test_many_turns_in_both_directions()
+    test_update_batch_matches_update()
+    test_origin()
+    test_wrapped_difference_and_conversion()
+    print("passed")
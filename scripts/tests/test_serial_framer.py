@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    SerialFramer frame extraction, resynchronisation and statistics
+"""
+
+import io
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from serial_framer import SerialFramer
+
+STX = 0x02
+ETX = 0x03
+
+
+def frame(message: bytes):
+    return bytes((STX, len(message) + 3)) + message + bytes((ETX,))
+
+
+def test_complete_frames():
+    framer = SerialFramer(stx=STX, etx=ETX)
+    framer.feed(frame(b'\xFE\x01\x02') + frame(b'\xFA\x07'))
+
+    assert [(message_id, bytes(message_buffer)) for message_id, message_buffer in framer.frames()] == [(0xFE, b'\xFE\x01\x02\x03'), (0xFA, b'\xFA\x07\x03')]
+    assert framer.available() == 0
+    assert framer.get_statistics() == {'bytes_received': 11, 'bytes_discarded': 0, 'frames_received': 2, 'frames_recovered': 0}
+
+
+def test_partial_frame_waits_for_the_rest():
+    framer = SerialFramer(stx=STX, etx=ETX)
+    data = frame(b'\xFE\x01\x02')
+
+    framer.feed(data[:3])
+    assert framer.next_frame() == (0, None)
+
+    framer.feed(data[3:])
+    message_id, message_buffer = framer.next_frame()
+    assert message_id == 0xFE
+    assert bytes(message_buffer) == b'\xFE\x01\x02\x03'
+
+
+def test_bad_length_byte_drops_only_stx():
+    framer = SerialFramer(stx=STX, etx=ETX)
+
+    # A length byte of 1 is below the minimum, the good frame straight after it must survive
+    framer.feed(bytes((STX, 1)) + frame(b'\xFA\x07'))
+
+    assert [(message_id, bytes(message_buffer)) for message_id, message_buffer in framer.frames()] == [(0xFA, b'\xFA\x07\x03')]
+    statistics = framer.get_statistics()
+    assert statistics['bytes_discarded'] == 2
+    assert statistics['frames_recovered'] == 1
+
+
+def test_missing_etx_resyncs_on_a_frame_inside():
+    framer = SerialFramer(stx=STX, etx=ETX)
+    good_frame = frame(b'\xFA\x07')
+
+    # The corrupt frame claims to hold the good one, its last byte isn't ETX
+    framer.feed(bytes((STX, len(good_frame) + 3)) + good_frame + b'\x00')
+
+    assert [message_id for message_id, _ in framer.frames()] == [0xFA]
+    assert framer.get_statistics()['frames_recovered'] == 1
+
+
+def test_noise_before_stx_is_discarded():
+    framer = SerialFramer(stx=STX, etx=ETX)
+    framer.feed(b'\xAA\xBB\xCC' + frame(b'\xFA\x07'))
+
+    assert [message_id for message_id, _ in framer.frames()] == [0xFA]
+    statistics = framer.get_statistics()
+    assert statistics['bytes_discarded'] == 3
+    assert statistics['frames_recovered'] == 1
+    assert statistics['frames_received'] == 1
+
+
+def test_returned_views_are_valid_until_the_next_feed():
+    framer = SerialFramer(stx=STX, etx=ETX, buffer_length=16)
+    framer.feed(frame(b'\xFE\x01\x02\x03') + frame(b'\xFA\x07'))
+
+    _, first = framer.next_frame()
+    _, second = framer.next_frame()
+
+    # Both views stay intact while frames are taken out of one read
+    assert bytes(first) == b'\xFE\x01\x02\x03\x03'
+    assert bytes(second) == b'\xFA\x07\x03'
+
+    first_copy = bytes(first)
+    framer.feed(frame(b'\xFD\x09\x09\x09\x09\x09\x09'))
+
+    # The buffer is reused, a message needed after the next feed has to be copied
+    assert bytes(first) != first_copy
+    assert first_copy == b'\xFE\x01\x02\x03\x03'
+    assert [message_id for message_id, _ in framer.frames()] == [0xFD]
+
+
+def test_overflow_discards_the_buffered_bytes():
+    framer = SerialFramer(stx=STX, etx=ETX, buffer_length=16)
+    framer.feed(bytes((STX, 20)) + bytes(10))
+
+    assert framer.next_frame() == (0, None)
+
+    framer.feed(frame(b'\xFA\x07') + bytes(6))
+    assert [message_id for message_id, _ in framer.frames()] == [0xFA]
+    statistics = framer.get_statistics()
+    assert statistics['bytes_discarded'] == 12 + 6
+    assert statistics['frames_recovered'] == 1
+
+
+def test_fill_from_reads_into_the_buffer():
+    framer = SerialFramer(stx=STX, etx=ETX)
+    data = frame(b'\xFE\x01\x02') + frame(b'\xFA\x07')
+
+    assert framer.fill_from(io.BytesIO(data), len(data)) == len(data)
+    assert framer.fill_from(io.BytesIO(b''), 0) == 0
+    assert [message_id for message_id, _ in framer.frames()] == [0xFE, 0xFA]
+    assert framer.get_statistics()['bytes_received'] == len(data)
+
+
+if __name__ == "__main__":
+    test_complete_frames()
+    test_partial_frame_waits_for_the_rest()
+    test_bad_length_byte_drops_only_stx()
+    test_missing_etx_resyncs_on_a_frame_inside()
+    test_noise_before_stx_is_discarded()
+    test_returned_views_are_valid_until_the_next_feed()
+    test_overflow_discards_the_buffered_bytes()
+    test_fill_from_reads_into_the_buffer()
+    print("passed")
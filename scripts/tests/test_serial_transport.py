@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    PosixSerialTransport on a pseudo terminal
+"""
+
+import os
+import sys
+import pty
+import errno
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from serial_transport import PosixSerialTransport, open_transport
+
+
+@pytest.fixture
+def terminal():
+    master_fd, slave_fd = pty.openpty()
+    transport = open_transport('posix', os.ttyname(slave_fd), 115200, timeout=0)
+
+    yield master_fd, transport
+
+    transport.close()
+
+    for fd in (master_fd, slave_fd):
+        try:
+            os.close(fd)
+
+        except OSError:
+            pass
+
+
+def test_read_and_write(terminal):
+    master_fd, transport = terminal
+    buffer = bytearray(16)
+
+    assert isinstance(transport, PosixSerialTransport)
+    assert transport.readinto(buffer) == 0
+    assert transport.is_open
+
+    os.write(master_fd, b'\x02\x04\xFE\x03')
+    assert transport.readinto(buffer) == 4
+    assert buffer[:4] == b'\x02\x04\xFE\x03'
+
+    assert transport.write(b'\x02\x04\xE8\x03') == 4
+    assert os.read(master_fd, 16) == b'\x02\x04\xE8\x03'
+
+
+def test_write_after_close_raises_os_error(terminal):
+    _, transport = terminal
+    transport.close()
+
+    with pytest.raises(OSError) as error:
+        transport.write(b'\x02\x04\xE8\x03')
+
+    assert error.value.errno == errno.EBADF
+
+
+def test_hangup_closes_port(terminal):
+    master_fd, transport = terminal
+    os.close(master_fd)
+
+    assert transport.readinto(bytearray(16)) == 0
+    assert not transport.is_open
+
+
+def test_unknown_keyword_is_rejected(terminal):
+    with pytest.raises(TypeError):
+        PosixSerialTransport(terminal[1].port, 115200, read_timeout=1)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
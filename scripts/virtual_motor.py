@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+
+"""
+Author:
+    Lachlan Mares, lachlan.mares@adelaide.edu.au
+
+License:
+    ??
+
+Description:
+    Virtual motor controller on a pseudo terminal. Speaks the protocol in SerialInterface.ino / definitions.h
+    and models MotorInterface job handling, pulse timing, ramping and the quadrature encoder, so the Python
+    clients can be tested and load tested without an RP2040.
+"""
+
+import os
+import tty
+import math
+import time
+import struct
+import argparse
+import selectors
+import threading
+from typing import Union
+from pathlib import Path
+
+from definition_file_parser import parse_header_defines
+from motor_protocol import load_protocol
+from serial_framer import SerialFramer
+
+
+class VirtualMotor:
+    def __init__(self, definitions_filepath: Path, time_scale: float = 1.0, library_header_filepath: Union[Path, None] = None, micros_offset: int = 0):
+        """
+        Description:
+            Opens a pty, port_name is the device path to hand to Motor. Firmware behaviour is ported from
+            processCommandMessage, MotorInterface::StartJob / Update / UpdateStatus and QuadratureEncoder,
+            including their quirks (e.g. the stale job id echoed for PAUSE/RESUME/CANCEL).
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            time_scale (float): Simulated microseconds per real microsecond, > 1 runs faster than real time
+            library_header_filepath (Path): MotorInterface.h, defaults to the copy next to definitions.h
+            micros_offset (int): Added to the micros() sent in timestamps, e.g. close to 2 ** 32 to test the wrap
+        """
+        definitions = load_protocol(definitions_filepath).require_serial()
+
+        if library_header_filepath is None:
+            library_header_filepath = definitions.header_path.parent / 'libraries/MotorInterface/MotorInterface.h'
+
+        library_defines = parse_header_defines(library_header_filepath)
+
+        self.time_scale = time_scale
+
+        serial_settings = definitions['serial_settings']
+        self.STX = serial_settings['STX']
+        self.ETX = serial_settings['ETX']
+        self.ACK = serial_settings['ACK']
+        self.NAK = serial_settings['NAK']
+
+        self.commands = definitions['command_types']
+        self.responses = definitions['response_types']
+        self.message_types = definitions['message_types']
+        self.status_bits = definitions['status_message_bits']
+
+        self.encoder_update_period_us = definitions['encoder_settings']['ENCODER_UPDATE_PERIOD_US']
+        self.encoder_pulses_per_revolution = definitions['encoder_settings']['ENCODER_PULSES_PER_REVOLUTION']
+        self.motor_steps_per_revolution = definitions['motor_settings']['MOTOR_STEPS_PER_REV']
+        self.status_message_interval_us = definitions['schedule_settings']['STATUS_MESSAGE_INTERVAL_US']
+        self.motor_feedback_interval_us = definitions['schedule_settings']['MOTOR_FEEDBACK_INTERVAL_US']
+        self.motor_feedback_minimum_interval_us = definitions['schedule_settings'].get('MOTOR_FEEDBACK_MINIMUM_INTERVAL_US', 0)
+        self.feedback_batch_max_samples = definitions.get('message_lengths', {}).get('MOTOR_FEEDBACK_BATCH_MAX_SAMPLES', 1)
+        self.filter_length = 10  # ENC_MAF_FILTER_LENGTH
+
+        # MotorInterface.h values, these are what StartJob actually uses
+        self.minimum_pulse_interval = library_defines['MINIMUM_PULSE_INTERVAL']
+        self.maximum_pulse_interval = library_defines['MAXIMUM_PULSE_INTERVAL']
+        self.default_pulse_interval = library_defines['DEFAULT_PULSE_INTERVAL']
+        self.default_pulse_on_period = library_defines['DEFAULT_PULSE_ON_PERIOD']
+        self.default_ramp_steps = library_defines['DEFAULT_RAMP_STEPS']
+        self.default_ramp_scaler = library_defines['DEFAULT_RAMP_SCALER']
+
+        self.motor_status_struct = struct.Struct('<4BL')
+        self.motor_feedback_struct = struct.Struct('<B2fi')
+        self.timestamp_struct = struct.Struct('<L')
+        self.feedback_batch_sample_struct = struct.Struct('<Lfi')
+
+        # Global in the firmware, RESET_MOTOR leaves it alone
+        self.timestamps_enabled = False
+        self.micros_offset = micros_offset
+        self.feedback_batch_size = 1
+        self.feedback_batch = []
+        self.long_struct = struct.Struct('!l')
+
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port_name = os.ttyname(self.slave_fd)
+
+        self.framer = SerialFramer(stx=self.STX, etx=self.ETX)
+        self.serial_buffer = bytearray(definitions['serial_settings']['SERIAL_BUFFER_LENGTH'])
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.frames_dropped = 0
+
+        self.running_thread = None
+        self.thread_running = False
+        self.start_time = time.perf_counter()
+
+        self.reset_state()
+
+    def reset_state(self):
+        # status_variables
+        self.running = False
+        self.fault = False
+        self.direction = False
+        self.enabled = False
+        self.sleep = False
+        self.paused = False
+        self.use_ramping = False
+        self.microstep = 1
+        self.job_id = 0
+        self.ramp_scaler = self.default_ramp_scaler
+        self.ramp_up_stop = 0
+        self.ramp_down_start = 0
+        self.ramp_up_interval = self.default_pulse_interval
+        self.ramp_down_interval = self.default_pulse_interval
+        self.ramp_interval_step = 0
+        self.ramp_pulse_interval = self.default_pulse_interval
+        self.pulse_interval = self.default_pulse_interval
+        self.pulse_on_period = self.default_pulse_on_period
+        self.pulses_remaining = 0
+        self.status_byte = 0
+
+        self.clear_command_variables()
+
+        # Step output
+        self.output_state = False
+        self.last_pulse_on_micros = 0
+
+        # encoder_status, rotor position is tracked in fractional encoder counts
+        self.rotor_counts = 0.0
+        self.encoder_count = 0
+        self.angle_count = 0
+        self.velocity_radians = 0.0
+        self.previous_encoder_count = 0
+        self.previous_encoder_micros = 0
+        self.filter_buffer = [0.0] * self.filter_length
+
+        # ScheduleMicro
+        self.status_task_micros = 0
+        self.feedback_task_micros = 0
+
+    def clear_command_variables(self):
+        self.command_direction = False
+        self.command_use_ramping = False
+        self.command_microstep = 1
+        self.command_job_id = 0
+        self.command_ramp_scaler = self.default_ramp_scaler
+        self.command_ramping_steps = 0
+        self.command_pulses = 0
+        self.command_pulse_interval = self.default_pulse_interval
+        self.command_pulse_on_period = self.default_pulse_on_period
+
+    def micros(self):
+        return int((time.perf_counter() - self.start_time) * 1e6 * self.time_scale)
+
+    def send_message(self, message: bytes):
+        frame = bytes((self.STX, len(message) + 3)) + message + bytes((self.ETX,))
+
+        try:
+            os.write(self.master_fd, frame)
+            self.frames_sent += 1
+
+        except (BlockingIOError, OSError):
+            # Host isn't reading, the USB CDC buffer would drop the data as well
+            self.frames_dropped += 1
+
+    def update(self, micros_now: Union[int, None] = None):
+        """
+        Description:
+            One pass of the firmware loop(): updateMotor, updateScheduler, updateSerial.
+
+        Args:
+            micros_now (int): Simulated micros(), defaults to the scaled wall clock
+        """
+        if micros_now is None:
+            micros_now = self.micros()
+
+        self.update_encoder_velocity(micros_now)
+
+        if self.update_motor(micros_now):
+            self.send_message(bytes((self.message_types['JOB_COMPLETE_MESSAGE_ID'], self.job_id)))
+            self.job_id = 0
+
+        self.read_commands()
+
+        if micros_now - self.status_task_micros >= self.status_message_interval_us:
+            self.status_task_micros = micros_now
+            self.update_status()
+            self.send_message(self.motor_status_struct.pack(self.message_types['MOTOR_STATUS_MESSAGE_ID'],
+                                                            self.status_byte,
+                                                            self.job_id,
+                                                            self.microstep,
+                                                            self.pulses_remaining & 0xFFFFFFFF) + self.timestamp(micros_now))
+
+        if micros_now - self.feedback_task_micros >= self.motor_feedback_interval_us:
+            self.feedback_task_micros = micros_now
+
+            if self.feedback_batch_size > 1:
+                self.add_feedback_sample(micros_now)
+            else:
+                self.send_feedback_message(micros_now)
+
+    def send_feedback_message(self, micros_now: int):
+        angle_radians = (self.angle_count / self.encoder_pulses_per_revolution) * 6.28318531
+
+        # {MOTOR_FEEDBACK_MESSAGE_ID, velocity_radians, angle_radians, angle_count}, the full 4 byte angle_count is sent
+        self.send_message(self.motor_feedback_struct.pack(self.message_types['MOTOR_FEEDBACK_MESSAGE_ID'],
+                                                          self.velocity_radians,
+                                                          angle_radians,
+                                                          self.angle_count) + self.timestamp(micros_now))
+
+    def add_feedback_sample(self, micros_now: int):
+        """
+        Description:
+            addFeedbackSample, the batch is sent as {MOTOR_FEEDBACK_BATCH_MESSAGE_ID, sample count, samples...}
+            once it holds feedback_batch_size samples.
+        """
+        self.feedback_batch.append(self.feedback_batch_sample_struct.pack((micros_now + self.micros_offset) & 0xFFFFFFFF,
+                                                                          self.velocity_radians,
+                                                                          self.angle_count))
+
+        if len(self.feedback_batch) >= self.feedback_batch_size:
+            self.send_message(bytes((self.message_types['MOTOR_FEEDBACK_BATCH_MESSAGE_ID'], len(self.feedback_batch))) + b''.join(self.feedback_batch))
+            self.feedback_batch = []
+
+    def timestamp(self, micros_now: int):
+        """
+        Description:
+            micros() as appended to status and feedback after SET_TIMESTAMPS, nothing otherwise.
+        """
+        if not self.timestamps_enabled:
+            return b''
+
+        return self.timestamp_struct.pack((micros_now + self.micros_offset) & 0xFFFFFFFF)
+
+    def read_commands(self):
+        try:
+            data = os.read(self.master_fd, 4096)
+
+        except (BlockingIOError, OSError):
+            data = b''
+
+        if data:
+            self.framer.feed(data)
+
+        for _, message_buffer in self.framer.frames():
+            # AtSerial copies the payload without ETX into serial_buffer, old bytes stay behind it
+            payload_length = len(message_buffer) - 1
+            self.serial_buffer[:payload_length] = message_buffer[:payload_length]
+            self.frames_received += 1
+            self.process_command_message(payload_length)
+
+    def long_from_bytes(self, index: int):
+        return self.long_struct.unpack_from(self.serial_buffer, index)[0] & 0xFFFFFFFF
+
+    def job_rejection(self, check_fault: bool = True):
+        if check_fault and self.fault:
+            return self.responses['MOTOR_IN_FAULT_RESPONSE']
+        elif not self.enabled:
+            return self.responses['MOTOR_DISABLED_RESPONSE']
+        elif self.running:
+            return self.responses['MOTOR_BUSY_RESPONSE']
+        elif self.sleep:
+            return self.responses['MOTOR_IN_SLEEP_RESPONSE']
+        return None
+
+    def process_command_message(self, bytes_read: int):
+        serial_buffer = self.serial_buffer
+        command = serial_buffer[0]
+        response = [self.message_types['RESPONSE_MESSAGE_ID'], command, 0x00, self.responses['UNKNOWN_MOTOR_COMMAND_RESPONSE'], self.NAK]
+
+        job_lengths = {self.commands.get('SEND_JOB'): 8,
+                       self.commands.get('SEND_JOB_WITH_RAMPING'): 12,
+                       self.commands.get('SEND_JOB_ALL_VARIABLES'): 16,
+                       self.commands.get('SEND_JOB_ALL_VARIABLES_WITH_RAMPING'): 20,
+                       self.commands.get('SEND_JOB_ALL_VARIABLES_WITH_RAMPING_AND_RATE'): 21,
+                       }
+
+        if command in job_lengths and command is not None:
+            response[2] = serial_buffer[3]
+
+            # The SEND_JOB_ALL_VARIABLES fault check is disabled in the firmware
+            rejection = self.job_rejection(check_fault=command != self.commands['SEND_JOB_ALL_VARIABLES'])
+
+            if rejection is not None:
+                response[3] = rejection
+
+            elif bytes_read == job_lengths[command]:
+                self.command_direction = serial_buffer[1] > 0
+                self.command_microstep = serial_buffer[2]
+                self.command_job_id = serial_buffer[3]
+                self.command_pulses = self.long_from_bytes(4)
+
+                if command == self.commands['SEND_JOB']:
+                    self.command_use_ramping = False
+                    self.command_pulse_interval = 0
+                    self.command_pulse_on_period = 0
+                    self.command_ramping_steps = 0
+
+                elif command == self.commands['SEND_JOB_WITH_RAMPING']:
+                    self.command_use_ramping = True
+                    self.command_ramping_steps = self.long_from_bytes(8)
+                    self.command_pulse_interval = 0
+                    self.command_pulse_on_period = 0
+
+                elif command == self.commands['SEND_JOB_ALL_VARIABLES']:
+                    self.command_use_ramping = False
+                    self.command_pulse_interval = self.long_from_bytes(8)
+                    self.command_pulse_on_period = self.long_from_bytes(12)
+
+                else:
+                    self.command_use_ramping = True
+                    self.command_pulse_interval = self.long_from_bytes(8)
+                    self.command_pulse_on_period = self.long_from_bytes(12)
+                    self.command_ramping_steps = self.long_from_bytes(16)
+
+                    if bytes_read == 21:
+                        self.command_ramp_scaler = serial_buffer[20]
+
+                self.start_job()
+                response[3] = 0x00
+                response[4] = self.ACK
+
+            else:
+                response[3] = self.responses['BAD_JOB_COMMAND_RESPONSE']
+
+        elif command == self.commands['PAUSE_JOB']:
+            response[2] = serial_buffer[3]
+
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+
+                if self.running:
+                    self.paused = True
+
+            elif self.enabled:
+                if self.running:
+                    if self.paused:
+                        response[3] = self.responses['JOB_ALREADY_PAUSED_RESPONSE']
+                    else:
+                        self.paused = True
+                        response[3] = 0x00
+                        response[4] = self.ACK
+                else:
+                    response[3] = self.responses['NO_ACTIVE_JOB_RESPONSE']
+            else:
+                response[3] = self.responses['MOTOR_DISABLED_RESPONSE']
+
+        elif command == self.commands['RESUME_JOB']:
+            response[2] = serial_buffer[3]
+
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+
+            elif self.enabled:
+                if self.running:
+                    if self.paused:
+                        self.resume_job()
+                        response[3] = 0x00
+                        response[4] = self.ACK
+                    else:
+                        response[3] = self.responses['JOB_ALREADY_RESUMED_RESPONSE']
+                else:
+                    response[3] = self.responses['NO_ACTIVE_JOB_RESPONSE']
+            else:
+                response[3] = self.responses['MOTOR_DISABLED_RESPONSE']
+
+        elif command == self.commands['CANCEL_JOB']:
+            response[2] = serial_buffer[3]
+
+            if self.enabled:
+                if self.running:
+                    self.cancel_job()
+                    self.send_message(bytes((self.message_types['JOB_CANCELLED_MESSAGE_ID'], self.job_id)))
+                    self.job_id = 0
+                    response[3] = 0x00
+                    response[4] = self.ACK
+                else:
+                    response[3] = self.responses['NO_ACTIVE_JOB_RESPONSE']
+            else:
+                response[3] = self.responses['MOTOR_DISABLED_RESPONSE']
+
+        elif command == self.commands['ENABLE_MOTOR']:
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+            elif self.enabled:
+                response[3] = self.responses['MOTOR_ALREADY_ENABLED_RESPONSE']
+            else:
+                self.enabled = True
+                response[3] = 0x00
+                response[4] = self.ACK
+
+        elif command == self.commands['DISABLE_MOTOR']:
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+            elif self.enabled:
+                self.enabled = False
+                response[3] = 0x00
+                response[4] = self.ACK
+            else:
+                response[3] = self.responses['MOTOR_ALREADY_DISABLED_RESPONSE']
+
+        elif command == self.commands['SLEEP_MOTOR']:
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+                response[4] = self.ACK
+                self.sleep = True
+
+            elif self.sleep:
+                response[3] = self.responses['MOTOR_ALREADY_SLEEPING_RESPONSE']
+
+            else:
+                if self.enabled and self.running:
+                    self.paused = True
+
+                self.sleep = True
+                response[3] = 0x00
+                response[4] = self.ACK
+
+        elif command == self.commands['WAKE_MOTOR']:
+            if self.fault:
+                response[3] = self.responses['MOTOR_IN_FAULT_RESPONSE']
+
+            elif self.sleep:
+                self.sleep = False
+
+                # A plain wake leaves the response at UNKNOWN_MOTOR_COMMAND_RESPONSE / NAK, as the firmware does
+                if self.enabled and self.running and self.paused:
+                    response[3] = self.responses['WAKE_WITH_ACTIVE_JOB_RESPONSE']
+                    response[4] = self.ACK
+                    self.resume_job()
+
+            else:
+                response[3] = self.responses['MOTOR_ALREADY_AWAKE_RESPONSE']
+
+        elif command == self.commands.get('SET_TIMESTAMPS'):
+            if bytes_read == 2:
+                self.timestamps_enabled = serial_buffer[1] > 0
+                response[3] = 0x00
+                response[4] = self.ACK
+
+        elif command == self.commands.get('SET_FEEDBACK_BATCH'):
+            if bytes_read == 6:
+                feedback_interval = self.long_from_bytes(2)
+
+                if not 1 <= serial_buffer[1] <= self.feedback_batch_max_samples:
+                    response[3] = self.responses['BAD_SETTING_RESPONSE']
+
+                elif feedback_interval != 0 and feedback_interval < self.motor_feedback_minimum_interval_us:
+                    response[3] = self.responses['BAD_SETTING_RESPONSE']
+
+                else:
+                    self.feedback_batch_size = serial_buffer[1]
+                    self.feedback_batch = []
+
+                    if feedback_interval != 0:
+                        self.motor_feedback_interval_us = feedback_interval
+
+                    response[3] = 0x00
+                    response[4] = self.ACK
+
+        elif command == self.commands['RESET_MOTOR']:
+            was_running = self.enabled and self.running
+
+            # Pause, sleep, reset, enable, wake and resume leaves everything as it was
+            if was_running:
+                self.resume_job()
+
+            response[3] = 0x00
+            response[4] = self.ACK
+
+        self.send_message(bytes(response))
+
+    def start_job(self):
+        self.running = True
+        self.direction = self.command_direction
+        self.use_ramping = self.command_use_ramping
+        self.microstep = self.command_microstep if self.command_microstep in (1, 2, 4, 8, 16, 32) else 1
+        self.job_id = self.command_job_id
+        self.paused = False
+        self.ramp_scaler = self.default_ramp_scaler if self.command_ramp_scaler == 0 else self.command_ramp_scaler
+
+        self.output_state = False
+        self.last_pulse_on_micros = None
+
+        self.enabled = True
+        self.sleep = False
+
+        if self.minimum_pulse_interval < self.command_pulse_interval < self.maximum_pulse_interval:
+            self.pulse_interval = self.command_pulse_interval
+        else:
+            self.pulse_interval = self.default_pulse_interval
+
+        if self.command_pulse_on_period < self.command_pulse_interval and self.command_pulse_on_period != 0:
+            self.pulse_on_period = self.command_pulse_on_period
+        else:
+            self.pulse_on_period = self.pulse_interval // 2
+
+        self.pulses_remaining = self.command_pulses
+
+        if self.use_ramping:
+            if self.command_ramping_steps == 0:
+                self.command_ramping_steps = self.default_ramp_steps
+
+            if 2 * self.command_ramping_steps < self.pulses_remaining:
+                self.ramp_up_stop = self.pulses_remaining - self.command_ramping_steps
+                self.ramp_down_start = self.command_ramping_steps
+            else:
+                self.ramp_up_stop = self.pulses_remaining // 2
+                self.ramp_down_start = (self.ramp_up_stop - 1) & 0xFFFFFFFF
+
+            # unsigned long arithmetic, as in MotorInterface::StartJob
+            self.ramp_up_interval = (self.pulse_interval * self.command_ramp_scaler) & 0xFFFFFFFF
+            self.ramp_pulse_interval = self.ramp_up_interval
+            self.ramp_down_interval = self.pulse_interval
+            self.ramp_interval_step = ((self.ramp_up_interval - self.ramp_down_interval) & 0xFFFFFFFF) // self.command_ramping_steps
+
+        else:
+            self.ramp_up_stop = 0
+            self.ramp_down_start = 0
+            self.ramp_up_interval = 0
+            self.ramp_down_interval = 0
+            self.ramp_interval_step = 0
+            self.ramp_pulse_interval = 0
+
+        self.clear_command_variables()
+
+    def resume_job(self):
+        self.paused = False
+        self.last_pulse_on_micros = None
+
+    def cancel_job(self):
+        self.running = False
+        self.output_state = False
+        self.pulses_remaining = 0
+        self.enabled = False
+        self.job_id = 0
+
+    def update_motor(self, micros_now: int):
+        """
+        Description:
+            Replays every step pin edge MotorInterface::Update would have produced up to micros_now.
+
+        Returns:
+            job done: (bool)
+        """
+        while self.enabled and self.running and not self.paused and not self.fault:
+            if self.pulses_remaining == 0:
+                self.running = False
+                return True
+
+            if not self.output_state:
+                if self.last_pulse_on_micros is None:
+                    # Timers are reset at the start of a job, the first pulse goes straight away
+                    pulse_on_micros = micros_now
+                else:
+                    # Update only looks for the next rising edge once the step pin has gone low
+                    pulse_on_micros = self.last_pulse_on_micros + max(self.ramp_pulse_interval if self.use_ramping else self.pulse_interval,
+                                                                      self.pulse_on_period)
+
+                if pulse_on_micros > micros_now:
+                    break
+
+                self.last_pulse_on_micros = pulse_on_micros
+                self.output_state = True
+
+                if self.use_ramping:
+                    if self.pulses_remaining > self.ramp_up_stop:
+                        self.ramp_up_interval = (self.ramp_up_interval - self.ramp_interval_step) & 0xFFFFFFFF
+                        self.ramp_pulse_interval = self.ramp_up_interval
+
+                    elif self.pulses_remaining < self.ramp_down_start:
+                        self.ramp_down_interval = (self.ramp_down_interval + self.ramp_interval_step) & 0xFFFFFFFF
+                        self.ramp_pulse_interval = self.ramp_down_interval
+
+                    else:
+                        self.ramp_pulse_interval = self.pulse_interval
+
+            else:
+                # ResumeJob resets the timers, a step left high by a pause goes low straight away
+                if self.last_pulse_on_micros is not None and self.last_pulse_on_micros + self.pulse_on_period > micros_now:
+                    break
+
+                self.output_state = False
+                self.pulses_remaining -= 1
+                self.step_rotor()
+
+        return False
+
+    def step_rotor(self):
+        counts_per_pulse = self.encoder_pulses_per_revolution / (self.motor_steps_per_revolution * self.microstep)
+        self.rotor_counts += counts_per_pulse if self.direction else -counts_per_pulse
+
+        new_encoder_count = math.floor(self.rotor_counts + 1e-9)
+        self.angle_count = (self.angle_count + new_encoder_count - self.encoder_count) % self.encoder_pulses_per_revolution
+        self.encoder_count = new_encoder_count
+
+    def update_encoder_velocity(self, micros_now: int):
+        if micros_now - self.previous_encoder_micros >= self.encoder_update_period_us:
+            delta = self.encoder_count - self.previous_encoder_count
+            self.filter_buffer.pop(0)
+            self.filter_buffer.append((delta / self.encoder_pulses_per_revolution) * 6.28318531)
+            self.velocity_radians = sum(self.filter_buffer) / self.filter_length
+            self.previous_encoder_count = self.encoder_count
+            self.previous_encoder_micros = micros_now
+
+    def update_status(self):
+        status_byte = 0
+        status_byte |= self.direction << self.status_bits['STATUS_DIRECTION_BIT']
+        status_byte |= self.fault << self.status_bits['STATUS_FAULT_BIT']
+        status_byte |= self.paused << self.status_bits['STATUS_PAUSED_BIT']
+        status_byte |= self.use_ramping << self.status_bits['STATUS_RAMPING_BIT']
+        status_byte |= self.enabled << self.status_bits['STATUS_ENABLED_BIT']
+        status_byte |= self.running << self.status_bits['STATUS_RUNNING_BIT']
+        status_byte |= self.sleep << self.status_bits['STATUS_SLEEP_BIT']
+        self.status_byte = status_byte
+
+    def run_loop(self, loop_period: float = 0.0005):
+        while self.thread_running:
+            self.update()
+            time.sleep(loop_period)
+
+    def start(self, loop_period: float = 0.0005):
+        """
+        Description:
+            Runs the firmware loop in a background thread.
+
+        Args:
+            loop_period (float): Real time between loop passes in seconds
+        """
+        self.thread_running = True
+        self.running_thread = threading.Thread(target=self.run_loop, args=(loop_period,), daemon=True)
+        self.running_thread.start()
+
+    def stop(self):
+        self.thread_running = False
+
+        if self.running_thread is not None:
+            self.running_thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+class VirtualMotorFarm:
+    def __init__(self, definitions_filepath: Path, number_of_motors: int, time_scale: float = 1.0):
+        """
+        Description:
+            Runs many VirtualMotors from one thread, commands are picked up as soon as they arrive
+            and every motor's firmware loop is run at least once per loop period.
+
+        Args:
+            definitions_filepath (Path): Path to the firmware definitions.h
+            number_of_motors (int): Number of virtual motors
+            time_scale (float): Simulated microseconds per real microsecond
+        """
+        self.motors = [VirtualMotor(definitions_filepath, time_scale=time_scale) for _ in range(number_of_motors)]
+        self.port_names = [motor.port_name for motor in self.motors]
+        self.selector = selectors.DefaultSelector()
+
+        for motor in self.motors:
+            self.selector.register(motor.master_fd, selectors.EVENT_READ, motor)
+
+        self.thread_running = False
+        self.running_thread = None
+
+    def run_loop(self, loop_period: float = 0.0005):
+        while self.thread_running:
+            for key, _ in self.selector.select(loop_period):
+                key.data.update()
+
+            for motor in self.motors:
+                motor.update()
+
+    def start(self, loop_period: float = 0.0005):
+        self.thread_running = True
+        self.running_thread = threading.Thread(target=self.run_loop, args=(loop_period,), daemon=True)
+        self.running_thread.start()
+
+    def stop(self):
+        self.thread_running = False
+
+        if self.running_thread is not None:
+            self.running_thread.join()
+
+    def close(self):
+        self.stop()
+        self.selector.close()
+
+        for motor in self.motors:
+            motor.close()
+
+
+if __name__ == "__main__":
+    project_dir = Path(__file__).resolve().parents[1]
+
+    parser = argparse.ArgumentParser(description="Virtual engineering-team-motor controllers on pseudo terminals")
+    parser.add_argument('--count', type=int, default=1, help="number of virtual motors")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="simulated time per real time")
+    parser.add_argument('--definitions', type=Path, default=project_dir / 'arduino/engineering-team-motor/definitions.h')
+    args = parser.parse_args()
+
+    farm = VirtualMotorFarm(args.definitions, number_of_motors=args.count, time_scale=args.time_scale)
+
+    for port_name in farm.port_names:
+        print(port_name)
+
+    farm.start()
+
+    try:
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        farm.close()